@@ -1,313 +1,943 @@
 import dash
 import dash_bootstrap_components as dbc
-import dash_core_components as dcc
-import dash_html_components as html
-import geopandas as gpd
 import pandas as pd
 import plotly.express as px
-import requests
-from dash.dependencies import Input, Output
+from dash import Patch, dcc, html
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
+from flask import jsonify, request
+import datetime
+import hashlib
+import json
+import numpy as np
 import os
 import sys
+import threading
+import time
 
+from ingest import INCOMING_DIR, POLL_INTERVAL, IncomingWatcher, merge_batch
+from memory import artifact_sizes, format_sizes
+from metrics import Metrics, instrument
+from pipeline import (INITIAL_ZOOM, build_artifacts, dashboard_artifacts, hist_specs, input_version, load_boundaries,
+                      sketch_specs)
+from price_ranks import PriceRanks
+from response_cache import SHARED_DB, MemoryTier, ResponseCache, SharedTier, callback_id, source_version
+from sketches import median
+from spatial import SuburbLocator
 
 
-# check for tokens
-token = os.getenv('MAPBOX_TOKEN')
-mapbox_style = "dark"
-if not token:
-    try:
-        token = open('.mapbox_token').read()
-    except Exception as e:
-        print('mapbox token not found, using open-street-maps')
-        mapbox_style = "carto-darkmatter"
 
+# CLIENTSIDE_SELECTION=1 ships the per-suburb aggregates to the browser once and handles map clicks there
+clientside_selection = bool(os.getenv('CLIENTSIDE_SELECTION'))
 
-# Function to import geojson and change to geopandas dataframe
-def remoteGeoJSONToGDF(url, display=False):
-    """Import remote GeoJSON to a GeoDataFrame
-    Keyword arguments:
-    url -- URL to GeoJSON resource on web
-    display -- Displays geometries upon loading (default: False)
-    """
-    r = requests.get(url)
-    data = r.json()
-    gdf = gpd.GeoDataFrame.from_features(data['features'])
-    if display:
-        gdf.plot()
-    return gdf
+# CHUNK_ROWS=<rows> builds the aggregates from chunks of the sales data for datasets too large to load whole, the
+# dashboard then serves from aggregates only and price medians come from the sketches
+chunk_rows = int(os.getenv('CHUNK_ROWS', 0))
+
+# BUILD_WORKERS=<n> spreads a build of the artifacts at startup over n processes (see pipeline.py)
+build_workers = int(os.getenv('BUILD_WORKERS', 1))
+
+# timings and counters served on /metrics (see metrics.py), PROFILE_DIR=<dir> allows profiling single requests
+metrics = Metrics()
+metrics.describe('startup_phase_seconds', 'gauge', 'Time spent in each phase of loading the data')
+metrics.describe('callback_duration_seconds', 'histogram', 'Time spent in each callback function, without HTTP')
+metrics.describe('ingested_sales_total', 'counter', 'Sales added since startup')
+metrics.describe('response_cache_hits_total', 'counter', 'Requests answered from each tier of the response cache')
+metrics.describe('response_cache_misses_total', 'counter', 'Cacheable requests that ran their callback')
+metrics.describe('response_cache_bytes', 'gauge', 'Bytes of the responses held by each tier of the response cache')
+metrics.describe('data_memory_bytes', 'gauge', 'Memory held by each structure of the data, mapped ones are shared')
 
 
 # function to plot histograms
-def plot_hist(x, df, new_label, range_list, title):
+def plot_hist(data, x, position, location=None, months=None):
     """
 
+    :param data: the Artifacts to plot from
     :param x: x column of dataframe
-    :param df: dataframe
-    :param new_label: new label to replace existing one
-    :param range_list: a range of x limits in list format
-    :param title: plot title
+    :param position: suburb position in suburb_index, or None for all of Sydney
+    :param location: suburb name for the title
+    :param months: (start, stop) month positions of the date range, None for all sales
     :return: returns figure
     """
-    figure = px.histogram(data_frame=df, x=x, template='plotly_dark', labels={x: new_label}, height=300)
+    spec = hist_specs[x]
+    title = spec['title'] if location is None else '{0} in {1}'.format(spec['title'], location)
+
+    if months is None:
+        edges, counts = data.histogram_cache.get(x, position)
+    else:
+        edges, counts = data.cube.histogram(x, position, *months)
+    figure = px.bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, template='plotly_dark',
+                    labels={'x': spec['label'], 'y': 'count'}, height=300)
+
+    figure.update_layout(
+        dict(title=title, plot_bgcolor='rgba(0, 0, 0, 0)', paper_bgcolor='rgba(0, 0, 0, 0)', bargap=0),
+        yaxis=dict(showgrid=False),
+        xaxis=dict(showgrid=False))
+    figure.update_xaxes(range=spec['range'])
+    figure.update_traces(width=edges[1] - edges[0], marker=dict(color=px.colors.sequential.Viridis[-4]))
+
+    return figure
+
+
+# periods of the price trend, with the number of calendar months in each
+trend_periods = {'M': ('Monthly', 1), 'Q': ('Quarterly', 3)}
+
+
+def build_trends(data):
+    """Median selling price and number of sales of every suburb, and of all of Sydney, per month and per quarter
+
+    Rolled up from the monthly cube's sketches once per data version and kept with the artifacts, so a trend is
+    one row of a table. The last row of each table is all of Sydney.
+    """
+    if 'trends' in data.extras:
+        return data.extras['trends']
+
+    cube = data.cube
+    trends = {}
+    for period, (_, months) in trend_periods.items():
+        medians, counts = cube.period_medians('sellPrice', months)
+        city_medians, city_counts = cube.period_medians('sellPrice', months, np.arange(len(medians)))
+        trends[period] = {'medians': np.vstack([medians, city_medians]), 'counts': np.vstack([counts, city_counts]),
+                          'dates': [cube.period_label(p, months) for p in range(medians.shape[1])]}
+    data.extras['trends'] = trends
+
+    return trends
+
+
+def plot_trend(data, position, period, location=None, months=None):
+    """
+
+    :param data: the Artifacts to plot from
+    :param position: suburb position in suburb_index, an array of positions to combine, or None for all of Sydney
+    :param period: key of trend_periods
+    :param location: suburb name for the title
+    :param months: (start, stop) month positions of the date range, None for all sales
+    :return: returns figure
+    """
+    trend = build_trends(data)[period]
+    label, period_months = trend_periods[period]
+    if position is None:
+        medians, counts = trend['medians'][-1], trend['counts'][-1]
+    elif np.ndim(position):
+        # a selection of several suburbs merges their sketches, like the stat cards
+        medians, counts = data.cube.period_medians('sellPrice', period_months, position)
+    elif position < 0:
+        medians, counts = np.full(len(trend['dates']), np.nan), np.zeros(len(trend['dates']), dtype='int64')
+    else:
+        medians, counts = trend['medians'][position], trend['counts'][position]
+
+    dates = trend['dates']
+    if months is not None:
+        periods, _ = data.cube.periods(period_months)
+        first, last = periods[months[0]], periods[months[1]] + 1
+        dates, medians, counts = dates[first:last], medians[first:last], counts[first:last]
+
+    title = '{0} Median Selling Price'.format(label)
+    if location is not None:
+        title = '{0} in {1}'.format(title, location)
+
+    figure = px.line(x=dates, y=medians, hover_data={'sales': counts}, markers=True, template='plotly_dark',
+                     labels={'x': 'date', 'y': 'median selling price'}, height=300)
 
     figure.update_layout(
         dict(title=title, plot_bgcolor='rgba(0, 0, 0, 0)', paper_bgcolor='rgba(0, 0, 0, 0)'),
         yaxis=dict(showgrid=False),
         xaxis=dict(showgrid=False))
-    figure.update_xaxes(range=range_list)
-    figure.update_traces(marker=dict(color=px.colors.sequential.Viridis[-4]))
+    figure.update_traces(line=dict(color=px.colors.sequential.Viridis[-4]))
 
     return figure
 
 
+def build_ranks(data):
+    """Selling price CDFs of every suburb and of all of Sydney for percentile lookups (see price_ranks.py)
+
+    Exact from the sales rows, or from the price sketches when the data is held as aggregates only. Built once
+    per data version and kept with the artifacts.
+    """
+    if 'ranks' not in data.extras:
+        data.extras['ranks'] = PriceRanks.from_index(data.suburb_index, 'sellPrice') if len(data.df) else \
+            PriceRanks.from_cube(data.cube, 'sellPrice')
+
+    return data.extras['ranks']
+
+
 stat_labels = ['Selling Price is {:.2f}', 'Number of Bedrooms is {:.2f}', 'Number of Bathrooms is {:.2f}',
                'Number of Carspaces is {:.2f}']
 
-# Preparing Data
-# ---------------------------------------------------------------------------------------------------------------------
-# import dataframe
-df = pd.read_csv("data/prices_data.csv", parse_dates=True, index_col='Date')
+# median columns of the stat cards, in the order of stat_labels, always selected by name
+stat_columns = list(sketch_specs)
 
-sydney = remoteGeoJSONToGDF('https://raw.githubusercontent.com/Perishleaf/data-visualisation-scripts/master'
-                            '/dash_project_medium/Sydney_suburb.geojson')
+# metrics the map can be coloured by, with their colour range (None for the range of the suburb medians)
+map_metrics = {'sellPrice': dict(label='Selling Price', colorbar='Selling Price in Millions (AUD)', range=(0, 2000000)),
+               'bed': dict(label='Bedrooms', colorbar='Median Number of Bedrooms', range=None),
+               'bath': dict(label='Bathrooms', colorbar='Median Number of Bathrooms', range=None),
+               'car': dict(label='Carspaces', colorbar='Median Number of Carspaces', range=None)}
 
-# cleaning the geopandas dataframe
-sydney = sydney[["geometry", "nsw_loca_2"]]
-sydney.rename(columns={"nsw_loca_2": "suburb"}, inplace=True)
+# BACKGROUND_LOADING=1 binds the server straight away and loads the data on a thread, serving a loading page and
+# reporting progress on /healthz and /readyz until it is ready (see load_data)
+background_loading = bool(os.getenv('BACKGROUND_LOADING'))
 
-# change to proper nouns to match our geojson file
-sydney.suburb = sydney.suburb.str.title()
+# the data the callbacks read, set by load_data and replaced as a whole when new sales are ingested
+artifacts = None
+suburb_locator = None
+data_ready = threading.Event()
+loading_state = {'step': None, 'started': None, 'finished': None, 'error': None}
 
-# Median Stats
-median_statistics = df.groupby("suburb").median()
+# new sales replace artifacts as a whole under this lock, callbacks read the global once and use that snapshot
+ingest_lock = threading.Lock()
 
-# Create merged geopandas df
-geo_house_prices = pd.merge(sydney, median_statistics, left_on="suburb", right_on=median_statistics.index, how="inner")
-geo_house_prices.set_index("suburb", inplace=True)
 
-# Choropleth Map
-# ---------------------------------------------------------------------------------------------------------------------
-fig = px.choropleth_mapbox(geo_house_prices,
-                           geojson=geo_house_prices.geometry,
-                           locations=geo_house_prices.index, color='sellPrice',
-                           color_continuous_scale="viridis",
-                           center={"lat": -33.865143, "lon": 151.209900},
-                           range_color=(0, 2000000),
-                           labels={"sellPrice": "Selling Price", "suburb": "Suburb"},
-                           opacity=0.6,
-                           zoom=10
-                           )
-
-fig.update_layout(mapbox_style="dark",
-                  template='plotly_dark',
-                  mapbox_accesstoken=token,
-                  autosize=True,
-                  plot_bgcolor='rgba(0, 0, 0, 0)',
-                  paper_bgcolor='rgba(0, 0, 0, 0)',
-                  margin=dict(l=0, r=0, t=0, b=0)
-                  )
-fig.update_coloraxes(colorbar_title=dict(side='right', text='Selling Price in Millions (AUD)'),
-                     colorbar=dict(x=0.92, xpad=0))
-fig.update_geos(fitbounds="locations", visible=False)
-
-# Histograms
-# ---------------------------------------------------------------------------------------------------------------------
+def ingest_batch(batch):
+    """Add a dataframe of new sales to the dashboard (see ingest.py)"""
+    global artifacts
+
+    data_ready.wait()
+    with ingest_lock:
+        data = merge_batch(artifacts, batch)
+        build_trends(data)
+        build_ranks(data)
+        artifacts = data
+    metrics.inc('ingested_sales_total', len(batch))
+    report_memory(artifacts, suburb_locator)
+    print('ingested {0} sales, data version {1}'.format(len(batch), artifacts.version))
+
+
+def report_memory(data, locator):
+    """Record the memory of every data structure on /metrics, and print it when MEMORY_REPORT=1 (see memory.py)"""
+    sizes = artifact_sizes(data, locator)
+    for name, size, mapped in sizes:
+        metrics.set('data_memory_bytes', size, structure=name, mapped=str(mapped).lower())
+
+    if os.getenv('MEMORY_REPORT'):
+        print('data version {0}\n{1}'.format(data.version, format_sizes(sizes)))
+
+
+watcher = None
+
+
+def start_ingest():
+    """Watch data/incoming for new sales when INGEST=1, called once per serving process"""
+    global watcher
+
+    if os.getenv('INGEST') and watcher is None:
+        watcher = IncomingWatcher(ingest_batch, os.getenv('INGEST_DIR', INCOMING_DIR),
+                                  float(os.getenv('INGEST_INTERVAL', POLL_INTERVAL)))
+        watcher.start()
+
+
+def month_range(dates, cube):
+    """(start, stop) months picked on the date slider, None when it covers every month"""
+    if dates is None or (dates[0] <= 0 and dates[1] >= cube.n_months - 1):
+        return None
+
+    return int(dates[0]), int(dates[1])
+
+
+def json_values(values):
+    """List of floats with None for NaN, which JSON can't hold"""
+    values = np.asarray(values, dtype='float64')
+
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+# Client-side selection
 # ---------------------------------------------------------------------------------------------------------------------
-# Count Number of sales made in each month and turn into a dataframe
-sold_per_month = pd.DataFrame(df.index.month_name().value_counts())
+def build_aggregates(data):
+    """Medians and histogram bins of every suburb, everything the clientside selection callback needs
+
+    Histograms are shipped as their city-wide figure plus bin counts, the browser only swaps the counts and title.
+    Built once per data version and kept with the artifacts.
+    """
+    if 'aggregates' in data.extras:
+        return data.extras['aggregates']
 
-# Rename Date column to Sold per Month
-sold_per_month.rename(columns={'Date': 'Sold per Month'}, inplace=True)
-sold_per_month.head()
+    table = {'labels': stat_labels,
+             'suburbs': list(data.suburb_index.suburbs),
+             'medians': json_values(data.median_statistics[stat_columns].values),
+             'city': json_values(data.median_statistics[stat_columns].median().values),
+             'hist': [{'title': spec['title'],
+                       'counts': data.histogram_cache.counts[x].tolist(),
+                       'figure': json.loads(plot_hist(data, x, None).to_json())} for x, spec in hist_specs.items()]}
+    table['version'] = hashlib.sha1(json.dumps(table, sort_keys=True).encode()).hexdigest()
+    data.extras['aggregates'] = table
 
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+    return table
+
+
+def map_figure(data):
+    """The map's figure, in the clientside selection mode with clicks that don't select
+
+    assets/clientside.js combines no suburbs, it shows the clicked one, so selecting several with shift-click, the
+    lasso or the box is turned off rather than showing only the last click of a selection.
+    """
+    if not clientside_selection:
+        return data.figure
+
+    return dict(data.figure, layout=dict(data.figure['layout'], clickmode='event'))
+
+
+# the loading page has none of the dashboard's components, so their callbacks can't be checked against it
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=background_loading)
 
 server = app.server
 
+# registered first so responses served from the response cache are measured too
+instrument(app, metrics, os.getenv('PROFILE_DIR'))
+
 # Layouts
 # ---------------------------------------------------------------------------------------------------------------------
-app.layout = dbc.Container([
-    dbc.Row([
-        dbc.Col([
-            html.H5(["Sydney Housing Market Dashboard",
+# the date slider filters by month, the clientside selection mode only ships all-time aggregates so has no slider
+def date_controls(cube):
+    """Date range slider over the months of a cube"""
+    if clientside_selection:
+        return []
+
+    return [dcc.RangeSlider(id='dates', min=0, max=cube.n_months - 1, step=1, value=[0, cube.n_months - 1],
+                            allowCross=False,
+                            marks={month: str((cube.first_month + month) // 12) for month in range(cube.n_months)
+                                   if (cube.first_month + month) % 12 == 0})]
+
+
+def loading_layout():
+    """Shown until the data is loaded, the page reloads itself once it is"""
+    return dbc.Container([
+        html.H5("Sydney Housing Market Dashboard", style={'margin-top': '20px'}),
+        html.P('Loading the data...', id='loading-status'),
+        dcc.Interval(id='loading-poll', interval=1000),
+        dcc.Store(id='loading-ready')
+    ], fluid=True)
+
+
+def serve_layout():
+    """The page for the current data, rebuilt when new sales were ingested"""
+    data = artifacts
+    if data is None:
+        return loading_layout()
+
+    return dbc.Container([
+        dbc.Row([
+            dbc.Col([
+                html.H5(["Sydney Housing Market Dashboard",
+
+                         html.A(
+                             html.Img(
+                                 src='assets/puzzle.png',
+                                 style={'float': 'right', 'height': '28px',
+                                        'margin-right': '1%', 'margin-top': '-7px'}
+                             ),
+                             href='https://kostyafarber.github.io/'),
 
-                     html.A(
                          html.Img(
-                             src='assets/puzzle.png',
+                             src='assets/dash-logo.png',
                              style={'float': 'right', 'height': '28px',
                                     'margin-right': '1%', 'margin-top': '-7px'}
-                         ),
-                         href='https://kostyafarber.github.io/'),
-
-                     html.Img(
-                         src='assets/dash-logo.png',
-                         style={'float': 'right', 'height': '28px',
-                                'margin-right': '1%', 'margin-top': '-7px'}
-                     )
-                     ])
-        ])
-    ]),
-
-    dbc.Row([
-        dbc.Col(html.H5(id='price'), className='pretty_container text-center'),
-        dbc.Col(html.H5(id='bedrooms'), className='pretty_container text-center'),
-        dbc.Col(html.H5(id='bathrooms'), className='pretty_container text-center'),
-        dbc.Col(html.H5(id='carspace'), className='pretty_container text-center')
-    ]),
-
-    dbc.Row([
-        dbc.Col([
-            html.H6(id='header', className='container_title'),
-            dcc.Graph(figure=fig, id='map'),
-        ], className='pretty_container twelve columns')
-    ]),
-
-    dbc.Row([
-        dbc.Col(dcc.Graph(id='bed'), className='pretty_container six columns'),
-
-        dbc.Col(dcc.Graph(id='sell'), className='pretty_container six columns'),
-    ]),
-
-    dbc.Row([
-        dbc.Col(dcc.Graph(id='car'), className='pretty_container six columns'),
-
-        dbc.Col(dcc.Graph(id='bath'), className='pretty_container six columns')
-    ]),
-
-    dbc.Row([
-        dbc.Col([
-            html.H5('Additional Information', className='container_title'),
-            dcc.Markdown('''
+                         )
+                         ])
+            ])
+        ]),
+
+        dbc.Row([
+            dbc.Col(html.H5(id='price'), className='pretty_container text-center'),
+            dbc.Col(html.H5(id='bedrooms'), className='pretty_container text-center'),
+            dbc.Col(html.H5(id='bathrooms'), className='pretty_container text-center'),
+            dbc.Col(html.H5(id='carspace'), className='pretty_container text-center')
+        ]),
+
+        dbc.Row([
+            dbc.Col([
+                dcc.Input(id='price-query', type='number', min=0, step=1000, debounce=True,
+                          placeholder='Compare a price (AUD)', style={'margin-bottom': '10px'}),
+                html.H5(id='percentile')
+            ], className='pretty_container text-center')
+        ]),
+
+        dbc.Row([
+            dbc.Col([
+                html.H6(id='header', className='container_title'),
+                dcc.RadioItems(id='metric', value='sellPrice', inline=True, inputStyle={'margin': '0 5px 0 15px'},
+                               options=[{'label': spec['label'], 'value': metric} for metric, spec in map_metrics.items()]),
+                dcc.Graph(figure=map_figure(data), id='map',
+                          config={'modeBarButtonsToRemove': ['select2d', 'lasso2d']} if clientside_selection else {}),
+                # the detail tier and bounds of the geometry in the map's figure, see update_detail
+                dcc.Store(id='map-detail', data={'version': data.version, 'level': data.detail.level(INITIAL_ZOOM),
+                                                 'bounds': None}),
+            ] + date_controls(data.cube), className='pretty_container twelve columns')
+        ]),
+
+        dbc.Row([
+            dbc.Col(dcc.Graph(id='bed'), className='pretty_container six columns'),
+
+            dbc.Col(dcc.Graph(id='sell'), className='pretty_container six columns'),
+        ]),
+
+        dbc.Row([
+            dbc.Col(dcc.Graph(id='car'), className='pretty_container six columns'),
+
+            dbc.Col(dcc.Graph(id='bath'), className='pretty_container six columns')
+        ]),
+
+        dbc.Row([
+            dbc.Col([
+                dcc.RadioItems(id='period', value='M', inline=True, inputStyle={'margin': '0 5px 0 15px'},
+                               options=[{'label': label, 'value': period}
+                                        for period, (label, _) in trend_periods.items()]),
+                dcc.Graph(id='trend'),
+            ], className='pretty_container twelve columns')
+        ]),
+
+        dbc.Row([
+            dbc.Col([
+                html.H5('Additional Information', className='container_title'),
+                dcc.Markdown('''
                 * Data was obtained from Kaggle [here](https://www.kaggle.com/mihirhalai/sydney-house-prices/activity). Data was scraped from realestate.com from 2010-2019.
                 * For more in-depth analysis see my [Jupyter Notebook](https://nbviewer.jupyter.org/github/kostyafarber/sydneyhouseprices/blob/master/notebooks/sydney_choropleth.ipynb) and the source code on [GitHub](https://github.com/kostyafarber/sydneyhouseprices).
                 * Thank you rapidsai for the great CSS and inspiration for the layout of this dashboard. Check out their GitHub Repo [here](https://github.com/rapidsai/plotly-dash-rapids-census-demo)
                 * Check out the source code for this project on [Github](https://github.com/kostyafarber/sydneyhouseprices-dashboard)
                 * For more about me, visit my blog by clicking on the jigsaw icon in the top right corner of this dashboard!
                 ''')
-        ])
-    ], className='pretty_container')
+            ])
+        ], className='pretty_container')
 
-], fluid=True)
+    ] + ([dcc.Store(id='aggregates', storage_type='local')] if clientside_selection else []), fluid=True)
 
 
-@app.callback(
-    Output('header', 'children'),
-    Input('map', 'clickData')
-)
-def update_header(clickData):
-    if clickData is None:
-        return 'Median House Prices Sydney'
-    else:
-        location = clickData['points'][0]['location']
+app.layout = serve_layout
 
-        return 'Median House Prices Sydney (suburb selected {})'.format(location)
+selection_outputs = [Output('header', 'children'),
+                     Output('price', 'children'),
+                     Output('bedrooms', 'children'),
+                     Output('bathrooms', 'children'),
+                     Output('carspace', 'children')] + \
+                    [Output(spec['graph'], 'figure') for spec in hist_specs.values()]
 
 
-@app.callback([
-    Output('price', 'children'),
-    Output('bedrooms', 'children'),
-    Output('bathrooms', 'children'),
-    Output('carspace', 'children')],
-    [Input('map', 'clickData')]
-)
-def update_info(clickData):
-    if clickData is None:
-        sydney_stats = median_statistics.median().values
+def selected_suburbs(clickData, selectedData):
+    """Names of the suburbs selected on the map, in the order they were picked"""
+    # clicks also select (clickmode 'event+select'), so the selection is the current one when there is any
+    points = (selectedData or {}).get('points') or (clickData or {}).get('points') or []
 
-        output = []
+    return list(dict.fromkeys(point['location'] for point in points if 'location' in point))
 
-        for label, stat in zip(stat_labels, sydney_stats):
-            output.append(label.format(stat))
 
-        return output
+@metrics.timed('callback_duration_seconds', callback='update_selection')
+def update_selection(clickData, selectedData=None, dates=None):
+    """Update the header, stat cards and histograms for the selected suburbs and date range in one round trip
+
+    A click selects one suburb, a lasso or box selection any number of them. Several suburbs are combined by
+    summing their histogram bins and merging their median sketches, so a large selection costs about the same
+    as a single suburb. Over a date range the medians and bins are merged from the monthly cube instead of
+    filtering df.
+    """
+    data = artifacts
+    if data is None:
+        raise PreventUpdate
+    cube = data.cube
+    months = month_range(dates, cube)
+
+    suburbs = selected_suburbs(clickData, selectedData)
+
+    if not suburbs:
+        location, position = None, None
+        header = 'Median House Prices Sydney'
+        if months is None:
+            stats = data.median_statistics[stat_columns].median().values
+        else:
+            stats = [np.nanmedian(cube.suburb_medians(x, *months)) for x in stat_columns]
+
+    elif len(suburbs) == 1:
+        location = suburbs[0]
+        position = data.suburb_index.locate(location)
+        header = 'Median House Prices Sydney (suburb selected {})'.format(location)
+        if months is not None:
+            stats = cube.medians(stat_columns, position, *months)
+        elif position >= 0:
+            stats = data.median_statistics[stat_columns].iloc[position].values
+        else:
+            stats = [float('nan')] * len(stat_labels)
+
+    else:
+        location = '{0} suburbs'.format(len(suburbs))
+        position = data.suburb_index.suburbs.get_indexer(suburbs)
+        header = 'Median House Prices Sydney ({0} suburbs selected)'.format(len(suburbs))
+        stats = cube.medians(stat_columns, position, *(months or (0, cube.n_months - 1)))
+
+    if months is not None:
+        header += ' {0} to {1}'.format(cube.month_label(months[0]), cube.month_label(months[1]))
+
+    output = [header]
+
+    for label, stat in zip(stat_labels, stats):
+        output.append(label.format(stat))
+
+    for x in hist_specs:
+        output.append(plot_hist(data, x, position, location, months))
+
+    return output
+
+
+if clientside_selection:
+    # aggregates are kept in the browser's local storage and only sent again when the data changes
+    @app.callback(Output('aggregates', 'data'),
+                  Input('aggregates', 'modified_timestamp'),
+                  State('aggregates', 'data'))
+    @metrics.timed('callback_duration_seconds', callback='ship_aggregates')
+    def ship_aggregates(modified_timestamp, data):
+        if artifacts is None:
+            raise PreventUpdate
+        aggregates = build_aggregates(artifacts)
+        if data is not None and data.get('version') == aggregates['version']:
+            raise PreventUpdate
+
+        return aggregates
+
+    # assets/clientside.js
+    app.clientside_callback(ClientsideFunction(namespace='selection', function_name='update'),
+                            selection_outputs,
+                            Input('map', 'clickData'),
+                            Input('aggregates', 'data'))
+else:
+    app.callback(selection_outputs, Input('map', 'clickData'), Input('map', 'selectedData'),
+                 Input('dates', 'value'))(update_selection)
+
+
+@app.callback(Output('percentile', 'children'),
+              Input('price-query', 'value'),
+              Input('map', 'clickData'),
+              Input('map', 'selectedData'))
+@metrics.timed('callback_duration_seconds', callback='update_percentile')
+def update_percentile(price, clickData, selectedData):
+    """Rank a price among all sales of the selected suburbs and of Sydney, two binary searches each"""
+    data = artifacts
+    if data is None:
+        raise PreventUpdate
+    if price is None:
+        return 'Enter a price to see how it compares'
+
+    ranks = build_ranks(data)
+    city, _ = ranks.percentile(price)
+    text = 'A price of ${0:,.0f} is above {1:.1f}% of sales in Sydney'.format(price, city)
+
+    suburbs = selected_suburbs(clickData, selectedData)
+    if suburbs:
+        location = suburbs[0] if len(suburbs) == 1 else '{0} suburbs'.format(len(suburbs))
+        rank, sales = ranks.percentile(price, data.suburb_index.suburbs.get_indexer(suburbs))
+        if sales:
+            text = 'A price of ${0:,.0f} is above {1:.1f}% of sales in {2} and {3:.1f}% in Sydney'.format(
+                price, rank, location, city)
+        else:
+            text += ', there are no sales in {0}'.format(location)
+
+    return text
+
+
+@app.callback(Output('trend', 'figure'),
+              [Input('map', 'clickData'), Input('map', 'selectedData'), Input('period', 'value')] +
+              ([] if clientside_selection else [Input('dates', 'value')]))
+@metrics.timed('callback_duration_seconds', callback='update_trend')
+def update_trend(clickData, selectedData, period, dates=None):
+    """Plot the median selling price per month or quarter of the selected suburbs over the date range"""
+    data = artifacts
+    if data is None:
+        raise PreventUpdate
+    months = month_range(dates, data.cube)
+
+    suburbs = selected_suburbs(clickData, selectedData)
+    if not suburbs:
+        location, position = None, None
+    elif len(suburbs) == 1:
+        location, position = suburbs[0], data.suburb_index.locate(suburbs[0])
     else:
+        location = '{0} suburbs'.format(len(suburbs))
+        position = data.suburb_index.suburbs.get_indexer(suburbs)
 
-        location = clickData['points'][0]['location']
-        stats_location = median_statistics[median_statistics.index == location].median().values
+    return plot_trend(data, position, period, location, months)
 
-        output = []
 
-        for label, stat in zip(stat_labels, stats_location):
-            output.append(label.format(stat))
+@app.callback(Output('map', 'figure'),
+              [Input('metric', 'value')] + ([] if clientside_selection else [Input('dates', 'value')]),
+              prevent_initial_call=True)
+@metrics.timed('callback_duration_seconds', callback='update_metric')
+def update_metric(metric, dates=None):
+    """Recolour the map by the median of a metric over a date range
 
-        return output
+    Only the colours and colour axis are sent, not the geometry.
+    """
+    data = artifacts
+    if data is None:
+        raise PreventUpdate
+    spec = map_metrics[metric]
+    months = month_range(dates, data.cube)
+    if months is None:
+        z = data.geo_house_prices[metric]
+    else:
+        z = pd.Series(data.cube.suburb_medians(metric, *months)[data.map_positions], index=data.map_suburbs)
+    cmin, cmax = spec['range'] or (z.min(), z.max())
 
+    figure = Patch()
+    figure['data'][0]['z'] = z.tolist()
+    figure['data'][0]['hovertemplate'] = 'Suburb=%{{location}}<br>{0}=%{{z}}<extra></extra>'.format(spec['label'])
+    figure['layout']['coloraxis']['cmin'] = cmin
+    figure['layout']['coloraxis']['cmax'] = cmax
+    figure['layout']['coloraxis']['colorbar']['title']['text'] = spec['colorbar']
 
-@app.callback(
-    Output('bed', 'figure'),
-    Input('map', 'clickData'))
-def update_histogram(clickData):
-    if clickData is None:
-        bed = plot_hist('bed', df, 'Number of Beds', [0, 10], 'Number of Beds Histogram')
+    return figure
 
-        return bed
 
-    else:
-        location = clickData['points'][0]['location']
-        dff = df[df['suburb'] == location]
-        bed = plot_hist('bed', dff, 'Number of Beds', [0, 10], 'Number of Beds Histogram in {0}'.format(location))
+@app.callback(Output('map', 'figure', allow_duplicate=True),
+              Output('map-detail', 'data'),
+              Input('map', 'relayoutData'),
+              State('map-detail', 'data'),
+              prevent_initial_call=True)
+@metrics.timed('callback_duration_seconds', callback='update_detail')
+def update_detail(relayoutData, shown):
+    """Swap the map's geometry for the detail tier of its zoom, only the suburbs around the viewport when zoomed in
+
+    Pans within the bounds already sent and zooms within the same tier send nothing (see map_detail.py).
+    """
+    data = artifacts
+    if data is None or not relayoutData:
+        raise PreventUpdate
 
-        return bed
+    view = data.detail.view(relayoutData)
+    if view is None:
+        raise PreventUpdate
+    level, bounds = view
+    current = {'version': data.version, 'level': level, 'bounds': list(bounds) if bounds is not None else None}
+    if current == shown:
+        raise PreventUpdate
 
+    figure = Patch()
+    figure['data'][0]['geojson'] = data.detail.geojson(level, bounds)
 
-@app.callback(
-    Output('bath', 'figure'),
-    Input('map', 'clickData'))
-def update_histogram(clickData):
-    if clickData is None:
-        bath = plot_hist('bath', df, 'Number of Baths', [0, 10], 'Number of Baths Histogram')
+    return figure, current
 
-        return bath
 
-    else:
+if background_loading:
+    @app.callback(Output('loading-status', 'children'),
+                  Output('loading-ready', 'data'),
+                  Input('loading-poll', 'n_intervals'))
+    def poll_loading(n_intervals):
+        """Progress shown on the loading page, ready is set once the dashboard can be served"""
+        status = loading_status()
+        if status['error']:
+            return 'Loading the data failed ({0})'.format(status['error']), False
+        if status['ready']:
+            return 'Ready', True
 
-        location = clickData['points'][0]['location']
-        dff = df[df['suburb'] == clickData['points'][0]['location']]
+        return 'Loading the data ({0}, {1:.0f}s)...'.format(status['step'] or 'starting', status['seconds']), False
 
-        bath = plot_hist('bath', dff, 'Number of Baths', [0, 10],
-                         'Number of Bathrooms Histogram in {0}'.format(location))
+    # assets/clientside.js reloads the page, which is then the dashboard
+    app.clientside_callback(ClientsideFunction(namespace='loading', function_name='reload'),
+                            Output('loading-poll', 'disabled'),
+                            Input('loading-ready', 'data'))
 
-        return bath
 
+# JSON API
+# ---------------------------------------------------------------------------------------------------------------------
+# points per lookup request and suburbs per stats request
+MAX_POINTS = 100000
+MAX_SUBURBS = 10000
 
-@app.callback(
-    Output('car', 'figure'),
-    Input('map', 'clickData'))
-def update_histogram(clickData):
-    if clickData is None:
-        car = plot_hist('car', df, 'Number of Cars', [0, 10], 'Number of Cars Histogram')
 
-        return car
+def api_month(value, cube):
+    """Month position of a date like 2015-01, ValueError when it isn't one or is outside the cube's months"""
+    date = datetime.datetime.strptime(value, '%Y-%m')
+    position = date.year * 12 + date.month - 1 - cube.first_month
+    if not 0 <= position < cube.n_months:
+        raise ValueError('{0} is outside the months covered'.format(value))
 
-    else:
+    return position
 
-        location = clickData['points'][0]['location']
-        dff = df[df['suburb'] == clickData['points'][0]['location']]
 
-        car = plot_hist('car', dff, 'Number of Cars', [0, 10], 'Number of Cars Histogram in {0}'.format(location))
+def api_month_label(position, cube):
+    """Month position written as api_month reads it, e.g. 2015-01"""
+    year, month = divmod(cube.first_month + int(position), 12)
 
-        return car
+    return '{0}-{1:02d}'.format(year, month + 1)
 
 
-@app.callback(
-    Output('sell', 'figure'),
-    Input('map', 'clickData'))
-def update_histogram(clickData):
-    if clickData is None:
-        sell = plot_hist('sellPrice', df, 'Selling Price in Millions (AUD)', [0, 2500000], 'Number of Baths Histogram')
+def api_flag(value):
+    """Boolean of a JSON true/false or a query string true/false/1/0, ValueError for anything else"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', '1', 'false', '0'):
+        return value.lower() in ('true', '1')
 
-        return sell
+    raise ValueError('{0!r} is not true or false'.format(value))
 
+
+@server.route('/api/suburbs/locate', methods=['GET', 'POST'])
+def locate_suburbs():
+    """Suburb and median stats of a batch of points
+
+    POST a JSON object {"lat": [...], "lon": [...]}, or GET ?lat=...&lon=... for one point. Points outside every
+    suburb are matched to the nearest one unless "nearest" is false, optionally only within "max_distance"
+    metres. The response has one list per field, in the order of the points: suburb, distance in metres (0
+    inside the suburb) and the suburb's medians, null where nothing matched.
+    """
+    params = request.get_json(silent=True) if request.method == 'POST' else request.args.to_dict()
+    if not isinstance(params, dict):
+        return jsonify(error='expected a JSON object'), 400
+    try:
+        # a single point from the query string is a list of one
+        lat = np.atleast_1d(np.asarray(params['lat'], dtype='float64'))
+        lon = np.atleast_1d(np.asarray(params['lon'], dtype='float64'))
+        nearest = str(params.get('nearest', True)).lower() not in ('false', '0')
+        max_distance = float(params['max_distance']) if params.get('max_distance') is not None else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify(error='expected lat and lon lists of numbers'), 400
+
+    if lat.ndim != 1 or lon.ndim != 1:
+        return jsonify(error='expected lat and lon lists of numbers, not nested lists'), 400
+    if len(lat) != len(lon):
+        return jsonify(error='lat and lon have different lengths'), 400
+    if len(lat) > MAX_POINTS:
+        return jsonify(error='at most {0} points per request'.format(MAX_POINTS)), 413
+
+    data = artifacts
+    if data is None:
+        return jsonify(error='the data is still loading'), 503, {'Retry-After': '5'}
+    positions, distances = suburb_locator.locate(lat, lon, nearest, max_distance)
+    suburbs = suburb_locator.names(positions)
+
+    # suburbs without sales have no medians
+    rows = data.suburb_index.suburbs.get_indexer(suburbs)
+    medians = np.where(rows[:, None] >= 0, data.suburb_medians[np.maximum(rows, 0)], np.nan)
+
+    response = {'suburb': suburbs.tolist(), 'distance': json_values(distances), 'version': data.version}
+    for i, column in enumerate(data.median_statistics.columns):
+        response[column] = json_values(medians[:, i])
+
+    return jsonify(response)
+
+
+@server.route('/api/stats', methods=['GET', 'POST'])
+def suburb_stats():
+    """Medians, sale counts and histogram bins of many suburbs in one request
+
+    POST a JSON object {"suburbs": [...], "metrics": [...], "start": "2015-01", "end": "2018-12", "histograms": true},
+    or GET ?suburb=...&suburb=...&metric=...&start=...&end=...&histograms=0. Metrics default to all of them, the
+    date range to every month and histograms to true. Every suburb is looked up at once against the monthly cube, so
+    the cost hardly depends on how many are asked for.
+
+    Medians over every month are the exact ones, over a date range they come from the quantile sketches. Counts are
+    the sales with a value for the metric. Responses carry an ETag of the data version and the query, so clients
+    and proxies can revalidate GETs with If-None-Match.
+    """
+    if request.method == 'POST':
+        params = request.get_json(silent=True)
+        if not isinstance(params, dict):
+            return jsonify(error='expected a JSON object'), 400
     else:
-        location = clickData['points'][0]['location']
-        dff = df[df['suburb'] == clickData['points'][0]['location']]
+        params = {'suburbs': request.args.getlist('suburb'), 'metrics': request.args.getlist('metric') or None,
+                  'start': request.args.get('start'), 'end': request.args.get('end'),
+                  'histograms': request.args.get('histograms')}
+
+    data = artifacts
+    if data is None:
+        return jsonify(error='the data is still loading'), 503, {'Retry-After': '5'}
+    cube = data.cube
+    suburbs = params.get('suburbs')
+    columns = params.get('metrics') or list(sketch_specs)
+    if not isinstance(suburbs, list) or not isinstance(columns, list) or \
+            not all(isinstance(name, str) for name in suburbs + columns):
+        return jsonify(error='expected a list of suburbs and optionally a list of metrics'), 400
+    if len(suburbs) > MAX_SUBURBS:
+        return jsonify(error='at most {0} suburbs per request'.format(MAX_SUBURBS)), 413
+    unknown = [column for column in columns if column not in sketch_specs]
+    if unknown:
+        return jsonify(error='unknown metrics {0}, expected some of {1}'.format(unknown, list(sketch_specs))), 400
+
+    try:
+        dates = [api_month(params[key], cube) if params.get(key) is not None else default
+                 for key, default in (('start', 0), ('end', cube.n_months - 1))]
+    except (TypeError, ValueError):
+        return jsonify(error='start and end should be months like 2015-01 from {0} to {1}'.format(
+            api_month_label(0, cube), api_month_label(cube.n_months - 1, cube))), 400
+    if dates[0] > dates[1]:
+        return jsonify(error='start is after end'), 400
+    try:
+        histograms = api_flag(params['histograms']) if params.get('histograms') is not None else True
+    except ValueError:
+        return jsonify(error='histograms should be true or false'), 400
+    months = month_range(dates, cube)
+    start, stop = months or (0, cube.n_months - 1)
+
+    query = json.dumps([data.version, suburbs, columns, start, stop, histograms])
+    etag = hashlib.sha1(query.encode()).hexdigest()
+    # only reads are conditional, a POST with a matching If-None-Match still gets the stats
+    if request.method in ('GET', 'HEAD') and etag in request.if_none_match:
+        response = server.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    positions = data.suburb_index.suburbs.get_indexer(suburbs)
+    result = {'version': data.version, 'suburbs': suburbs, 'found': (positions >= 0).tolist(),
+              'start': cube.month_label(start), 'end': cube.month_label(stop), 'metrics': {}}
+
+    for column in columns:
+        sketches = cube.suburb_totals(cube.sketches[column], start, stop, positions)
+        if months is None and column in data.median_statistics.columns:
+            medians = data.suburb_medians[:, data.median_statistics.columns.get_loc(column)][np.maximum(positions, 0)]
+            medians = np.where(positions >= 0, medians, np.nan)
+        else:
+            medians = median(sketches, sketch_specs[column])
+
+        stats = {'median': json_values(medians), 'count': sketches.sum(axis=1).tolist()}
+        if histograms:
+            stats['edges'] = cube.edges[column].tolist()
+            stats['bins'] = cube.suburb_totals(cube.bins[column], start, stop, positions).tolist()
+        result['metrics'][column] = stats
+
+    response = jsonify(result)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+
+def data_version():
+    """Version of the data being served, 'loading' until there is some"""
+    return artifacts.version if artifacts is not None else 'loading'
+
+
+def cache_tiers():
+    """Tiers of the response cache, from the environment
+
+    RESPONSE_CACHE_MB bounds the responses each process keeps (default 64), RESPONSE_CACHE_TTL expires them after
+    that many seconds (default a day, 0 never). RESPONSE_CACHE_DB=<file> also shares them between the workers of
+    a machine through SQLite, bounded by RESPONSE_CACHE_SHARED_MB (default 512). With SHARED_ARTIFACTS=1 the
+    shared tier is on in data/cache unless RESPONSE_CACHE_DB is set to an empty string.
+    """
+    ttl = float(os.getenv('RESPONSE_CACHE_TTL', 24 * 3600))
+    tiers = [MemoryTier(float(os.getenv('RESPONSE_CACHE_MB', 64)) * 2 ** 20, ttl)]
+
+    path = os.getenv('RESPONSE_CACHE_DB', SHARED_DB if os.getenv('SHARED_ARTIFACTS') else '')
+    if path:
+        # responses rendered by another version of the code are never shared
+        namespace = source_version(os.path.dirname(os.path.abspath(__file__)))
+        tiers.append(SharedTier(path, float(os.getenv('RESPONSE_CACHE_SHARED_MB', 512)) * 2 ** 20, ttl, namespace))
+
+    return tiers
+
+
+def selection_key(clickData, selectedData, *values):
+    """What a response to a map selection depends on: the suburbs it resolves to and the callback's other inputs,
+    not where the click landed or the lasso path"""
+    return [selected_suburbs(clickData, selectedData)] + list(values)
+
+
+# the layout and callback responses are serialized and compressed once, then served with ETags
+# responses are kept per data version so ingested sales are never answered from before they arrived
+response_cache = ResponseCache(server, outputs=[selection_outputs, Output('map', 'figure'), Output('trend', 'figure')],
+                               version=data_version, tiers=cache_tiers(),
+                               keys={callback_id(selection_outputs): selection_key,
+                                     callback_id(Output('trend', 'figure')): selection_key})
+
+
+@metrics.collect
+def response_cache_samples():
+    samples = [('response_cache_misses_total', {}, response_cache.misses)]
+    for tier in response_cache.tiers:
+        samples += [('response_cache_hits_total', {'tier': tier.name}, response_cache.hits[tier.name]),
+                    ('response_cache_bytes', {'tier': tier.name}, tier.bytes)]
+
+    return samples
+
+
+# Startup
+# ---------------------------------------------------------------------------------------------------------------------
+def load_data():
+    """Load or build the artifacts and everything derived from them, then hand them to the callbacks"""
+    global artifacts, suburb_locator
+
+    loading_state.update(step='artifacts', started=time.time(), error=None)
+    try:
+        # SHARED_ARTIFACTS=1 (set in gunicorn.conf.py) builds everything once to data/artifacts and memory-maps it in
+        # every worker instead of each worker building its own copy, or attaches to a version built by pipeline.py
+        with metrics.time('startup_phase_seconds', phase='artifacts'):
+            if os.getenv('SHARED_ARTIFACTS'):
+                data, _ = dashboard_artifacts(metrics, chunk_rows, build_workers)
+            else:
+                data = build_artifacts(metrics, chunk_rows, build_workers, version=input_version(chunk_rows))
+
+        # every suburb polygon, with or without sales, for point lookups
+        loading_state['step'] = 'spatial_index'
+        with metrics.time('startup_phase_seconds', phase='spatial_index'):
+            locator = SuburbLocator.from_frame(load_boundaries(metrics))
+
+        # suburb x period rollups of the price trend
+        loading_state['step'] = 'trends'
+        with metrics.time('startup_phase_seconds', phase='trends'):
+            build_trends(data)
+
+        # price CDFs of the percentile lookup
+        loading_state['step'] = 'ranks'
+        with metrics.time('startup_phase_seconds', phase='ranks'):
+            build_ranks(data)
+
+        if clientside_selection:
+            loading_state['step'] = 'aggregates'
+            build_aggregates(data)
+    except Exception as e:
+        loading_state['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        raise
+
+    suburb_locator = locator
+    artifacts = data
+    data_ready.set()
+    report_memory(data, locator)
+
+    # the first visitor's page is served from the response cache
+    loading_state['step'] = 'warm'
+    response_cache.warm(server)
+    loading_state.update(step=None, finished=time.time())
+
+
+def loading_status():
+    """Progress of loading the data, for the probes and the loading page"""
+    started, finished = loading_state['started'], loading_state['finished']
+    phases = {dict(labels)['phase']: round(seconds, 3)
+              for labels, seconds in metrics.samples('startup_phase_seconds').items()}
+
+    return {'ready': data_ready.is_set(), 'step': loading_state['step'], 'error': loading_state['error'],
+            'seconds': round((finished or time.time()) - started, 3) if started else 0.0, 'phases': phases,
+            'version': artifacts.version if artifacts is not None else None}
+
+
+@server.route('/healthz')
+def healthz():
+    """Liveness, fails only when loading the data failed"""
+    status = loading_status()
+
+    return jsonify(status), 500 if status['error'] else 200
+
+
+@server.route('/readyz')
+def readyz():
+    """Readiness, 503 until the data is loaded"""
+    status = loading_status()
+
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+loader = None
+
+
+def start_loading():
+    """Load the data on a thread when BACKGROUND_LOADING=1, called once per serving process"""
+    global loader
+
+    if background_loading and loader is None:
+        loader = threading.Thread(target=load_data, name='load-data', daemon=True)
+        loader.start()
+
 
-        sell = plot_hist('sellPrice', dff, 'Selling Price in Millions (AUD)', [0, 2500000],
-                         'Selling Property Price Histogram '
-                         'in {0}'.format(location))
-        return sell
+if not background_loading:
+    load_data()
 
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    start_loading()
+    start_ingest()
+    app.run(debug=True)
@@ -0,0 +1,277 @@
+"""Read-only data artifacts shared by every gunicorn worker
+
+Everything derived from the sales data and the suburb boundaries (sales sorted by suburb, the median
+table, the suburbs on the map, per-suburb histogram bins, the serialized map figure and its geometry
+detail tiers) is written once to a versioned directory under data/artifacts. Workers memory-map the
+arrays from there, so the operating system keeps one copy in its page cache however many workers attach.
+
+The first process to start builds the artifacts while holding a file lock, the others wait and attach.
+Versions can also be built ahead of time on a bigger machine, see pipeline.py.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+from cube import MonthlyCube
+from datastore import read_store, write_store
+from geodata import pack_coordinates, sha256
+from histograms import HistogramCache
+from map_detail import MapDetail
+from suburb_index import SuburbIndex
+
+ARTIFACTS_DIR = os.path.join('data', 'artifacts')
+HASHES = '.hashes.json'
+
+# bump when the layout of the artifacts changes
+ARTIFACTS_VERSION = 9
+
+
+def pack_figure(figure):
+    """A figure dict whose map traces' GeoJSON coordinates are packed, see pack_coordinates"""
+    data = []
+    for trace in figure.get('data', []):
+        geojson = trace.get('geojson')
+        if isinstance(geojson, dict) and 'features' in geojson:
+            features = [dict(feature, geometry=dict(feature['geometry'],
+                                                    coordinates=pack_coordinates(feature['geometry']['coordinates'])))
+                        if feature.get('geometry') else feature for feature in geojson['features']]
+            trace = dict(trace, geojson=dict(geojson, features=features))
+        data.append(trace)
+
+    return dict(figure, data=data)
+
+
+class Artifacts:
+    """Everything the dashboard derives from its input data
+
+    Artifacts are never modified once built, new data produces new Artifacts that replace them as a whole.
+    """
+
+    def __init__(self, suburb_index, median_statistics, map_suburbs, histogram_cache, cube, figure, detail,
+                 version='0'):
+        """
+        :param suburb_index: SuburbIndex over the sales
+        :param median_statistics: per-suburb medians indexed by suburb
+        :param map_suburbs: suburbs drawn on the map, in the order of the figure's locations
+        :param histogram_cache: HistogramCache in suburb_index order
+        :param cube: MonthlyCube in suburb_index order
+        :param figure: the choropleth map, a plotly figure or its dict
+        :param detail: MapDetail of the suburbs on the map
+        :param version: data version, changes whenever new data is added
+        """
+        self.suburb_index = suburb_index
+        self.histogram_cache = histogram_cache
+        self.cube = cube
+        self.detail = detail
+        self.figure = pack_figure(figure.to_plotly_json() if hasattr(figure, 'to_plotly_json') else figure)
+        self.version = version
+
+        # medians are held once, as a float array aligned to the suburb_index positions that median_statistics
+        # is a view of, and every suburb name is the index's own string (the one dictionary of suburbs)
+        suburbs = suburb_index.suburbs.rename(median_statistics.index.name)
+        if not median_statistics.index.equals(suburbs):
+            median_statistics = median_statistics.reindex(suburbs)
+        self.suburb_medians = np.asarray(median_statistics.values, dtype='float64')
+        self.median_statistics = pd.DataFrame(self.suburb_medians, index=suburbs, columns=median_statistics.columns,
+                                              copy=False)
+
+        self.map_positions = suburbs.get_indexer(map_suburbs)
+        self.map_suburbs = suburbs[self.map_positions]
+
+        # anything else the app derives from these, e.g. the clientside aggregate table
+        self.extras = {}
+
+    @property
+    def df(self):
+        """The sales, sorted by suburb"""
+        return self.suburb_index.rows
+
+    @property
+    def geo_house_prices(self):
+        """Medians of the suburbs on the map indexed by suburb, in the map's order
+
+        The polygons are only kept in the map figure and its detail tiers.
+        """
+        return pd.DataFrame(self.suburb_medians[self.map_positions], index=self.map_suburbs,
+                            columns=self.median_statistics.columns)
+
+
+def content_hashes(files, root=ARTIFACTS_DIR):
+    """sha256 of every file
+
+    Digests are remembered in root/.hashes.json with the size and modification time they were taken at, so
+    unchanged files are not read again on every start.
+
+    :param files: list of file paths
+    :param root: directory holding every artifact version
+    :return: dict of path -> hex digest
+    """
+    path = os.path.join(root, HASHES)
+    try:
+        with open(path) as f:
+            known = json.load(f)
+    except (OSError, ValueError):
+        known = {}
+
+    hashes = {}
+    for name in files:
+        stat = os.stat(name)
+        size, mtime_ns, digest = known.get(name, (None, None, None))
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            digest = sha256(name)
+        hashes[name] = digest
+        known[name] = (stat.st_size, stat.st_mtime_ns, digest)
+
+    os.makedirs(root, exist_ok=True)
+    tmp = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(known, f)
+    os.replace(tmp, path)
+
+    return hashes
+
+
+def artifacts_key(sources, settings, root=ARTIFACTS_DIR):
+    """Version of the artifacts built from the given inputs
+
+    Files are compared by content, so touching or copying an input doesn't change the version.
+
+    :param sources: list of input files or directories, missing ones are skipped
+    :param settings: anything else the artifacts depend on (JSON serializable)
+    :param root: directory holding every artifact version, where file digests are remembered
+    :return: hex digest
+    """
+    files = []
+    for path in sources:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)))
+        elif os.path.exists(path):
+            files.append(path)
+
+    digest = hashlib.sha256(json.dumps([ARTIFACTS_VERSION, settings], sort_keys=True).encode())
+    for name, content in content_hashes(files, root).items():
+        digest.update('{0}:{1}'.format(name, content).encode())
+
+    return digest.hexdigest()[:16]
+
+
+def find_artifacts(root, name, key):
+    """An existing artifact version built from the same inputs for one part of the build
+
+    :param root: directory holding every artifact version
+    :param name: part of the build, a key of the inputs given to shared_artifacts
+    :param key: version of that part's inputs
+    :return: artifact directory, or None
+    """
+    if not os.path.isdir(root):
+        return None
+
+    for version in sorted(os.listdir(root)):
+        manifest = os.path.join(root, version, 'manifest.json')
+        if version.startswith('.') or '.tmp' in version or not os.path.exists(manifest):
+            continue
+        with open(manifest) as f:
+            if json.load(f).get('inputs', {}).get(name) == key:
+                return os.path.join(root, version)
+
+    return None
+
+
+def save_artifacts(artifacts, path, inputs=None):
+    """Write artifacts to a directory
+
+    :param artifacts: Artifacts
+    :param path: directory to write
+    :param inputs: dict of part of the build -> version of its inputs, recorded for find_artifacts
+    """
+    index = artifacts.suburb_index
+    os.makedirs(os.path.join(path, 'hist'))
+
+    write_store(index.rows, os.path.join(path, 'rows'))
+
+    np.save(os.path.join(path, 'medians.npy'), artifacts.suburb_medians)
+
+    for column, counts in artifacts.histogram_cache.counts.items():
+        np.save(os.path.join(path, 'hist', column + '.edges.npy'), artifacts.histogram_cache.edges[column])
+        np.save(os.path.join(path, 'hist', column + '.counts.npy'), counts)
+
+    artifacts.cube.save(os.path.join(path, 'cube'))
+    artifacts.detail.save(path)
+
+    with open(os.path.join(path, 'map_figure.json'), 'w') as f:
+        json.dump(artifacts.figure, f, cls=PlotlyJSONEncoder)
+
+    manifest = {'suburbs': list(index.suburbs), 'medians': list(artifacts.median_statistics.columns),
+                'map_suburbs': list(artifacts.map_suburbs),
+                'hist': list(artifacts.histogram_cache.counts), 'inputs': inputs or {}}
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+
+def load_artifacts(path, mappings):
+    """Attach to artifacts written by save_artifacts, arrays are memory-mapped read-only
+
+    :param path: artifact directory
+    :param mappings: dict of column -> sketch mapping the cube was built with
+    :return: Artifacts with the map figure as a dict
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    suburb_index = SuburbIndex(read_store(os.path.join(path, 'rows')))
+
+    medians = np.load(os.path.join(path, 'medians.npy'), mmap_mode='r')
+    median_statistics = pd.DataFrame(medians, index=pd.Index(manifest['suburbs'], name='suburb'),
+                                     columns=manifest['medians'], copy=False)
+
+    edges = {}
+    counts = {}
+    for column in manifest['hist']:
+        edges[column] = np.load(os.path.join(path, 'hist', column + '.edges.npy'))
+        counts[column] = np.load(os.path.join(path, 'hist', column + '.counts.npy'), mmap_mode='r')
+
+    cube = MonthlyCube.load(os.path.join(path, 'cube'), mappings)
+
+    with open(os.path.join(path, 'map_figure.json')) as f:
+        figure = json.load(f)
+
+    return Artifacts(suburb_index, median_statistics, manifest['map_suburbs'], HistogramCache(edges, counts), cube,
+                     figure, MapDetail.load(path), version=os.path.basename(path))
+
+
+def shared_artifacts(build, key, mappings, root=ARTIFACTS_DIR, inputs=None):
+    """Attach to the artifacts of a version, building them first if no process has yet
+
+    :param build: function returning Artifacts, only called by the process that builds them
+    :param key: artifact version from artifacts_key
+    :param mappings: dict of column -> sketch mapping of the cube
+    :param root: directory holding every artifact version
+    :param inputs: dict of part of the build -> version of its inputs, see find_artifacts
+    :return: Artifacts loaded from disk
+    """
+    path = os.path.join(root, key)
+    os.makedirs(root, exist_ok=True)
+
+    with open(os.path.join(root, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                tmp = '{0}.tmp{1}'.format(path, os.getpid())
+                shutil.rmtree(tmp, ignore_errors=True)
+                save_artifacts(build(), tmp, inputs)
+                os.rename(tmp, path)
+
+                # older versions are unlinked, workers still mapping them keep their pages
+                for name in os.listdir(root):
+                    if name != key and not name.startswith('.'):
+                        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return load_artifacts(path, mappings)
@@ -0,0 +1,56 @@
+// Clientside map selection, used when the app runs with CLIENTSIDE_SELECTION=1.
+// Mirrors update_selection in app.py for one clicked suburb using the aggregate table shipped to the 'aggregates'
+// store. Selections of several suburbs are turned off in this mode (see map_figure in app.py).
+// The loading page (BACKGROUND_LOADING=1) reloads itself once the data is ready.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    selection: {
+        update: function (clickData, aggregates) {
+            if (!aggregates) {
+                return window.dash_clientside.no_update;
+            }
+
+            var location = null;
+            var position = -1;
+            var header = 'Median House Prices Sydney';
+            var stats = aggregates.city;
+
+            if (clickData) {
+                location = clickData.points[0].location;
+                position = aggregates.suburbs.indexOf(location);
+                header = 'Median House Prices Sydney (suburb selected ' + location + ')';
+                stats = position >= 0 ? aggregates.medians[position] : aggregates.labels.map(function () {
+                    return null;
+                });
+            }
+
+            var output = [header];
+
+            aggregates.labels.forEach(function (label, i) {
+                var stat = stats[i] === null ? 'nan' : stats[i].toFixed(2);
+                output.push(label.replace('{:.2f}', stat));
+            });
+
+            aggregates.hist.forEach(function (hist) {
+                var figure = JSON.parse(JSON.stringify(hist.figure));
+
+                if (location !== null) {
+                    figure.data[0].y = position >= 0 ? hist.counts[position] : hist.counts[0].map(function () {
+                        return 0;
+                    });
+                    figure.layout.title.text = hist.title + ' in ' + location;
+                }
+                output.push(figure);
+            });
+
+            return output;
+        }
+    },
+    loading: {
+        reload: function (ready) {
+            if (ready) {
+                window.location.reload();
+            }
+            return Boolean(ready);
+        }
+    }
+});
@@ -0,0 +1,375 @@
+"""Callback latency and payload benchmark
+
+Runs the dashboard in-process against a synthetic prices_data.csv and suburb GeoJSON, replays a trace
+of map clicks, date ranges and metric switches through the Flask test client and reports latency
+percentiles and response bytes per callback, cold start time and the memory of every worker:
+
+    $ python benchmark.py --workers 2 --clicks 500 --json results.json
+
+A trace is a JSON list of events, either {"callback": "selection", "clickData": ..., "selectedData": ...,
+"dates": ...} or {"callback": "metric", "metric": ..., "dates": ...}, where clickData and selectedData are
+what Dash sends for map clicks and lasso selections (null for none) and dates is the [start, stop] month
+positions of the slider (null for all).
+Save the generated trace with --record and replay the same one later with --trace.
+
+Environment variables such as SHARED_ARTIFACTS=1 are passed on to the workers, so every serving mode
+can be measured the same way.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from geodata import GEOJSON_CACHE, SUBURB_PROPERTY, sha256
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PRICES_CSV = os.path.join('data', 'prices_data.csv')
+FIXTURE_SETTINGS = os.path.join('data', 'benchmark.json')
+
+METRICS = ['sellPrice', 'bed', 'bath', 'car']
+
+# Sydney's centre, suburbs are laid out on a grid of circles around it
+CENTER = (151.2099, -33.8651)
+SPACING = 0.02
+
+
+# Fixtures
+# ---------------------------------------------------------------------------------------------------------------------
+def suburb_names(n_suburbs):
+    """Names of the synthetic suburbs as the dashboard shows them"""
+    return ['Suburb {0:04d}'.format(i) for i in range(n_suburbs)]
+
+
+def generate_suburbs(path, n_suburbs, vertices=200):
+    """Write a GeoJSON of round suburbs with its sha256 checksum, like `geodata.py --refresh` does
+
+    :param path: GeoJSON file to write
+    :param n_suburbs: number of suburbs
+    :param vertices: points per polygon, the real boundaries have a few hundred
+    """
+    side = int(np.ceil(np.sqrt(n_suburbs)))
+    angles = np.linspace(0, 2 * np.pi, vertices)
+    features = []
+
+    for i, name in enumerate(suburb_names(n_suburbs)):
+        row, col = divmod(i, side)
+        x = CENTER[0] + (col - side / 2) * SPACING
+        y = CENTER[1] + (row - side / 2) * SPACING
+        ring = np.column_stack([x + 0.49 * SPACING * np.cos(angles), y + 0.49 * SPACING * np.sin(angles)])
+        ring[-1] = ring[0]
+        features.append({'type': 'Feature', 'properties': {SUBURB_PROPERTY: name.upper()},
+                         'geometry': {'type': 'Polygon', 'coordinates': [np.round(ring, 6).tolist()]}})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    with open(path + '.sha256', 'w') as f:
+        f.write(sha256(path))
+
+
+def generate_prices(path, n_sales, n_suburbs, years=10, seed=0):
+    """Write a prices_data.csv of random sales
+
+    Suburb popularity follows a Zipf-like curve and 1% of sales are in a suburb without a polygon, as in the
+    real data.
+
+    :param path: CSV file to write
+    :param n_sales: number of sales
+    :param n_suburbs: number of suburbs
+    :param years: years of sales, ending in 2019
+    :param seed: random seed
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array(suburb_names(n_suburbs) + ['Unmapped'])
+
+    popularity = 1 / np.arange(1, n_suburbs + 1) ** 0.8
+    popularity = np.append(0.99 * popularity / popularity.sum(), 0.01)
+    suburb = rng.choice(len(names), n_sales, p=popularity)
+
+    # pricier suburbs have bigger houses
+    level = rng.normal(0, 0.4, len(names))[suburb]
+    bed = np.clip(np.round(rng.normal(3 + 2 * level, 1)), 1, 9)
+    df = pd.DataFrame({
+        'Date': pd.Timestamp(2020 - years, 1, 1) + pd.to_timedelta(rng.integers(0, 365 * years, n_sales), unit='D'),
+        'suburb': names[suburb],
+        'postalCode': 2000 + suburb % 800,
+        'sellPrice': np.round(rng.lognormal(13.7 + level + 0.1 * bed, 0.4), -3),
+        'bed': bed,
+        'bath': np.clip(np.round(bed / 2 + rng.normal(0, 0.5, n_sales)), 1, 6),
+        'car': np.where(rng.random(n_sales) < 0.05, np.nan, np.clip(np.round(rng.normal(1.5, 1, n_sales)), 0, 6)),
+    })
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.sort_values('Date').to_csv(path, index=False)
+
+
+def prepare(workdir, n_sales, n_suburbs, seed=0):
+    """Generate the fixtures in workdir/data unless they were already generated with the same settings"""
+    settings = {'sales': n_sales, 'suburbs': n_suburbs, 'seed': seed}
+    previous = os.path.join(workdir, FIXTURE_SETTINGS)
+    if os.path.exists(previous):
+        with open(previous) as f:
+            if json.load(f) == settings:
+                return
+
+    # anything derived from older fixtures is rebuilt by the app
+    shutil.rmtree(os.path.join(workdir, 'data'), ignore_errors=True)
+    generate_suburbs(os.path.join(workdir, GEOJSON_CACHE), n_suburbs)
+    generate_prices(os.path.join(workdir, PRICES_CSV), n_sales, n_suburbs, seed=seed)
+
+    with open(previous, 'w') as f:
+        json.dump(settings, f)
+
+
+# Traces
+# ---------------------------------------------------------------------------------------------------------------------
+def click(*locations):
+    """clickData of a click on a suburb of the map, or selectedData of a selection of suburbs"""
+    return {'points': [{'curveNumber': 0, 'pointNumber': 0, 'pointIndex': 0, 'location': location}
+                       for location in locations]}
+
+
+def make_trace(n_suburbs, n_clicks, n_months, seed=0):
+    """A session of clicks on suburbs, most of them popular ones
+
+    One event in ten narrows the date range, one in twenty switches the map metric, one in twenty clears
+    the selection and one in twenty lassos a block of up to 200 neighbouring suburbs.
+
+    :param n_suburbs: number of suburbs in the fixture
+    :param n_clicks: number of events
+    :param n_months: months on the date slider
+    :param seed: random seed
+    :return: list of events
+    """
+    rng = np.random.default_rng(seed)
+    names = suburb_names(n_suburbs)
+    dates = None
+    trace = []
+
+    for _ in range(n_clicks):
+        kind = rng.random()
+        if kind < 0.1:
+            start = int(rng.integers(0, n_months - 1))
+            dates = [start, int(rng.integers(start, n_months))]
+            trace.append({'callback': 'metric', 'metric': 'sellPrice', 'dates': dates})
+        elif kind < 0.15:
+            trace.append({'callback': 'metric', 'metric': str(rng.choice(METRICS)), 'dates': dates})
+        elif kind < 0.2:
+            trace.append({'callback': 'selection', 'clickData': None, 'selectedData': None, 'dates': dates})
+        elif kind < 0.25:
+            start = int(rng.integers(0, n_suburbs))
+            lasso = click(*names[start:start + int(rng.integers(2, 201))])
+            trace.append({'callback': 'selection', 'clickData': None, 'selectedData': lasso, 'dates': dates})
+        else:
+            # a click also selects the suburb, as the map's clickmode is 'event+select'
+            location = click(names[min(int(rng.zipf(1.3)) - 1, n_suburbs - 1)])
+            trace.append({'callback': 'selection', 'clickData': location, 'selectedData': location, 'dates': dates})
+
+    return trace
+
+
+# Replay
+# ---------------------------------------------------------------------------------------------------------------------
+def memory():
+    """Resident and proportional set size of this process in MB, the latter splits shared pages between processes"""
+    sizes = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                if name in ('Rss', 'Pss'):
+                    sizes[name.lower()] = int(value.split()[0]) / 1024
+    except OSError:
+        # ru_maxrss is in kB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sizes['rss'] = peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    return sizes
+
+
+def request_body(output, inputs):
+    """Body of a /_dash-update-component request
+
+    :param output: output id string, see response_cache.callback_id
+    :param inputs: list of (component id, property, value)
+    """
+    def spec(output):
+        component, prop = output.rsplit('.', 1)
+        return {'id': component, 'property': prop}
+
+    outputs = [spec(part) for part in output.strip('.').split('...')] if output.startswith('..') else spec(output)
+
+    return {'output': output, 'outputs': outputs,
+            'inputs': [{'id': component, 'property': prop, 'value': value} for component, prop, value in inputs],
+            'changedPropIds': ['{0}.{1}'.format(component, prop) for component, prop, _ in inputs[:1]]}
+
+
+def replay(workdir, trace, keep_cache, results, barrier):
+    """Benchmark one worker: import the app, load the layout, replay the trace
+
+    :param workdir: directory holding data/
+    :param trace: list of events
+    :param keep_cache: keep cached responses between requests instead of running every callback
+    :param results: queue the worker's results are put on
+    :param barrier: every worker waits here before measuring memory, so they are all alive at once
+    """
+    try:
+        measure(workdir, trace, keep_cache, results, barrier)
+    except Exception:
+        # the parent waits for every worker's results, so failures are reported rather than raised
+        barrier.abort()
+        results.put({'pid': os.getpid(), 'error': traceback.format_exc()})
+
+
+def measure(workdir, trace, keep_cache, results, barrier):
+    """Import the app, load the layout and replay the trace, see replay"""
+    started = time.perf_counter()
+    sys.path.insert(0, HERE)
+    os.chdir(workdir)
+    if not keep_cache:
+        # the workers would otherwise answer each other's requests through the shared tier
+        os.environ['RESPONSE_CACHE_DB'] = ''
+
+    import app
+    from response_cache import callback_id
+    imported = time.perf_counter()
+
+    client = app.server.test_client()
+    headers = {'Accept-Encoding': 'br, gzip'}
+    layout = client.get('/_dash-layout', headers=headers)
+    timings = {'layout': [(time.perf_counter() - imported) * 1000]}
+    sizes = {'layout': [len(layout.data)]}
+
+    selection = callback_id(app.selection_outputs)
+    dated = [] if app.clientside_selection else [('dates', 'value')]
+
+    for event in trace:
+        dates = [(component, prop, event.get('dates')) for component, prop in dated]
+        posts = []
+        if event['callback'] == 'selection':
+            selected = [('map', 'clickData', event.get('clickData')), ('map', 'selectedData', event.get('selectedData'))]
+            if not app.clientside_selection:
+                posts.append(('selection', request_body(selection, selected + dates)))
+            # the price trend follows the selection too
+            posts.append(('trend', request_body('trend.figure', selected + [('period', 'value', 'M')] + dates)))
+        else:
+            posts.append(('metric', request_body('map.figure', [('metric', 'value', event['metric'])] + dates)))
+
+        for callback, body in posts:
+            if not keep_cache:
+                app.response_cache.clear()
+
+            start = time.perf_counter()
+            response = client.post('/_dash-update-component', json=body, headers=headers)
+            timings.setdefault(callback, []).append((time.perf_counter() - start) * 1000)
+            sizes.setdefault(callback, []).append(len(response.data))
+
+            if response.status_code != 200:
+                raise RuntimeError('{0} returned {1}: {2}'.format(event, response.status_code, response.data[:200]))
+
+    barrier.wait()
+    results.put({'pid': os.getpid(), 'import_s': imported - started,
+                 'first_layout_ms': timings['layout'][0], 'memory_mb': memory(),
+                 'timings': timings, 'sizes': sizes})
+    barrier.wait()
+
+
+def summarize(workers):
+    """Latency percentiles and response sizes per callback over every worker's requests"""
+    summary = {}
+    for callback in sorted({name for worker in workers for name in worker['timings']}):
+        timings = np.concatenate([worker['timings'].get(callback, []) for worker in workers])
+        sizes = np.concatenate([worker['sizes'].get(callback, []) for worker in workers])
+        summary[callback] = {'requests': len(timings),
+                             'p50_ms': np.percentile(timings, 50),
+                             'p95_ms': np.percentile(timings, 95),
+                             'p99_ms': np.percentile(timings, 99),
+                             'mean_bytes': sizes.mean(),
+                             'max_bytes': int(sizes.max())}
+
+    return summary
+
+
+def report(summary, workers):
+    print('{0:<12}{1:>10}{2:>10}{3:>10}{4:>10}{5:>14}{6:>14}'.format(
+        'callback', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'mean bytes', 'max bytes'))
+    for callback, stats in summary.items():
+        print('{0:<12}{requests:>10}{p50_ms:>10.2f}{p95_ms:>10.2f}{p99_ms:>10.2f}{mean_bytes:>14.0f}{max_bytes:>14}'
+              .format(callback, **stats))
+
+    print()
+    print('{0:<12}{1:>10}{2:>16}{3:>10}{4:>10}'.format('worker', 'import s', 'first layout ms', 'rss MB', 'pss MB'))
+    for worker in workers:
+        print('{0:<12}{1:>10.2f}{2:>16.1f}{3:>10.1f}{4:>10}'.format(
+            worker['pid'], worker['import_s'], worker['first_layout_ms'], worker['memory_mb']['rss'],
+            '{0:.1f}'.format(worker['memory_mb']['pss']) if 'pss' in worker['memory_mb'] else '-'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard callbacks against synthetic data')
+    parser.add_argument('--sales', type=int, default=200000, help='sales in the generated prices_data.csv')
+    parser.add_argument('--suburbs', type=int, default=600, help='suburbs in the generated GeoJSON')
+    parser.add_argument('--clicks', type=int, default=300, help='events in the generated trace')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', help='replay a trace from a JSON file instead of generating one')
+    parser.add_argument('--record', help='write the trace to a JSON file')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes replaying the trace together')
+    parser.add_argument('--keep-cache', action='store_true',
+                        help='let repeated requests hit the response cache, as in production')
+    parser.add_argument('--workdir', help='keep the fixtures and built data here between runs (default: a temp dir)')
+    parser.add_argument('--json', help='write the results to a JSON file')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='dashboard-benchmark-'))
+    try:
+        prepare(workdir, args.sales, args.suburbs, args.seed)
+        # every run starts with a cold response cache, including the tier shared by the workers
+        shutil.rmtree(os.path.join(workdir, 'data', 'cache'), ignore_errors=True)
+
+        if args.trace:
+            with open(args.trace) as f:
+                trace = json.load(f)
+        else:
+            dates = pd.read_csv(os.path.join(workdir, PRICES_CSV), usecols=['Date'], parse_dates=['Date'])['Date']
+            n_months = (dates.max().year - dates.min().year) * 12 + dates.max().month - dates.min().month + 1
+            trace = make_trace(args.suburbs, args.clicks, n_months, args.seed)
+        if args.record:
+            with open(args.record, 'w') as f:
+                json.dump(trace, f)
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        barrier = context.Barrier(args.workers)
+        processes = [context.Process(target=replay, args=(workdir, trace, args.keep_cache, results, barrier))
+                     for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        workers = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        failed = [worker for worker in workers if 'error' in worker]
+        if failed:
+            sys.exit('worker {pid} failed:\n{error}'.format(**failed[0]))
+
+        summary = summarize(workers)
+        report(summary, workers)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'settings': vars(args), 'callbacks': summary,
+                           'workers': [{key: value for key, value in worker.items() if key not in ('timings', 'sizes')}
+                                       for worker in workers]}, f, indent=2)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
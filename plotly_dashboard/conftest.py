@@ -0,0 +1,58 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import prepare
+
+
+def sales(n_suburbs=40, n_rows=5000, n_months=24, seed=0):
+    """Random sales with the columns of prices_data.csv, indexed by Date
+
+    :param n_suburbs: number of suburbs, named 'Suburb 0000' and up
+    :param n_rows: number of sales
+    :param n_months: months the sales are spread over, from January 2015
+    :param seed: random seed
+    :return: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    suburbs = np.array(['Suburb {0:04d}'.format(i) for i in range(n_suburbs)])
+    # every suburb has sales, the others are spread at random
+    codes = np.concatenate([np.arange(n_suburbs), rng.integers(0, n_suburbs, max(n_rows - n_suburbs, 0))])
+    rng.shuffle(codes)
+
+    cars = rng.integers(0, 4, len(codes)).astype('float64')
+    cars[rng.random(len(codes)) < 0.05] = np.nan
+
+    df = pd.DataFrame({
+        'Date': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, n_months * 30, len(codes)), unit='D'),
+        'postalCode': 2000 + codes,
+        'suburb': suburbs[codes],
+        'sellPrice': np.round(rng.lognormal(13.7, 0.5, len(codes)), -3),
+        'bed': rng.integers(1, 7, len(codes)).astype('float64'),
+        'bath': rng.integers(1, 4, len(codes)).astype('float64'),
+        'car': cars,
+        'propType': rng.choice(['house', 'townhouse', 'duplex/semi-detached'], len(codes))})
+
+    return df.set_index('Date')
+
+
+@pytest.fixture
+def make_sales():
+    """The sales function, for tests that need several datasets"""
+    return sales
+
+
+@pytest.fixture(scope='session')
+def dashboard(tmp_path_factory):
+    """The app module, loaded from the benchmark's synthetic sales and suburb polygons in a temporary directory"""
+    workdir = str(tmp_path_factory.mktemp('dashboard'))
+    prepare(workdir, n_sales=5000, n_suburbs=40)
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(workdir)
+        patch.delenv('BACKGROUND_LOADING', raising=False)
+        app = importlib.import_module('app')
+
+    return app
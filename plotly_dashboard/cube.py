@@ -0,0 +1,453 @@
+"""Suburb x month cube of sales counts, histogram bins and quantile sketches
+
+Each (suburb, month) cell with sales keeps its histogram bins and sketches as sparse (key, count)
+entries, sorted by suburb, then month, then key. The cells of a suburb over any month range are then a
+contiguous run of entries, and any date range is answered by summing monthly cells instead of
+re-filtering the sales. City-wide histogram bins are kept per month as cumulative sums.
+"""
+import json
+import os
+
+import numpy as np
+
+from histograms import bin_index, bin_counts
+from sketches import median, sparse_quantile
+
+
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def month_number(dates):
+    """Months since year 0 of a DatetimeIndex"""
+    return dates.year.values.astype('int64') * 12 + dates.month.values - 1
+
+
+class SparseCounts:
+    """Counts of keys per cell, stored as cell-sorted entries with a cell -> entry offset table"""
+
+    def __init__(self, offsets, keys, counts, size):
+        """
+        :param offsets: (n_cells + 1) offsets of every cell's entries
+        :param keys: key of every entry
+        :param counts: count of every entry
+        :param size: number of distinct keys
+        """
+        self.offsets = offsets
+        self.keys = keys
+        self.counts = counts
+        self.size = size
+
+    @property
+    def cells(self):
+        """Cell of every entry, for queries across many cells
+
+        Derived from the offsets on every use rather than kept, it would be as large as keys in every worker.
+        """
+        return np.repeat(np.arange(len(self.offsets) - 1, dtype='int32'), np.diff(self.offsets))
+
+    @classmethod
+    def build(cls, cells, keys, n_cells, size, weights=None):
+        """
+        :param cells: cell of every value
+        :param keys: key of every value, negative keys are dropped
+        :param n_cells: number of cells
+        :param size: number of distinct keys
+        :param weights: count of every value (default: 1 each)
+        """
+        keep = keys >= 0
+        pairs, inverse = np.unique(cells[keep].astype('int64') * size + keys[keep], return_inverse=True)
+        counts = np.bincount(inverse, weights=None if weights is None else weights[keep], minlength=len(pairs))
+        offsets = np.searchsorted(pairs // size, np.arange(n_cells + 1))
+
+        return cls.narrow(offsets, pairs % size, counts, size)
+
+    @classmethod
+    def narrow(cls, offsets, keys, counts, size):
+        """SparseCounts with keys and counts in the narrowest unsigned type that holds them, usually one or two
+        bytes each"""
+        return cls(offsets.astype('int32' if offsets[-1] < 2 ** 31 else 'int64'),
+                   keys.astype(np.min_scalar_type(size - 1)),
+                   counts.astype(np.min_scalar_type(int(counts.max(initial=0)))), size)
+
+    def merge(self, other, cells, other_cells, n_cells):
+        """Counts of both, with the cells of each moved to their merged cell numbers
+
+        The other's entries are inserted among this one's, which are sorted already, so merging a small batch
+        costs about a copy of the entries rather than sorting them again.
+
+        :param other: SparseCounts of the same keys
+        :param cells: merged cell of every cell of this one, increasing
+        :param other_cells: merged cell of every cell of the other, increasing
+        :param n_cells: number of merged cells
+        """
+        pairs = np.asarray(cells, dtype='int64')[self.cells] * self.size + self.keys
+        other_pairs = np.asarray(other_cells, dtype='int64')[other.cells] * self.size + other.keys
+
+        at = np.searchsorted(pairs, other_pairs)
+        found = at < len(pairs)
+        found[found] = pairs[at[found]] == other_pairs[found]
+        counts = self.counts.astype('int64')
+        counts[at[found]] += other.counts[found]
+
+        new = ~found
+        entries = np.zeros(n_cells, dtype='int64')
+        entries[cells] = np.diff(self.offsets)
+        entries += np.bincount(np.asarray(other_cells)[other.cells[new]], minlength=n_cells)
+
+        return SparseCounts.narrow(np.concatenate([[0], np.cumsum(entries)]),
+                                   np.insert(self.keys, at[new], other.keys[new]),
+                                   np.insert(counts, at[new], other.counts[new]), self.size)
+
+    def total(self, start, stop):
+        """Summed counts of the cells start:stop, or of every range when start and stop are arrays"""
+        lo, hi = self.offsets[start], self.offsets[stop]
+        if np.ndim(lo) == 0:
+            return np.bincount(self.keys[lo:hi], weights=self.counts[lo:hi], minlength=self.size).astype('int64')
+
+        # entry numbers of every range, concatenated
+        lengths = hi - lo
+        entries = np.arange(lengths.sum()) + np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+
+        return np.bincount(self.keys[entries], weights=self.counts[entries], minlength=self.size).astype('int64')
+
+    def totals(self, groups, n_groups, mask):
+        """Summed counts per group of the cells selected by mask
+
+        :param groups: group of every cell
+        :param n_groups: number of groups
+        :param mask: boolean mask of the cells to include
+        :return: (n_groups, size) array
+        """
+        cells = self.cells
+        keep = mask[cells]
+        flat = groups[cells[keep]].astype('int64') * self.size + self.keys[keep]
+        totals = np.bincount(flat, weights=self.counts[keep], minlength=n_groups * self.size)
+
+        return totals.reshape(n_groups, self.size).astype('int64')
+
+    def medians(self, groups, n_groups, mask, mapping):
+        """Median and total count per group of the cells selected by mask, from sketch counts
+
+        Merges the entries of every group sparsely, so any number of groups costs about one pass over the entries.
+
+        :param groups: group of every cell
+        :param n_groups: number of groups
+        :param mask: boolean mask of the cells to include
+        :param mapping: the mapping the sketches were built with
+        :return: (medians, counts) arrays of n_groups, NaN medians for groups without values
+        """
+        cells = self.cells
+        keep = mask[cells]
+        pairs, inverse = np.unique(groups[cells[keep]].astype('int64') * self.size + self.keys[keep],
+                                   return_inverse=True)
+        counts = np.bincount(inverse, weights=self.counts[keep], minlength=len(pairs))
+
+        return sparse_quantile(pairs // self.size, pairs % self.size, counts, n_groups, mapping)
+
+
+class MonthlyCube:
+    """Per (suburb, month) histogram bins and quantile sketches of the sales"""
+
+    def __init__(self, first_month, n_months, cell_suburb, cell_month, suburb_offsets, bins, sketches, city_bins,
+                 edges, mappings):
+        """
+        :param first_month: month number (see month_number) of the first month
+        :param n_months: number of months covered
+        :param cell_suburb: suburb position of every cell
+        :param cell_month: month (from first_month) of every cell
+        :param suburb_offsets: (n_suburbs + 1) offsets of every suburb's cells
+        :param bins: dict of column -> SparseCounts of histogram bins per cell
+        :param sketches: dict of column -> SparseCounts of sketch buckets per cell
+        :param city_bins: dict of column -> (n_months + 1, n_bins) cumulative city-wide bins
+        :param edges: dict of column -> bin edges
+        :param mappings: dict of column -> sketch mapping
+        """
+        self.first_month = first_month
+        self.n_months = n_months
+        self.cell_suburb = cell_suburb
+        self.cell_month = cell_month
+        self.suburb_offsets = suburb_offsets
+        self.bins = bins
+        self.sketches = sketches
+        self.city_bins = city_bins
+        self.edges = edges
+        self.mappings = mappings
+
+    @classmethod
+    def build(cls, index, edges, mappings):
+        """
+        :param index: SuburbIndex over the sales
+        :param edges: dict of column -> histogram bin edges
+        :param mappings: dict of column -> sketch mapping
+        :return: MonthlyCube
+        """
+        rows = index.rows
+        months = month_number(rows.index)
+        first_month = int(months.min())
+        n_months = int(months.max()) - first_month + 1
+        months = months - first_month
+
+        # cells are numbered in (suburb, month) order
+        keep = index.codes >= 0
+        cell_ids, cells = np.unique(index.codes[keep].astype('int64') * n_months + months[keep],
+                                    return_inverse=True)
+        cell_suburb = (cell_ids // n_months).astype('int32')
+        cell_month = (cell_ids % n_months).astype('int32')
+        suburb_offsets = np.searchsorted(cell_suburb, np.arange(len(index) + 1))
+
+        bins = {}
+        sketches = {}
+        city_bins = {}
+        for column, column_edges in edges.items():
+            values = rows[column].values[keep]
+            bin_keys = bin_index(values, column_edges)
+            bins[column] = SparseCounts.build(cells, bin_keys, len(cell_ids), len(column_edges) - 1)
+            sketches[column] = SparseCounts.build(cells, mappings[column].key(values), len(cell_ids),
+                                                  mappings[column].size)
+
+            monthly = bin_counts(values, months[keep], n_months, column_edges)
+            city_bins[column] = np.concatenate([np.zeros((1, monthly.shape[1]), dtype='int64'),
+                                                np.cumsum(monthly, axis=0)])
+
+        return cls(first_month, n_months, cell_suburb, cell_month, suburb_offsets, bins, sketches, city_bins,
+                   edges, mappings)
+
+    def reindex(self, positions, n_suburbs):
+        """Move the cells to new suburb positions, e.g. after new suburbs were added
+
+        :param positions: new position of every current suburb, in increasing order so cells stay sorted
+        :param n_suburbs: number of suburbs after the move
+        :return: MonthlyCube
+        """
+        cell_suburb = np.asarray(positions)[self.cell_suburb].astype('int32')
+        suburb_offsets = np.searchsorted(cell_suburb, np.arange(n_suburbs + 1))
+
+        return MonthlyCube(self.first_month, self.n_months, cell_suburb, self.cell_month, suburb_offsets, self.bins,
+                           self.sketches, self.city_bins, self.edges, self.mappings)
+
+    def merge(self, other):
+        """Cube of both cubes' sales, they must share edges, mappings and suburb positions
+
+        Only the sparse cell entries are merged, no sales are re-read.
+        """
+        first_month = min(self.first_month, other.first_month)
+        n_months = max(self.first_month + self.n_months, other.first_month + other.n_months) - first_month
+        n_suburbs = len(self.suburb_offsets) - 1
+
+        cubes = (self, other)
+        ids = [cube.cell_suburb.astype('int64') * n_months + cube.cell_month + cube.first_month - first_month
+               for cube in cubes]
+        cell_ids = np.union1d(*ids)
+        cells = [np.searchsorted(cell_ids, cube_ids) for cube_ids in ids]
+
+        def merge_counts(counts):
+            return counts[0].merge(counts[1], cells[0], cells[1], len(cell_ids))
+
+        bins = {}
+        sketches = {}
+        city_bins = {}
+        for column in self.edges:
+            bins[column] = merge_counts([cube.bins[column] for cube in cubes])
+            sketches[column] = merge_counts([cube.sketches[column] for cube in cubes])
+
+            monthly = np.zeros((n_months, len(self.edges[column]) - 1), dtype='int64')
+            for cube in cubes:
+                start = cube.first_month - first_month
+                monthly[start:start + cube.n_months] += np.diff(cube.city_bins[column], axis=0)
+            city_bins[column] = np.concatenate([np.zeros((1, monthly.shape[1]), dtype='int64'),
+                                                np.cumsum(monthly, axis=0)])
+
+        cell_suburb = (cell_ids // n_months).astype('int32')
+        cell_month = (cell_ids % n_months).astype('int32')
+        suburb_offsets = np.searchsorted(cell_suburb, np.arange(n_suburbs + 1))
+
+        return MonthlyCube(first_month, n_months, cell_suburb, cell_month, suburb_offsets, bins, sketches, city_bins,
+                           self.edges, self.mappings)
+
+    @classmethod
+    def join(cls, cubes):
+        """One cube with the columns of cubes built separately over the same sales, e.g. in parallel
+
+        :param cubes: list of MonthlyCube with the same cells
+        :return: MonthlyCube
+        """
+        first = cubes[0]
+        for cube in cubes[1:]:
+            if (cube.first_month, cube.n_months) != (first.first_month, first.n_months) or \
+                    not np.array_equal(cube.cell_suburb, first.cell_suburb) or \
+                    not np.array_equal(cube.cell_month, first.cell_month):
+                raise ValueError('cubes were built over different sales')
+
+        parts = {'bins': {}, 'sketches': {}, 'city_bins': {}, 'edges': {}, 'mappings': {}}
+        for cube in cubes:
+            for name, columns in parts.items():
+                columns.update(getattr(cube, name))
+
+        return cls(first.first_month, first.n_months, first.cell_suburb, first.cell_month, first.suburb_offsets,
+                   **parts)
+
+    def month_label(self, month):
+        """Display name of a month position, e.g. 'Mar 2012'"""
+        year, month = divmod(self.first_month + int(month), 12)
+
+        return '{0} {1}'.format(MONTH_NAMES[month], year)
+
+    def months(self, dates):
+        """Month positions of dates, clipped to the months covered"""
+        return np.clip(month_number(dates) - self.first_month, 0, self.n_months - 1)
+
+    def cells(self, position, start, stop):
+        """(first, last + 1) cells of a suburb within the months start..stop (inclusive)
+
+        For an array of positions, arrays of the first and last + 1 cells of every suburb.
+        """
+        if np.ndim(position):
+            bounds = [self.cells(p, start, stop) for p in position if p >= 0]
+            return tuple(np.array(side, dtype='int64') for side in zip(*bounds)) if bounds else (0, 0)
+
+        lo, hi = self.suburb_offsets[position], self.suburb_offsets[position + 1]
+        months = self.cell_month[lo:hi]
+
+        return lo + np.searchsorted(months, start), lo + np.searchsorted(months, stop, side='right')
+
+    def histogram(self, column, position, start, stop):
+        """Histogram bins of a suburb, of several suburbs given an array of positions, or city-wide when position
+        is None, over the months start..stop"""
+        if position is None:
+            return self.edges[column], self.city_bins[column][stop + 1] - self.city_bins[column][start]
+
+        if np.ndim(position) == 0 and position < 0:
+            return self.edges[column], np.zeros(len(self.edges[column]) - 1, dtype='int64')
+
+        return self.edges[column], self.bins[column].total(*self.cells(position, start, stop))
+
+    def sketch(self, column, position, start, stop):
+        """Merged quantile sketch of a suburb, or of several suburbs given an array of positions, over the months
+        start..stop"""
+        if np.ndim(position) == 0 and position < 0:
+            return np.zeros(self.mappings[column].size, dtype='int64')
+
+        return self.sketches[column].total(*self.cells(position, start, stop))
+
+    def suburb_totals(self, counts, start, stop, positions=None):
+        """Summed counts of every suburb over the months start..stop, in one pass over the cells
+
+        :param counts: SparseCounts of the cube, e.g. self.bins[column]
+        :param start: first month position
+        :param stop: last month position (inclusive)
+        :param positions: suburb positions to return, all suburbs in position order when None
+        :return: (n, size) array, zeros for negative positions
+        """
+        mask = (self.cell_month >= start) & (self.cell_month <= stop)
+        n_suburbs = len(self.suburb_offsets) - 1
+        if positions is None:
+            return counts.totals(self.cell_suburb, n_suburbs, mask)
+
+        # count each requested suburb once, then copy rows for repeats; row 0 is the zeros of unknown suburbs
+        unique, inverse = np.unique(np.asarray(positions, dtype='int64'), return_inverse=True)
+        known = unique[unique >= 0]
+        groups = np.zeros(n_suburbs, dtype='int64')
+        groups[known] = np.arange(1, len(known) + 1)
+        cell_groups = groups[self.cell_suburb]
+
+        totals = counts.totals(cell_groups, len(known) + 1, mask & (cell_groups > 0))
+        rows = np.where(unique >= 0, groups[np.maximum(unique, 0)], 0)
+
+        return totals[rows[inverse.ravel()]]
+
+    def suburb_medians(self, column, start, stop, positions=None):
+        """Median of every suburb over the months start..stop, NaN for suburbs without sales
+
+        :param positions: suburb positions to return, all suburbs when None
+        :return: array in suburb position order, or in the order of positions
+        """
+        return median(self.suburb_totals(self.sketches[column], start, stop, positions), self.mappings[column])
+
+    def medians(self, columns, position, start, stop):
+        """Medians of columns in a suburb, or in several suburbs together, over the months start..stop"""
+        return [median(self.sketch(column, position, start, stop), self.mappings[column]) for column in columns]
+
+    def periods(self, months):
+        """(period of every month, number of periods) for periods of a number of calendar months, e.g. 3 for
+        quarters"""
+        first = self.first_month // months
+        period = (self.first_month + np.arange(self.n_months)) // months - first
+
+        return period, int(period[-1]) + 1
+
+    def period_label(self, period, months):
+        """First day of a period as an ISO date, e.g. '2012-04-01'"""
+        year, month = divmod((self.first_month // months + int(period)) * months, 12)
+
+        return '{0}-{1:02d}-01'.format(year, month + 1)
+
+    def period_medians(self, column, months, positions=None):
+        """Median and number of sales of every period of a number of calendar months, from the sketches
+
+        :param column: column with sketches
+        :param months: months per period, 1 for monthly or 3 for quarterly
+        :param positions: suburb positions combined into one series, every suburb its own series when None
+        :return: (medians, counts) as (n_suburbs, n_periods) arrays, or (n_periods,) arrays for positions
+        """
+        period, n_periods = self.periods(months)
+        cell_period = period[self.cell_month]
+        n_suburbs = len(self.suburb_offsets) - 1
+        sketches, mapping = self.sketches[column], self.mappings[column]
+
+        if positions is None:
+            medians, counts = sketches.medians(self.cell_suburb.astype('int64') * n_periods + cell_period,
+                                               n_suburbs * n_periods, np.ones(len(cell_period), dtype=bool), mapping)
+            return medians.reshape(n_suburbs, n_periods), counts.reshape(n_suburbs, n_periods)
+
+        positions = np.asarray(positions, dtype='int64')
+        selected = np.zeros(n_suburbs, dtype=bool)
+        selected[positions[positions >= 0]] = True
+
+        return sketches.medians(cell_period, n_periods, selected[self.cell_suburb], mapping)
+
+    def save(self, path):
+        """Write the cube's arrays to a directory, one .npy file each"""
+        os.makedirs(path)
+        arrays = {'cell_suburb': self.cell_suburb, 'cell_month': self.cell_month,
+                  'suburb_offsets': self.suburb_offsets}
+        for column in self.edges:
+            arrays[column + '.edges'] = self.edges[column]
+            arrays[column + '.city_bins'] = self.city_bins[column]
+            for name, counts in (('bins', self.bins[column]), ('sketch', self.sketches[column])):
+                arrays['{0}.{1}.offsets'.format(column, name)] = counts.offsets
+                arrays['{0}.{1}.keys'.format(column, name)] = counts.keys
+                arrays['{0}.{1}.counts'.format(column, name)] = counts.counts
+
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), values)
+
+        with open(os.path.join(path, 'cube.json'), 'w') as f:
+            json.dump({'first_month': self.first_month, 'n_months': self.n_months, 'columns': list(self.edges)}, f)
+
+    @classmethod
+    def load(cls, path, mappings):
+        """Memory-map a cube written by save
+
+        :param path: directory
+        :param mappings: dict of column -> the sketch mapping the cube was built with
+        """
+        with open(os.path.join(path, 'cube.json')) as f:
+            meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        bins = {}
+        sketches = {}
+        city_bins = {}
+        edges = {}
+        for column in meta['columns']:
+            edges[column] = load(column + '.edges')
+            city_bins[column] = load(column + '.city_bins')
+            bins[column] = SparseCounts(load(column + '.bins.offsets'), load(column + '.bins.keys'),
+                                        load(column + '.bins.counts'), len(edges[column]) - 1)
+            sketches[column] = SparseCounts(load(column + '.sketch.offsets'), load(column + '.sketch.keys'),
+                                            load(column + '.sketch.counts'), mappings[column].size)
+
+        return cls(meta['first_month'], meta['n_months'], load('cell_suburb'), load('cell_month'),
+                   load('suburb_offsets'), bins, sketches, city_bins, edges, mappings)
@@ -0,0 +1,193 @@
+"""Columnar binary copy of prices_data.csv
+
+Every column is stored as its own .npy file so workers can memory-map them instead of parsing the CSV:
+`suburb` and every other text column are dictionary encoded (integer codes plus the list of values in the
+manifest), numeric columns use the narrowest dtype that holds them exactly. Build it with:
+
+    $ python datastore.py
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+PRICES_CSV = os.path.join('data', 'prices_data.csv')
+PRICES_STORE = os.path.join('data', 'prices_data')
+
+MANIFEST = 'manifest.json'
+CATEGORICAL = ['suburb']
+
+# dtype kinds saved as they are, columns of any other kind (text, objects) are dictionary encoded
+NUMERIC_KINDS = 'biufM'
+
+
+def source_info(path):
+    """Size, modification time and sha256 of the source CSV"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    stat = os.stat(path)
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+
+def narrowest(values):
+    """Smallest dtype holding a numeric column exactly
+
+    :param values: numpy array
+    :return: array cast to the narrowest integer or float dtype
+    """
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iuf' or len(values) == 0:
+        return values
+
+    finite = values[~np.isnan(values)] if values.dtype.kind == 'f' else values
+    if len(finite) == len(values) and np.array_equal(finite, np.round(finite)):
+        return pd.to_numeric(values.astype('int64'), downcast='unsigned' if finite.min() >= 0 else 'integer')
+
+    if np.array_equal(values.astype('float32'), values, equal_nan=True):
+        return values.astype('float32')
+
+    return values.astype('float64')
+
+
+def is_categorical(df, column):
+    """Whether a column is dictionary encoded: the CATEGORICAL ones and any column that isn't numeric or dates"""
+    return column in CATEGORICAL or df[column].dtype.kind not in NUMERIC_KINDS
+
+
+def compact(df):
+    """The sales with categorical suburbs and text columns, every numeric column in its narrowest dtype
+    (see narrowest)"""
+    df = df.copy()
+    for column in df.columns:
+        if is_categorical(df, column):
+            df[column] = pd.Categorical(df[column])
+        else:
+            df[column] = narrowest(df[column].values)
+
+    return df
+
+
+def write_store(df, store, source=None):
+    """Write a dataframe indexed by Date as one .npy file per column
+
+    :param df: dataframe
+    :param store: output directory
+    :param source: details of the file the data came from, stored in the manifest
+    :return: the manifest written
+    """
+    os.makedirs(store, exist_ok=True)
+    df = df.reset_index()
+
+    columns = {}
+    for column in df.columns:
+        if is_categorical(df, column):
+            values = pd.Categorical(df[column])
+            codes = pd.to_numeric(values.codes, downcast='integer')
+            columns[column] = {'dtype': str(codes.dtype), 'categories': list(values.categories)}
+            np.save(os.path.join(store, column + '.npy'), codes)
+        else:
+            values = df[column].values if column == 'Date' else narrowest(df[column].values)
+            columns[column] = {'dtype': str(values.dtype)}
+            np.save(os.path.join(store, column + '.npy'), values)
+
+    manifest = {'source': source, 'index': 'Date', 'rows': len(df), 'columns': columns}
+    with open(os.path.join(store, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+def build_store(csv=PRICES_CSV, store=PRICES_STORE):
+    """Convert the sales CSV to one .npy file per column
+
+    :param csv: source CSV
+    :param store: output directory
+    :return: the manifest written
+    """
+    df = pd.read_csv(csv, parse_dates=True, index_col='Date')
+
+    return write_store(df, store, source_info(csv))
+
+
+def is_fresh(manifest, csv=PRICES_CSV):
+    """Whether a store was built from the current CSV
+
+    Size and modification time are compared first, the checksum only when they differ.
+    """
+    if not os.path.exists(csv):
+        return True
+
+    source = manifest['source']
+    stat = os.stat(csv)
+    if stat.st_size != source['size']:
+        return False
+    if stat.st_mtime_ns == source['mtime_ns']:
+        return True
+
+    return source_info(csv)['sha256'] == source['sha256']
+
+
+def read_manifest(store=PRICES_STORE):
+    """Column dtypes, suburb names and source CSV details of a store"""
+    with open(os.path.join(store, MANIFEST)) as f:
+        return json.load(f)
+
+
+def read_store(store=PRICES_STORE, mmap=True, manifest=None):
+    """Read the columnar store back to a dataframe indexed by Date
+
+    :param store: store directory
+    :param mmap: memory-map the column files instead of reading them
+    :param manifest: the store's manifest if already read
+    :return: dataframe
+    """
+    manifest = manifest or read_manifest(store)
+
+    data = {}
+    for column, spec in manifest['columns'].items():
+        values = np.load(os.path.join(store, column + '.npy'), mmap_mode='r' if mmap else None)
+        if 'categories' in spec:
+            values = pd.Categorical.from_codes(values, spec['categories'])
+        data[column] = values
+
+    index = pd.DatetimeIndex(data.pop(manifest['index']), name=manifest['index'])
+
+    return pd.DataFrame(data, index=index, copy=False)
+
+
+def read_fresh_store(csv=PRICES_CSV, store=PRICES_STORE, mmap=True):
+    """The columnar store as read by read_store, None when it is missing, older than the CSV or unreadable"""
+    if not os.path.exists(os.path.join(store, MANIFEST)):
+        return None
+
+    try:
+        manifest = read_manifest(store)
+        if not is_fresh(manifest, csv):
+            print('{0} is older than {1}, reading the CSV'.format(store, csv))
+            return None
+        return read_store(store, mmap, manifest)
+    except (OSError, ValueError, KeyError) as error:
+        print('{0} could not be read ({1}), reading the CSV'.format(store, error))
+        return None
+
+
+def load_prices(csv=PRICES_CSV, store=PRICES_STORE, mmap=True):
+    """Load the sales data from the columnar store, or parse the CSV when the store can't be used (see read_fresh_store)"""
+    df = read_fresh_store(csv, store, mmap)
+    if df is not None:
+        return df
+
+    return compact(pd.read_csv(csv, parse_dates=True, index_col='Date'))
+
+
+if __name__ == '__main__':
+    manifest = build_store()
+    print('{0}: {1} rows'.format(PRICES_STORE, manifest['rows']))
+    for column, spec in manifest['columns'].items():
+        print('  {0}: {1}'.format(column, spec['dtype']))
@@ -0,0 +1,213 @@
+"""Local cache of the Sydney suburb boundaries
+
+The boundary GeoJSON is downloaded once into the data directory (with a sha256 checksum next to it),
+then simplified and coordinate quantized into the much smaller file the dashboard loads at startup.
+Loading never touches the network, refresh the cache with:
+
+    $ python geodata.py --refresh
+"""
+import argparse
+import functools
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import requests
+from shapely.geometry import mapping, shape
+
+GEOJSON_URL = ('https://raw.githubusercontent.com/Perishleaf/data-visualisation-scripts/master'
+               '/dash_project_medium/Sydney_suburb.geojson')
+
+GEOJSON_CACHE = os.path.join('data', 'Sydney_suburb.geojson')
+SIMPLIFIED_CACHE = os.path.join('data', 'Sydney_suburb.simplified.geojson')
+
+# simplification tolerance in degrees (~50m) and decimal places kept (~1m)
+TOLERANCE = 0.0005
+PRECISION = 5
+
+# the only feature property the dashboard uses
+SUBURB_PROPERTY = 'nsw_loca_2'
+
+
+def sha256(path):
+    """Hex sha256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _write_atomic(path, content):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def fetch_geojson(url=GEOJSON_URL, path=GEOJSON_CACHE, checksum=None):
+    """Download the boundary file into the local cache
+
+    :param url: URL to GeoJSON resource on web
+    :param path: cache file to write
+    :param checksum: expected sha256 of the download, checked before the cache is replaced
+    :return: sha256 of the cached file
+    """
+    r = requests.get(url, timeout=60)
+    r.raise_for_status()
+
+    digest = hashlib.sha256(r.content).hexdigest()
+    if checksum is not None and digest != checksum:
+        raise ValueError('checksum mismatch for {0}: expected {1}, got {2}'.format(url, checksum, digest))
+
+    _write_atomic(path, r.content)
+    _write_atomic(path + '.sha256', digest.encode())
+
+    return digest
+
+
+def verify_cache(path=GEOJSON_CACHE):
+    """Check a cached file against its stored checksum
+
+    :param path: cached file
+    :return: sha256 of the cached file
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError('{0} is missing, run `python geodata.py --refresh` to download it'.format(path))
+
+    digest = sha256(path)
+    with open(path + '.sha256') as f:
+        expected = f.read().strip()
+    if digest != expected:
+        raise ValueError('{0} does not match its checksum, run `python geodata.py --refresh`'.format(path))
+
+    return digest
+
+
+def quantize_ring(ring, precision):
+    """Round a ring's coordinates and drop the points that collapse onto the previous one"""
+    ring = np.round(np.asarray(ring, dtype='float64'), precision)
+    keep = np.ones(len(ring), dtype=bool)
+    keep[1:] = np.any(ring[1:] != ring[:-1], axis=1)
+    quantized = ring[keep]
+
+    # a closed ring needs at least 4 positions, keep the rounded original if it degenerates
+    if len(quantized) < 4:
+        quantized = ring
+
+    return quantized.tolist()
+
+
+def pack_coordinates(coordinates):
+    """GeoJSON coordinates with every ring held as an (n, 2) float array instead of lists of Python floats
+
+    A coordinate pair takes 16 bytes instead of about 130, the figure serializes to the same JSON.
+    """
+    if len(coordinates) and np.ndim(coordinates[0]) == 1:
+        return np.asarray(coordinates, dtype='float64')
+
+    return [pack_coordinates(part) for part in coordinates]
+
+
+def simplify_geometry(geometry, tolerance=TOLERANCE, precision=PRECISION):
+    """Simplify a GeoJSON (Multi)Polygon and quantize its coordinates
+
+    :param geometry: GeoJSON geometry dict
+    :param tolerance: simplification tolerance in degrees
+    :param precision: number of decimal places to keep
+    :return: GeoJSON geometry dict
+    """
+    geometry = mapping(shape(geometry).simplify(tolerance, preserve_topology=True))
+
+    if geometry['type'] == 'Polygon':
+        coordinates = [quantize_ring(ring, precision) for ring in geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        coordinates = [[quantize_ring(ring, precision) for ring in polygon] for polygon in geometry['coordinates']]
+    else:
+        return geometry
+
+    return {'type': geometry['type'], 'coordinates': coordinates}
+
+
+def simplify_geojson(path=GEOJSON_CACHE, out=SIMPLIFIED_CACHE, tolerance=TOLERANCE, precision=PRECISION, mapper=map):
+    """Write the simplified, quantized copy of the cached boundary file
+
+    Only the suburb name is kept from the feature properties. The source checksum and settings are
+    stored in the output so a stale copy can be detected.
+
+    :param path: cached boundary file
+    :param out: simplified file to write
+    :param tolerance: simplification tolerance in degrees
+    :param precision: number of decimal places to keep
+    :param mapper: map function the suburbs are simplified with, e.g. a process pool's
+    :return: output file size in bytes
+    """
+    digest = verify_cache(path)
+    with open(path) as f:
+        data = json.load(f)
+
+    features = [feature for feature in data['features'] if feature.get('geometry') is not None]
+    geometries = mapper(functools.partial(simplify_geometry, tolerance=tolerance, precision=precision),
+                        [feature['geometry'] for feature in features])
+    features = [{'type': 'Feature',
+                 'properties': {SUBURB_PROPERTY: feature['properties'].get(SUBURB_PROPERTY)},
+                 'geometry': geometry} for feature, geometry in zip(features, geometries)]
+
+    simplified = {'type': 'FeatureCollection',
+                  'source': {'sha256': digest, 'tolerance': tolerance, 'precision': precision},
+                  'features': features}
+    content = json.dumps(simplified, separators=(',', ':')).encode()
+    _write_atomic(out, content)
+
+    return len(content)
+
+
+def is_stale(path=GEOJSON_CACHE, out=SIMPLIFIED_CACHE, tolerance=TOLERANCE, precision=PRECISION):
+    """Whether the simplified file is missing or was built from another source or settings"""
+    if not os.path.exists(out):
+        return True
+
+    with open(out) as f:
+        source = json.load(f).get('source', {})
+
+    return source != {'sha256': verify_cache(path), 'tolerance': tolerance, 'precision': precision}
+
+
+def load_suburbs(path=GEOJSON_CACHE, out=SIMPLIFIED_CACHE, tolerance=TOLERANCE, precision=PRECISION, mapper=map):
+    """Load the simplified suburb boundaries to a GeoDataFrame without touching the network
+
+    The simplified file is rebuilt from the cached boundary file (with mapper, see simplify_geojson) when it is
+    missing or stale.
+    """
+    if os.path.exists(path) and is_stale(path, out, tolerance, precision):
+        simplify_geojson(path, out, tolerance, precision, mapper)
+    elif not os.path.exists(out):
+        verify_cache(path)
+
+    with open(out) as f:
+        data = json.load(f)
+
+    return gpd.GeoDataFrame.from_features(data['features'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cache and simplify the Sydney suburb boundaries')
+    parser.add_argument('--refresh', action='store_true', help='download the boundary file again')
+    parser.add_argument('--url', default=GEOJSON_URL)
+    parser.add_argument('--checksum', help='expected sha256 of the download')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='simplification tolerance in degrees')
+    parser.add_argument('--precision', type=int, default=PRECISION, help='decimal places to keep')
+    args = parser.parse_args()
+
+    if args.refresh or not os.path.exists(GEOJSON_CACHE):
+        previous = sha256(GEOJSON_CACHE) if os.path.exists(GEOJSON_CACHE) else None
+        digest = fetch_geojson(args.url, GEOJSON_CACHE, args.checksum)
+        print('{0} {1} ({2})'.format(GEOJSON_CACHE, digest, 'unchanged' if digest == previous else 'updated'))
+
+    size = simplify_geojson(GEOJSON_CACHE, SIMPLIFIED_CACHE, args.tolerance, args.precision)
+    print('{0} {1:.0f} kB (from {2:.0f} kB)'.format(SIMPLIFIED_CACHE, size / 1024,
+                                                   os.path.getsize(GEOJSON_CACHE) / 1024))
@@ -0,0 +1,13 @@
+# gunicorn reads this file from the working directory (see Procfile)
+
+# build the dashboard data once in the master before forking, workers share the memory-mapped artifacts
+preload_app = True
+raw_env = ['SHARED_ARTIFACTS=1']
+
+
+def post_worker_init(worker):
+    # threads don't survive the fork, so each worker starts its own data loading (BACKGROUND_LOADING=1) and watcher
+    # for new sales (INGEST=1)
+    import app
+    app.start_loading()
+    app.start_ingest()
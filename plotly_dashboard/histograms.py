@@ -0,0 +1,147 @@
+import numpy as np
+
+
+# Fixed-edge histogram bins
+# ---------------------------------------------------------------------------------------------------------------------
+def bin_edges(range_list, bin_size, discrete=False):
+    """Fixed bin edges covering an x axis range
+
+    :param range_list: a range of x limits in list format
+    :param bin_size: width of each bin
+    :param discrete: centre the bins on whole multiples of bin_size (for counts like beds)
+    :return: array of bin edges
+    """
+    start, stop = range_list
+    if discrete:
+        start, stop = start - bin_size / 2, stop + bin_size / 2
+
+    n_bins = int(np.ceil((stop - start) / bin_size))
+
+    return start + bin_size * np.arange(n_bins + 1)
+
+
+def bin_index(values, edges):
+    """Bin of every value, -1 for values outside the edges and NaNs
+
+    The last bin is closed like np.histogram.
+
+    :param values: array of values to bin
+    :param edges: bin edges
+    :return: integer array of bin numbers
+    """
+    values = np.asarray(values, dtype='float64')
+    n_bins = len(edges) - 1
+
+    bins = np.searchsorted(edges, values, side='right') - 1
+    bins[values == edges[-1]] = n_bins - 1
+    bins[bins >= n_bins] = -1
+
+    return bins
+
+
+def bin_counts(values, codes, n_groups, edges):
+    """Count values into fixed-edge bins separately for every group
+
+    :param values: array of values to bin, values outside the edges (and NaNs) are dropped
+    :param codes: integer group code of each value, negative codes are dropped
+    :param n_groups: number of groups
+    :param edges: bin edges
+    :return: (n_groups, n_bins) array of counts
+    """
+    codes = np.asarray(codes)
+    n_bins = len(edges) - 1
+
+    bins = bin_index(values, edges)
+    keep = (bins >= 0) & (codes >= 0)
+
+    counts = np.bincount(codes[keep].astype('int64') * n_bins + bins[keep], minlength=n_groups * n_bins)
+
+    return counts.reshape(n_groups, n_bins)
+
+
+def spec_edges(specs):
+    """Bin edges of every histogram column
+
+    :param specs: dict of column -> dict with 'range' (x limits) and 'bin_size'
+    :return: dict of column -> bin edges
+    """
+    # unit bins are counts (beds, baths, cars) so centre them on whole numbers
+    return {column: bin_edges(spec['range'], spec['bin_size'], discrete=spec['bin_size'] == 1)
+            for column, spec in specs.items()}
+
+
+class HistogramCache:
+    """Bin counts of every histogram column, computed once per suburb and city-wide
+
+    Clicking a suburb then costs an array lookup no matter how many sales it has.
+    """
+
+    def __init__(self, edges, counts):
+        """
+        :param edges: dict of column -> bin edges
+        :param counts: dict of column -> (n_suburbs, n_bins) counts in SuburbIndex order
+        """
+        self.edges = edges
+        self.counts = counts
+        self.totals = {column: column_counts.sum(axis=0) for column, column_counts in counts.items()}
+
+    @classmethod
+    def build(cls, index, specs):
+        """Count the bins of every histogram column
+
+        :param index: SuburbIndex over the sales dataframe, counts are stored in its suburb order
+        :param specs: dict of column -> dict with 'range' (x limits) and 'bin_size'
+        :return: HistogramCache
+        """
+        return cls.count(index, spec_edges(specs))
+
+    @classmethod
+    def count(cls, index, edges):
+        """Count the bins of every histogram column on given edges
+
+        :param index: SuburbIndex over the sales dataframe
+        :param edges: dict of column -> bin edges
+        :return: HistogramCache
+        """
+        counts = {column: bin_counts(index.rows[column].values, index.codes, len(index), column_edges)
+                  for column, column_edges in edges.items()}
+
+        return cls(edges, counts)
+
+    def reindex(self, positions, n_suburbs):
+        """Move the counts to new suburb positions, e.g. after new suburbs were added
+
+        :param positions: new position of every current suburb
+        :param n_suburbs: number of suburbs after the move
+        :return: HistogramCache
+        """
+        counts = {}
+        for column, column_counts in self.counts.items():
+            counts[column] = np.zeros((n_suburbs, column_counts.shape[1]), dtype=column_counts.dtype)
+            counts[column][positions] = column_counts
+
+        return HistogramCache(self.edges, counts)
+
+    def merge(self, other):
+        """Counts of both caches added, they must share their edges and suburb positions"""
+        return HistogramCache(self.edges, {column: self.counts[column] + other.counts[column] for column in self.counts})
+
+    def get(self, column, position=None):
+        """Bin counts for a column in a suburb, or city-wide when position is None
+
+        :param column: histogram column
+        :param position: suburb position from SuburbIndex.locate, or an array of them for the summed counts of
+            several suburbs
+        :return: (edges, counts)
+        """
+        if position is None:
+            return self.edges[column], self.totals[column]
+
+        if np.ndim(position):
+            position = np.asarray(position, dtype='int64')
+            return self.edges[column], self.counts[column][position[position >= 0]].sum(axis=0)
+
+        if position < 0:
+            return self.edges[column], np.zeros_like(self.totals[column])
+
+        return self.edges[column], self.counts[column][position]
@@ -0,0 +1,169 @@
+"""Incremental ingestion of new sales
+
+New sales arrive as CSV files (same columns as prices_data.csv) dropped into data/incoming, each followed by an
+empty <name>.csv.done marker once it is written. Each batch is turned into its own histogram bins and monthly
+cube, merged into the current artifacts and published as new Artifacts in one reference swap, so readers see
+either all of a batch or none of it. Nothing is recomputed from the full sales table: bins are added, sketches
+are merged, the batch's rows are inserted among the sorted sales and only the suburbs in the batch get new
+medians.
+"""
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from artifacts import Artifacts
+from cube import MonthlyCube
+from datastore import compact
+from histograms import HistogramCache
+from price_ranks import PriceRanks
+from suburb_index import SuburbIndex
+
+INCOMING_DIR = os.path.join('data', 'incoming')
+
+# seconds between scans of the incoming directory
+POLL_INTERVAL = 30
+
+# a batch is complete once an empty file of its name with this suffix exists, e.g. sales-0001.csv.done
+DONE_SUFFIX = '.done'
+
+
+def read_batch(path):
+    """Read a CSV of new sales indexed by Date, in the compact dtypes of the sales table"""
+    return compact(pd.read_csv(path, parse_dates=True, index_col='Date'))
+
+
+def merge_aggregates(suburb_index, histogram_cache, cube, batch, keep_rows=True):
+    """Add a batch of sales to a suburb index and the histogram bins and monthly cube in its order
+
+    The batch is counted on its own and added to the existing counts, which are only moved to make room
+    for new suburbs.
+
+    :param suburb_index: SuburbIndex
+    :param histogram_cache: HistogramCache in suburb_index order
+    :param cube: MonthlyCube in suburb_index order
+    :param batch: dataframe of new sales with the columns of suburb_index.rows
+    :param keep_rows: add the batch's rows to the index
+    :return: (suburb_index, histogram_cache, cube, batch_index) where batch_index is the batch on its own in the new
+        suburb order
+    """
+    suburb_index, positions = suburb_index.append(batch, keep_rows)
+    n_suburbs = len(suburb_index)
+
+    batch = batch[suburb_index.rows.columns].copy()
+    batch[suburb_index.group] = pd.Categorical(batch[suburb_index.group].astype(object),
+                                               categories=suburb_index.suburbs)
+    batch_index = SuburbIndex(batch, suburb_index.group)
+
+    histogram_cache = histogram_cache.reindex(positions, n_suburbs).merge(
+        HistogramCache.count(batch_index, histogram_cache.edges))
+    cube = cube.reindex(positions, n_suburbs).merge(MonthlyCube.build(batch_index, cube.edges, cube.mappings))
+
+    return suburb_index, histogram_cache, cube, batch_index
+
+
+def merge_batch(artifacts, batch):
+    """New artifacts with a batch of sales added
+
+    Medians of the suburbs in the batch are taken from their merged sketches (exact for bedrooms,
+    bathrooms and carspaces, within the sketch's relative accuracy for prices), the other suburbs keep
+    theirs. Suburbs that had no sales before get stats but only appear on the map after a full rebuild,
+    as the map only holds the polygons of suburbs with sales.
+
+    :param artifacts: current Artifacts
+    :param batch: dataframe of new sales
+    :return: Artifacts
+    """
+    # artifacts built from aggregates only (see streaming.py) don't start holding rows either
+    suburb_index, histogram_cache, cube, batch_index = merge_aggregates(
+        artifacts.suburb_index, artifacts.histogram_cache, artifacts.cube, batch, keep_rows=len(artifacts.df) > 0)
+
+    # new medians for the suburbs in the batch only
+    affected = np.unique(batch_index.codes[batch_index.codes >= 0])
+    median_statistics = artifacts.median_statistics.reindex(suburb_index.suburbs)
+    for column in cube.mappings:
+        if column in median_statistics.columns:
+            median_statistics.iloc[affected, median_statistics.columns.get_loc(column)] = \
+                cube.suburb_medians(column, 0, cube.n_months - 1, affected)
+
+    # only the colours of the map change, the geometry is shared with the previous figure
+    trace = dict(artifacts.figure['data'][0], z=median_statistics['sellPrice'].reindex(artifacts.map_suburbs).values)
+    figure = dict(artifacts.figure, data=[trace] + list(artifacts.figure['data'][1:]))
+
+    digest = hashlib.sha1(pd.util.hash_pandas_object(batch, index=True).values.tobytes())
+    digest.update(str(artifacts.version).encode())
+
+    merged = Artifacts(suburb_index, median_statistics, artifacts.map_suburbs, histogram_cache, cube, figure,
+                       artifacts.detail, version=digest.hexdigest()[:16])
+
+    # the batch's price CDFs are merged into the current ones, CDFs of aggregates only come from the cube
+    ranks = artifacts.extras.get('ranks')
+    if ranks is not None and len(artifacts.df):
+        merged.extras['ranks'] = ranks.merge(PriceRanks.from_index(batch_index, 'sellPrice'),
+                                             suburb_index.suburbs.get_indexer(artifacts.suburb_index.suburbs))
+
+    return merged
+
+
+class IncomingWatcher(threading.Thread):
+    """Background thread ingesting every new CSV file that appears in a directory
+
+    A file is only read once it is complete, i.e. once its DONE_SUFFIX marker exists: write the CSV, then create
+    the marker. Files are processed in name order and never moved, so each gunicorn worker can watch the same
+    directory. Every file is ingested once per process, a file changed after that is ignored as its first version
+    is already in the data; new sales go in a new file.
+    """
+
+    def __init__(self, ingest, directory=INCOMING_DIR, interval=POLL_INTERVAL):
+        """
+        :param ingest: function called with the dataframe of every new file
+        :param directory: directory to watch
+        :param interval: seconds between scans
+        """
+        super().__init__(name='incoming-watcher', daemon=True)
+        self.ingest = ingest
+        self.directory = directory
+        self.interval = interval
+        # name -> (size, mtime) of the files ingested, and of the files that failed to, which are retried once changed
+        self.ingested = {}
+        self.failed = {}
+        self.stopped = threading.Event()
+
+    def scan(self):
+        """Ingest the complete files that weren't ingested yet"""
+        if not os.path.isdir(self.directory):
+            return
+
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.csv') or not os.path.isfile(path) or not os.path.exists(path + DONE_SUFFIX):
+                continue
+
+            stat = os.stat(path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if name in self.ingested:
+                if self.ingested[name] != signature:
+                    print('{0} changed after it was ingested, the changes are ignored'.format(path))
+                    self.ingested[name] = signature
+                continue
+            if self.failed.get(name) == signature:
+                continue
+
+            try:
+                self.ingest(read_batch(path))
+            except Exception as e:
+                print('could not ingest {0}: {1}'.format(path, e))
+                self.failed[name] = signature
+                continue
+            self.ingested[name] = signature
+            self.failed.pop(name, None)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.scan()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
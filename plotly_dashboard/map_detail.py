@@ -0,0 +1,140 @@
+"""Level-of-detail suburb geometry for the choropleth
+
+The map starts with a coarse copy of every suburb polygon, simplified to about a pixel at the initial
+zoom. As the user zooms in, finer tiers are sent, and at street level only the suburbs within (a margin
+around) the viewport. Every tier holds the same suburbs with the same feature ids, so the colours, the
+selection and the hover stay as they are when the geometry is swapped.
+"""
+import functools
+import json
+import math
+import os
+
+import numpy as np
+import shapely
+from plotly.utils import PlotlyJSONEncoder
+from shapely.geometry import mapping
+
+from geodata import PRECISION, TOLERANCE, pack_coordinates, simplify_geometry
+
+# simplification tolerance in degrees and decimal places kept from the zoom each tier is shown at, a pixel
+# is about 0.0007 degrees at zoom 10
+DETAIL_TIERS = [dict(min_zoom=0, tolerance=0.003, precision=3),
+                dict(min_zoom=9.5, tolerance=0.001, precision=4),
+                dict(min_zoom=11, tolerance=TOLERANCE, precision=PRECISION)]
+
+# from this zoom on only the suburbs around the viewport are sent
+VIEWPORT_ZOOM = 11
+
+# map size assumed when the browser doesn't report the viewport's corners
+VIEWPORT_PIXELS = (1200, 450)
+
+
+def viewport(relayout):
+    """(west, south, east, north) of the map shown after a relayout, None when it isn't a pan or zoom
+
+    :param relayout: the map's relayoutData
+    """
+    corners = (relayout.get('mapbox._derived') or {}).get('coordinates')
+    if corners:
+        lon, lat = np.asarray(corners, dtype='float64').T
+        return lon.min(), lat.min(), lon.max(), lat.max()
+
+    center, zoom = relayout.get('mapbox.center'), relayout.get('mapbox.zoom')
+    if center is None or zoom is None:
+        return None
+
+    # degrees per pixel of web mercator tiles of 512 pixels
+    width = 360 / (512 * 2 ** zoom) * VIEWPORT_PIXELS[0]
+    height = width * VIEWPORT_PIXELS[1] / VIEWPORT_PIXELS[0] * math.cos(math.radians(center['lat']))
+
+    return center['lon'] - width / 2, center['lat'] - height / 2, center['lon'] + width / 2, center['lat'] + height / 2
+
+
+def snap(bounds):
+    """Bounds grown by half their size on every side and snapped to a grid of that size
+
+    Small pans then map to the same bounds, so they send nothing new.
+    """
+    west, south, east, north = bounds
+    step = 2 ** math.ceil(math.log2(max(east - west, north - south, 1e-6)))
+    half = step / 2
+
+    return (math.floor((west - half) / half) * half, math.floor((south - half) / half) * half,
+            math.ceil((east + half) / half) * half, math.ceil((north + half) / half) * half)
+
+
+class MapDetail:
+    """Suburb polygons at several levels of detail, each a list of GeoJSON features with packed coordinates"""
+
+    def __init__(self, tiers, bounds):
+        """
+        :param tiers: list of dicts of DETAIL_TIERS settings with the tier's 'features', in increasing zoom
+        :param bounds: (n_features, 4) array of the (west, south, east, north) of every feature
+        """
+        self.tiers = tiers
+        self.bounds = np.asarray(bounds, dtype='float64')
+
+    @classmethod
+    def build(cls, geometries, ids, mapper=map):
+        """
+        :param geometries: shapely polygons of the suburbs, e.g. sydney.geometry
+        :param ids: feature id of every polygon, the choropleth's locations
+        :param mapper: map function the polygons are simplified with, e.g. a process pool's
+        """
+        shapes = [mapping(geometry) for geometry in geometries]
+        tiers = []
+        for settings in DETAIL_TIERS:
+            simplified = mapper(functools.partial(simplify_geometry, tolerance=settings['tolerance'],
+                                                  precision=settings['precision']), shapes)
+            features = [{'type': 'Feature', 'id': suburb,
+                         'geometry': dict(geometry, coordinates=pack_coordinates(geometry['coordinates']))}
+                        for suburb, geometry in zip(ids, simplified)]
+            tiers.append(dict(settings, features=features))
+
+        return cls(tiers, shapely.bounds(np.asarray(geometries)))
+
+    def level(self, zoom):
+        """Tier shown at a zoom"""
+        return max(level for level, tier in enumerate(self.tiers) if tier['min_zoom'] <= zoom)
+
+    def geojson(self, level, bounds=None):
+        """FeatureCollection of a tier, with the features intersecting bounds only when given"""
+        features = self.tiers[level]['features']
+        if bounds is not None:
+            west, south, east, north = bounds
+            inside = (self.bounds[:, 0] <= east) & (self.bounds[:, 2] >= west) & \
+                     (self.bounds[:, 1] <= north) & (self.bounds[:, 3] >= south)
+            features = [features[i] for i in np.flatnonzero(inside)]
+
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def view(self, relayout):
+        """(tier, bounds) to show after a relayout of the map, bounds None when every suburb is sent
+
+        :param relayout: the map's relayoutData
+        :return: tuple, None when the relayout isn't a pan or zoom
+        """
+        zoom = relayout.get('mapbox.zoom')
+        bounds = viewport(relayout)
+        if zoom is None or bounds is None:
+            return None
+
+        return self.level(zoom), (snap(bounds) if zoom >= VIEWPORT_ZOOM else None)
+
+    def save(self, path):
+        """Write the tiers to a directory"""
+        np.save(os.path.join(path, 'map_detail.bounds.npy'), self.bounds)
+        with open(os.path.join(path, 'map_detail.json'), 'w') as f:
+            json.dump(self.tiers, f, cls=PlotlyJSONEncoder)
+
+    @classmethod
+    def load(cls, path):
+        """Tiers written by save"""
+        with open(os.path.join(path, 'map_detail.json')) as f:
+            tiers = json.load(f)
+        for tier in tiers:
+            for feature in tier['features']:
+                feature['geometry']['coordinates'] = pack_coordinates(feature['geometry']['coordinates'])
+
+        return cls(tiers, np.load(os.path.join(path, 'map_detail.bounds.npy')))
@@ -0,0 +1,135 @@
+"""Memory held by the dashboard's data, structure by structure
+
+Arrays memory-mapped from the shared artifacts are reported separately: their pages are shared by every
+worker through the page cache, so only the private bytes grow with the number of workers. Run the app with
+MEMORY_REPORT=1 to print the report once the data is loaded, the same numbers are served on /metrics.
+"""
+import mmap
+import sys
+
+import numpy as np
+import pandas as pd
+import shapely
+
+
+def is_mapped(values):
+    """Whether an array (or any array it is a view of) is memory-mapped from a file"""
+    # a copy of a np.memmap is still a np.memmap, only the mmap it is a view of tells it is mapped
+    while values is not None:
+        if isinstance(values, mmap.mmap):
+            return True
+        values = getattr(values, 'base', None)
+
+    return False
+
+
+def array_size(values, seen=None):
+    """(bytes, mapped) of an array, a pandas categorical counts its codes and categories
+
+    :param values: array
+    :param seen: set of the buffers and objects counted so far, memory shared with them counts as 0
+    """
+    seen = set() if seen is None else seen
+    if isinstance(values, pd.Categorical):
+        codes, mapped = array_size(values.codes, seen)
+        return codes + array_size(values.categories.values, seen)[0], mapped
+
+    values = np.asarray(values)
+    address = (values.__array_interface__['data'][0], values.nbytes)
+    size = 0 if address in seen else values.nbytes
+    seen.add(address)
+
+    if values.dtype == object:
+        for value in values.ravel():
+            if id(value) not in seen:
+                seen.add(id(value))
+                size += sys.getsizeof(value)
+
+    return size, is_mapped(values)
+
+
+def object_size(value, seen=None):
+    """Bytes held by nested dicts, lists and scalars, e.g. a figure dict, counting shared objects once"""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return array_size(value, seen)[0]
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(object_size(k, seen) + object_size(v, seen) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(object_size(item, seen) for item in value)
+    if hasattr(value, '__dict__'):
+        # e.g. the PriceRanks kept with the artifacts
+        return sys.getsizeof(value) + object_size(vars(value), seen)
+
+    return sys.getsizeof(value)
+
+
+def frame_sizes(name, frame, seen):
+    """(name, bytes, mapped) of the index and every column of a dataframe"""
+    sizes = [('{0}.index'.format(name),) + array_size(frame.index.values, seen)]
+    for column in frame.columns:
+        values = frame[column].array if isinstance(frame[column].dtype, pd.CategoricalDtype) else frame[column].values
+        sizes.append(('{0}.{1}'.format(name, column),) + array_size(values, seen))
+
+    return sizes
+
+
+def artifact_sizes(artifacts, locator=None):
+    """Memory of every structure the dashboard serves from
+
+    Memory shared between structures (e.g. the suburb codes of the rows and of the suburb index, the suburb
+    names) is counted for the first one only.
+
+    :param artifacts: Artifacts
+    :param locator: SuburbLocator of the point lookups
+    :return: list of (structure, bytes, mapped)
+    """
+    seen = set()
+    index = artifacts.suburb_index
+    sizes = [('suburbs',) + array_size(index.suburbs.values, seen)]
+    sizes += frame_sizes('rows', index.rows, seen)
+    sizes += [('suburb_index.codes',) + array_size(index.codes, seen),
+              ('suburb_index.offsets',) + array_size(index.offsets, seen)]
+    sizes += frame_sizes('median_statistics', artifacts.median_statistics, seen)
+    sizes.append(('map_suburbs',) + array_size(artifacts.map_suburbs.values, seen))
+
+    for column, counts in artifacts.histogram_cache.counts.items():
+        sizes.append(('histograms.{0}'.format(column),) + array_size(counts, seen))
+
+    cube = artifacts.cube
+    cells = [array_size(values, seen) for values in (cube.cell_suburb, cube.cell_month, cube.suburb_offsets)]
+    sizes.append(('cube.cells', sum(size for size, _ in cells), cells[0][1]))
+    for part in ('bins', 'sketches'):
+        for column, counts in getattr(cube, part).items():
+            arrays = [array_size(values, seen) for values in (counts.offsets, counts.keys, counts.counts)]
+            sizes.append(('cube.{0}.{1}'.format(part, column), sum(size for size, _ in arrays), arrays[1][1]))
+
+    sizes.append(('map_figure', object_size(artifacts.figure, seen), False))
+    sizes.append(('map_detail', object_size(artifacts.detail, seen), False))
+    if artifacts.extras:
+        sizes.append(('extras', object_size(artifacts.extras, seen), False))
+
+    if locator is not None:
+        # coordinates as doubles, plus the suburb names
+        sizes.append(('suburb_locator', int(shapely.get_num_coordinates(locator.geometries).sum()) * 16 +
+                      array_size(locator.suburbs, seen)[0], False))
+
+    return sizes
+
+
+def format_sizes(sizes):
+    """Memory report of artifact_sizes as a text table, largest private structures first"""
+    lines = ['{0:<32}{1:>12}{2:>10}'.format('structure', 'kB', 'mapped')]
+    for name, size, mapped in sorted(sizes, key=lambda item: (item[2], -item[1])):
+        lines.append('{0:<32}{1:>12.1f}{2:>10}'.format(name, size / 1024, 'yes' if mapped else ''))
+
+    private = sum(size for _, size, mapped in sizes if not mapped)
+    shared = sum(size for _, size, mapped in sizes if mapped)
+    lines.append('{0:<32}{1:>12.1f}'.format('private total', private / 1024))
+    lines.append('{0:<32}{1:>12.1f}'.format('mapped total', shared / 1024))
+
+    return '\n'.join(lines)
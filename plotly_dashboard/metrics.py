@@ -0,0 +1,196 @@
+"""Timings, counters and payload sizes exposed in the Prometheus text format
+
+Every request to the Dash server is timed and its response size recorded, labelled with the callback it
+ran (or the route it hit), and startup phases are timed where they run. Scrape them from /metrics. Each
+gunicorn worker keeps its own numbers, so a scrape through the load balancer sees one worker at a time.
+
+With a profile directory set, any request carrying an `X-Profile: 1` header or a `profile=1` query
+parameter is run under cProfile and its stats written there, for `python -m pstats` or snakeviz.
+"""
+import cProfile
+import functools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+# latency buckets in seconds and payload buckets in bytes
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def format_labels(labels):
+    """Prometheus label set, e.g. {endpoint="update_selection"}"""
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms"""
+
+    def __init__(self):
+        self.kinds = {}
+        self.helps = {}
+        self.buckets = {}
+        self.values = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, description, buckets=SECONDS_BUCKETS):
+        """Declare a metric
+
+        :param name: metric name, counters end in _total
+        :param kind: 'counter', 'gauge' or 'histogram'
+        :param description: help text shown by Prometheus
+        :param buckets: upper bounds of a histogram's buckets
+        """
+        self.kinds[name] = kind
+        self.helps[name] = description
+        if kind == 'histogram':
+            self.buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge"""
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.buckets[name]
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(buckets), 0.0, 0))
+            counts = [n + (value <= bound) for n, bound in zip(counts, buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Time a block into a histogram, or into a gauge for things that run once like startup phases"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.kinds[name] == 'histogram':
+                self.observe(name, elapsed, **labels)
+            else:
+                self.set(name, elapsed, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator timing every call of a function"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(name, **labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def samples(self, name):
+        """Current values of a metric, as a dict of label tuple -> value"""
+        with self.lock:
+            return {labels: value for (sample, labels), value in self.values.items() if sample == name}
+
+    def collect(self, function):
+        """Register a function returning (name, labels dict, value) samples read at every scrape"""
+        self.collectors.append(function)
+
+        return function
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        with self.lock:
+            values = dict(self.values)
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                values[(name, tuple(sorted(labels.items())))] = value
+
+        lines = []
+        for name in self.kinds:
+            lines.append('# HELP {0} {1}'.format(name, self.helps[name]))
+            lines.append('# TYPE {0} {1}'.format(name, self.kinds[name]))
+
+            for (sample, labels), value in sorted(values.items()):
+                if sample != name:
+                    continue
+
+                if self.kinds[name] != 'histogram':
+                    lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+                    continue
+
+                counts, total, count = value
+                for bound, n in zip(self.buckets[name] + ('+Inf',), counts + [count]):
+                    lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels + (('le', bound),)), n))
+                lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), total))
+                lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def instrument(app, metrics, profile_dir=None):
+    """Time every request to a Dash app's server, record response sizes and serve /metrics
+
+    Call it before any other before_request hook is registered (e.g. ResponseCache), so requests answered by
+    those hooks are measured too.
+
+    :param app: the Dash app
+    :param metrics: Metrics to record into
+    :param profile_dir: directory for cProfile stats of requests that ask for them, None disables profiling
+    """
+    server = app.server
+    metrics.describe('http_request_duration_seconds', 'histogram', 'Time to answer a request, by callback or route')
+    metrics.describe('http_response_bytes', 'histogram', 'Size of the response body as sent, by callback or route',
+                     BYTES_BUCKETS)
+
+    def endpoint():
+        if request.path.endswith('/_dash-update-component'):
+            body = request.get_json(silent=True) or {}
+            callback = app.callback_map.get(body.get('output'), {}).get('callback')
+            return getattr(callback, '__name__', 'unknown')
+
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @server.before_request
+    def start():
+        g.metrics_start = time.perf_counter()
+        if profile_dir is not None and (request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1'):
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    @server.after_request
+    def stop(response):
+        profile = g.pop('profile', None)
+        name = endpoint()
+        if profile is not None:
+            profile.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, '{0}-{1}-{2}.prof'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                                                       re.sub(r'\W+', '_', name).strip('_'), os.getpid()))
+            profile.dump_stats(path)
+            response.headers['X-Profile-File'] = path
+
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - start, endpoint=name)
+        if not response.direct_passthrough:
+            metrics.observe('http_response_bytes', response.calculate_content_length() or 0, endpoint=name)
+
+        return response
+
+    @server.route('/metrics')
+    def serve_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,320 @@
+"""Build of everything the dashboard derives from its input data
+
+The sales data and the suburb boundaries are turned into the dashboard's artifacts here (see artifacts.py): the
+suburb medians, the per-suburb histogram bins, the monthly cube, the boundaries merged with the medians and the
+map figure. The app runs this at startup unless a version for the current inputs was already built, so a deploy
+can ship with the artifacts built ahead of time:
+
+    $ python pipeline.py --workers 8
+
+Versions are named after the content hashes of the inputs and the settings, so building again with unchanged
+inputs does nothing, and when only the suburb boundaries changed the sales aggregates are copied from the
+previous version instead of being counted again.
+
+The work for every metric (histogram bins, monthly cube and medians of a column) and for every suburb
+(simplifying its boundary) is spread over a pool of processes.
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+import plotly.express as px
+
+from artifacts import ARTIFACTS_DIR, Artifacts, artifacts_key, find_artifacts, load_artifacts, shared_artifacts
+from cube import MonthlyCube
+from datastore import PRICES_CSV, PRICES_STORE, load_prices
+from geodata import GEOJSON_CACHE, PRECISION, SIMPLIFIED_CACHE, TOLERANCE, load_suburbs
+from histograms import HistogramCache, spec_edges
+from map_detail import DETAIL_TIERS, MapDetail
+from metrics import Metrics
+from sketches import LinearMapping, LogMapping
+from streaming import fold, fold_medians, merge_folds, read_chunks
+from suburb_index import SuburbIndex
+
+# check for tokens
+token = os.getenv('MAPBOX_TOKEN')
+mapbox_style = "dark"
+if not token:
+    try:
+        token = open('.mapbox_token').read()
+    except Exception as e:
+        print('mapbox token not found, using open-street-maps')
+        mapbox_style = "carto-darkmatter"
+
+# zoom the map opens at, it is sent with the geometry of this zoom's detail tier (see map_detail.py)
+INITIAL_ZOOM = 10
+
+# histogram columns with the graph they are drawn in, axis label, x limits and bin width
+hist_specs = {'bed': dict(graph='bed', label='Number of Beds', range=[0, 10], bin_size=1,
+                          title='Number of Beds Histogram'),
+              'sellPrice': dict(graph='sell', label='Selling Price in Millions (AUD)', range=[0, 2500000],
+                                bin_size=50000, title='Selling Property Price Histogram'),
+              'car': dict(graph='car', label='Number of Cars', range=[0, 10], bin_size=1,
+                          title='Number of Cars Histogram'),
+              'bath': dict(graph='bath', label='Number of Baths', range=[0, 10], bin_size=1,
+                           title='Number of Bathrooms Histogram')}
+
+# quantile sketches behind the medians of a date range, in the order of the dashboard's stats
+sketch_specs = {'sellPrice': LogMapping(0.01, 10000, 1e9),
+                'bed': LinearMapping(50),
+                'bath': LinearMapping(50),
+                'car': LinearMapping(50)}
+
+# sales of the build in progress, pool workers are forked after it is set and read it instead of receiving a copy
+_suburb_index = None
+
+
+@contextmanager
+def process_pool(workers):
+    """map function running on a pool of forked processes, or the builtin map for a single worker"""
+    if workers <= 1:
+        yield map
+        return
+
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        yield pool.map
+
+
+def count_column(task):
+    """Histogram bins, monthly cube and suburb medians of one column of the sales being built
+
+    :param task: (column, bin edges, sketch mapping)
+    :return: (HistogramCache, MonthlyCube, medians series)
+    """
+    column, edges, mapping = task
+    index = _suburb_index
+
+    histogram_cache = HistogramCache.count(index, {column: edges})
+    cube = MonthlyCube.build(index, {column: edges}, {column: mapping})
+    medians = index.rows.groupby(index.group, observed=True)[column].median()
+
+    return histogram_cache, cube, medians
+
+
+def fold_part(task):
+    """Aggregates of every column folded in one pass over the chunks of one part of the sales, see streaming.py
+
+    :param task: (part, number of parts, bin edges, sketch mappings, rows per chunk)
+    :return: (SuburbIndex without rows, HistogramCache, MonthlyCube), None when the part has no sales
+    """
+    part, parts, edges, mappings, chunk_rows = task
+
+    return fold(read_chunks(['suburb'] + list(mappings), chunk_rows=chunk_rows, part=part, parts=parts),
+                edges, mappings)
+
+
+def join_columns(results):
+    """HistogramCache, MonthlyCube and median table of the per-column results"""
+    edges = {}
+    counts = {}
+    for histogram_cache, _, _ in results:
+        edges.update(histogram_cache.edges)
+        counts.update(histogram_cache.counts)
+
+    cube = MonthlyCube.join([cube for _, cube, _ in results])
+    median_statistics = pd.concat([medians for _, _, medians in results], axis=1)
+
+    return HistogramCache(edges, counts), cube, median_statistics
+
+
+def load_boundaries(metrics, mapper=map):
+    """Suburb polygons with a title-case suburb column
+
+    :param metrics: Metrics the load is timed in
+    :param mapper: map function the boundaries are simplified with when the simplified file is stale
+    """
+    # simplified suburb boundaries from the local cache (see geodata.py)
+    with metrics.time('startup_phase_seconds', phase='load_suburbs'):
+        sydney = load_suburbs(mapper=mapper)
+
+    # cleaning the geopandas dataframe
+    sydney = sydney[["geometry", "nsw_loca_2"]]
+    sydney.rename(columns={"nsw_loca_2": "suburb"}, inplace=True)
+
+    # change to proper nouns to match our geojson file
+    sydney.suburb = sydney.suburb.str.title()
+
+    return sydney
+
+
+def build_sales(metrics, chunk_rows=0, workers=1):
+    """Aggregates of the sales data
+
+    :param metrics: Metrics the phases are timed in
+    :param chunk_rows: fold the aggregates from chunks of this many rows, 0 loads the sales whole
+    :param workers: number of processes
+    :return: (suburb_index, median_statistics, histogram_cache, cube)
+    """
+    global _suburb_index
+
+    edges = spec_edges(hist_specs)
+
+    if chunk_rows:
+        # every worker folds all columns from chunks of its own part of the rows, all rows are never in memory at once
+        parts = max(workers, 1)
+        with metrics.time('startup_phase_seconds', phase='aggregate_chunks'), process_pool(workers) as mapper:
+            folded = merge_folds(list(mapper(fold_part, [(part, parts, edges, sketch_specs, chunk_rows)
+                                                         for part in range(parts)])))
+        if folded is None:
+            raise ValueError('no sales to aggregate')
+
+        suburb_index, histogram_cache, cube = folded
+        median_statistics = fold_medians(suburb_index, cube, sketch_specs)
+
+        return suburb_index, median_statistics, histogram_cache, cube
+
+    # import dataframe from the columnar store (see datastore.py), falls back to data/prices_data.csv
+    with metrics.time('startup_phase_seconds', phase='load_prices'):
+        df = load_prices()
+
+    # sales sorted by suburb with each suburb's row offsets
+    with metrics.time('startup_phase_seconds', phase='suburb_index'):
+        suburb_index = SuburbIndex(df)
+
+    # medians of the stat card columns, bin counts per suburb and for all of Sydney so clicks never rescan df, and the
+    # same bins and median sketches per suburb and month for the date range slider, one column per worker
+    _suburb_index = suburb_index
+    try:
+        with metrics.time('startup_phase_seconds', phase='columns'), process_pool(workers) as mapper:
+            results = list(mapper(count_column, [(column, edges[column], mapping)
+                                                 for column, mapping in sketch_specs.items()]))
+    finally:
+        _suburb_index = None
+
+    histogram_cache, cube, median_statistics = join_columns(results)
+
+    return suburb_index, median_statistics, histogram_cache, cube
+
+
+def build_artifacts(metrics, chunk_rows=0, workers=1, reuse=None, version='0'):
+    """Load the sales data and suburb boundaries and derive everything the dashboard shows
+
+    :param metrics: Metrics the phases are timed in, needs startup_phase_seconds
+    :param chunk_rows: fold the aggregates from chunks of this many rows, 0 loads the sales whole
+    :param workers: number of processes
+    :param reuse: artifact directory to take the sales aggregates from instead of building them
+    :param version: data version of the artifacts, see input_version
+    :return: Artifacts
+    """
+    if reuse is not None:
+        with metrics.time('startup_phase_seconds', phase='reuse_sales'):
+            previous = load_artifacts(reuse, sketch_specs)
+        suburb_index, median_statistics = previous.suburb_index, previous.median_statistics
+        histogram_cache, cube = previous.histogram_cache, previous.cube
+    else:
+        suburb_index, median_statistics, histogram_cache, cube = build_sales(metrics, chunk_rows, workers)
+
+    with process_pool(workers) as mapper:
+        sydney = load_boundaries(metrics, mapper)
+
+    # Create merged geopandas df
+    with metrics.time('startup_phase_seconds', phase='merge'):
+        geo_house_prices = pd.merge(sydney, median_statistics, left_on="suburb", right_on=median_statistics.index,
+                                    how="inner")
+        geo_house_prices.set_index("suburb", inplace=True)
+
+    # every suburb polygon at each level of detail, the map starts with the tier of its initial zoom
+    with process_pool(workers) as mapper, metrics.time('startup_phase_seconds', phase='map_detail'):
+        detail = MapDetail.build(geo_house_prices.geometry.values, geo_house_prices.index, mapper)
+
+    # Choropleth Map
+    # -----------------------------------------------------------------------------------------------------------------
+    with metrics.time('startup_phase_seconds', phase='figure'):
+        fig = px.choropleth_mapbox(geo_house_prices,
+                                   geojson=detail.geojson(detail.level(INITIAL_ZOOM)),
+                                   locations=geo_house_prices.index, color='sellPrice',
+                                   color_continuous_scale="viridis",
+                                   center={"lat": -33.865143, "lon": 151.209900},
+                                   range_color=(0, 2000000),
+                                   labels={"sellPrice": "Selling Price", "suburb": "Suburb"},
+                                   opacity=0.6,
+                                   zoom=INITIAL_ZOOM
+                                   )
+
+        fig.update_layout(mapbox_style="dark",
+                          template='plotly_dark',
+                          mapbox_accesstoken=token,
+                          autosize=True,
+                          plot_bgcolor='rgba(0, 0, 0, 0)',
+                          paper_bgcolor='rgba(0, 0, 0, 0)',
+                          margin=dict(l=0, r=0, t=0, b=0),
+                          # keep the user's zoom and pan when the figure is patched
+                          uirevision='map',
+                          # a click selects its suburb, shift-click, lasso and box select add more
+                          clickmode='event+select'
+                          )
+        fig.update_coloraxes(colorbar_title=dict(side='right', text='Selling Price in Millions (AUD)'),
+                             colorbar=dict(x=0.92, xpad=0))
+        fig.update_geos(fitbounds="locations", visible=False)
+
+    return Artifacts(suburb_index, median_statistics, geo_house_prices.index, histogram_cache, cube, fig, detail,
+                     version=version)
+
+
+def input_keys(chunk_rows=0, root=ARTIFACTS_DIR):
+    """Versions of the inputs of each part of the build, from the content of the input files and the settings
+
+    :param chunk_rows: rows per chunk the sales are folded from, 0 for whole
+    :param root: directory holding every artifact version
+    :return: dict with the 'sales' version of the aggregates and the 'boundaries' version of the map
+    """
+    # derived copies (the columnar store, the simplified boundaries) only count when their source is missing
+    sales = artifacts_key([PRICES_CSV if os.path.exists(PRICES_CSV) else PRICES_STORE],
+                          [{x: [spec['range'], spec['bin_size']] for x, spec in hist_specs.items()}, chunk_rows,
+                           {x: m.settings() for x, m in sketch_specs.items()}], root)
+    boundaries = artifacts_key([GEOJSON_CACHE if os.path.exists(GEOJSON_CACHE) else SIMPLIFIED_CACHE],
+                               [TOLERANCE, PRECISION, DETAIL_TIERS, INITIAL_ZOOM, token], root)
+
+    return {'sales': sales, 'boundaries': boundaries}
+
+
+def input_version(chunk_rows=0, root=ARTIFACTS_DIR):
+    """Version of the artifacts of the current inputs, the name dashboard_artifacts stores them under
+
+    Artifacts built in-process carry it too, so anything kept across restarts by data version (e.g. the shared
+    response cache) is never served for other data.
+    """
+    return artifacts_key([], input_keys(chunk_rows, root), root)
+
+
+def dashboard_artifacts(metrics, chunk_rows=0, workers=1, root=ARTIFACTS_DIR):
+    """Attach to the artifacts of the current inputs, building them first when no process has yet
+
+    :param metrics: Metrics the phases of a build are timed in
+    :param chunk_rows: rows per chunk the sales are folded from, 0 for whole
+    :param workers: number of processes for a build
+    :param root: directory holding every artifact version
+    :return: (Artifacts memory-mapped from root, whether they were built by this call)
+    """
+    keys = input_keys(chunk_rows, root)
+    built = []
+
+    def build():
+        built.append(True)
+        return build_artifacts(metrics, chunk_rows, workers, find_artifacts(root, 'sales', keys['sales']))
+
+    artifacts = shared_artifacts(build, artifacts_key([], keys, root), sketch_specs, root, inputs=keys)
+
+    return artifacts, bool(built)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the dashboard artifacts for the current input data')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--chunk-rows', type=int, default=int(os.getenv('CHUNK_ROWS', 0)),
+                        help='fold the sales from chunks of this many rows, as the app does with CHUNK_ROWS')
+    parser.add_argument('--root', default=ARTIFACTS_DIR, help='directory holding the artifact versions')
+    args = parser.parse_args()
+
+    build_metrics = Metrics()
+    build_metrics.describe('startup_phase_seconds', 'gauge', 'Time spent in each phase of the build')
+
+    start = time.perf_counter()
+    artifacts, built = dashboard_artifacts(build_metrics, args.chunk_rows, args.workers, args.root)
+    print('{0} {1} in {2:.1f}s'.format(os.path.join(args.root, artifacts.version),
+                                       'built' if built else 'is up to date', time.perf_counter() - start))
+    for (name, labels), seconds in build_metrics.values.items():
+        print('  {0}: {1:.2f}s'.format(dict(labels)['phase'], seconds))
@@ -0,0 +1,147 @@
+"""Percentile rank of a price among the sales of a suburb, a selection of suburbs or all of Sydney
+
+Every suburb's prices are held as a compact CDF: its distinct prices in increasing order with the number of
+sales up to each of them, all suburbs in one flat array with an offset table like the suburb index. A price
+is ranked with two binary searches in its suburb's slice, the sales are never filtered or sorted per request.
+"""
+import numpy as np
+import pandas as pd
+
+
+class PriceRanks:
+    """Per-suburb and city-wide CDFs of a price column"""
+
+    def __init__(self, values, cumulative, offsets, city_values, city_cumulative):
+        """
+        :param values: distinct prices of every suburb, sorted within each suburb
+        :param cumulative: (len(values) + 1) running count of sales, cumulative[i + 1] counts up to values[i]
+        :param offsets: (n_suburbs + 1) offsets of every suburb's values
+        :param city_values: distinct prices of all sales, sorted
+        :param city_cumulative: (len(city_values) + 1) running count of sales
+        """
+        self.values = values
+        self.cumulative = cumulative
+        self.offsets = offsets
+        self.city_values = city_values
+        self.city_cumulative = city_cumulative
+
+    @classmethod
+    def from_counts(cls, groups, values, counts, n_groups):
+        """
+        :param groups: suburb position of every (suburb, price) pair, sorted by suburb then price
+        :param values: price of every pair
+        :param counts: number of sales of every pair
+        :param n_groups: number of suburbs
+        """
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        offsets = np.searchsorted(groups, np.arange(n_groups + 1))
+
+        city_values, inverse = np.unique(values, return_inverse=True)
+        city_counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(city_values))
+        city_cumulative = np.concatenate([[0], np.cumsum(city_counts)])
+
+        # counts in the narrowest type that holds them
+        count_type = np.min_scalar_type(int(cumulative[-1]))
+        return cls(values, cumulative.astype(count_type), offsets.astype('int64'), city_values,
+                   city_cumulative.astype(count_type))
+
+    @classmethod
+    def from_index(cls, index, column):
+        """Exact CDFs from the sales rows of a SuburbIndex, prices keep the column's dtype
+
+        :param index: SuburbIndex
+        :param column: price column
+        """
+        prices = index.rows[column].values
+        keep = (index.codes >= 0) & ~pd.isna(prices)
+        codes, prices = index.codes[keep], prices[keep]
+        order = np.lexsort((prices, codes))
+        codes, prices = codes[order], prices[order]
+
+        # first sale of every distinct (suburb, price)
+        starts = np.flatnonzero(np.concatenate([[True], (codes[1:] != codes[:-1]) | (prices[1:] != prices[:-1])]))
+        counts = np.diff(np.append(starts, len(prices)))
+
+        return cls.from_counts(codes[starts], prices[starts], counts, len(index))
+
+    @classmethod
+    def from_cube(cls, cube, column):
+        """CDFs from the quantile sketches of a MonthlyCube, for indexes without rows, within the sketches' accuracy
+
+        :param cube: MonthlyCube
+        :param column: price column with sketches
+        """
+        sketches, mapping = cube.sketches[column], cube.mappings[column]
+        pairs, inverse = np.unique(cube.cell_suburb[sketches.cells].astype('int64') * sketches.size + sketches.keys,
+                                   return_inverse=True)
+        counts = np.bincount(inverse, weights=sketches.counts, minlength=len(pairs)).astype('int64')
+
+        return cls.from_counts(pairs // sketches.size, mapping.value(pairs % sketches.size), counts,
+                               len(cube.suburb_offsets) - 1)
+
+    def merge(self, other, positions):
+        """CDFs of the sales of both, e.g. of the current sales and a batch of new ones
+
+        The other CDFs' (suburb, price) pairs are inserted into this one's, nothing is sorted again.
+
+        :param other: PriceRanks in the merged suburb order
+        :param positions: merged position of every suburb of this one
+        """
+        n_groups = len(other.offsets) - 1
+        groups = np.repeat(np.asarray(positions, dtype='int64'), np.diff(self.offsets))
+        other_groups = np.repeat(np.arange(n_groups), np.diff(other.offsets))
+
+        # (suburb, price) pairs as one sortable key, prices by rank among all distinct prices
+        city_values = np.union1d(self.city_values, other.city_values)
+        keys = groups * len(city_values) + np.searchsorted(city_values, self.values)
+        other_keys = other_groups * len(city_values) + np.searchsorted(city_values, other.values)
+        at = np.searchsorted(keys, other_keys)
+        found = at < len(keys)
+        found[found] = keys[at[found]] == other_keys[found]
+
+        counts = np.diff(self.cumulative).astype('int64')
+        other_counts = np.diff(other.cumulative).astype('int64')
+        counts[at[found]] += other_counts[found]
+        new = ~found
+        values = np.insert(self.values.astype(city_values.dtype, copy=False), at[new], other.values[new])
+        groups = np.insert(groups, at[new], other_groups[new])
+        counts = np.insert(counts, at[new], other_counts[new])
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        offsets = np.searchsorted(groups, np.arange(n_groups + 1))
+
+        city_counts = np.zeros(len(city_values), dtype='int64')
+        for ranks in (self, other):
+            city_counts[np.searchsorted(city_values, ranks.city_values)] += np.diff(ranks.city_cumulative).astype('int64')
+        city_cumulative = np.concatenate([[0], np.cumsum(city_counts)])
+
+        count_type = np.min_scalar_type(int(cumulative[-1]))
+        return PriceRanks(values, cumulative.astype(count_type), offsets.astype('int64'), city_values,
+                          city_cumulative.astype(count_type))
+
+    @staticmethod
+    def rank(values, cumulative, lo, hi, price):
+        """(sales priced below, sales at the price, sales) of the CDF in values[lo:hi]"""
+        below = lo + np.searchsorted(values[lo:hi], price, side='left')
+        upto = lo + np.searchsorted(values[lo:hi], price, side='right')
+
+        return (int(cumulative[below] - cumulative[lo]), int(cumulative[upto] - cumulative[below]),
+                int(cumulative[hi] - cumulative[lo]))
+
+    def percentile(self, price, position=None):
+        """Percentile rank of a price, counting sales at that price as half below it
+
+        :param price: price to rank
+        :param position: suburb position, an array of positions ranked among all their sales, or None for all of
+            Sydney
+        :return: (percentile, number of sales), percentile NaN when there are no sales
+        """
+        if position is None:
+            below, equal, total = self.rank(self.city_values, self.city_cumulative, 0, len(self.city_values), price)
+        else:
+            below = equal = total = 0
+            for p in np.atleast_1d(position):
+                if p >= 0:
+                    counts = self.rank(self.values, self.cumulative, self.offsets[p], self.offsets[p + 1], price)
+                    below, equal, total = below + counts[0], equal + counts[1], total + counts[2]
+
+        return (100 * (below + equal / 2) / total if total else float('nan')), total
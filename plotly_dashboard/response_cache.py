@@ -0,0 +1,380 @@
+"""Pre-serialized, pre-compressed responses for the layout and the selection callbacks
+
+The first response for a key (the layout, or a callback output with its input values) is stored as
+raw, gzip and brotli bodies with an ETag. Later requests are answered from those bytes without running
+the callback, serializing to JSON or compressing again. Conditional GETs with a matching If-None-Match
+get a 304. With a data version, cached responses are dropped as soon as the version changes.
+
+Responses are kept in tiers, looked up in order: an in-process LRU (MemoryTier) and optionally a SQLite file
+shared by every worker on the machine (SharedTier), so a response is computed once per deploy rather than once
+per worker. Both are bounded in bytes and expire entries after a TTL.
+"""
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# every body is compressed once per key, so spend the CPU on smaller responses
+BROTLI_QUALITY = 9
+GZIP_LEVEL = 9
+
+SHARED_DB = os.path.join('data', 'cache', 'responses.sqlite')
+
+
+def callback_id(outputs):
+    """The output string Dash sends for a callback
+
+    :param outputs: an Output or a list of Outputs
+    :return: output id such as 'bed.figure' or '..header.children...price.children..'
+    """
+    if isinstance(outputs, (list, tuple)):
+        return '..' + '...'.join(callback_id(output) for output in outputs) + '..'
+
+    return '{0}.{1}'.format(outputs.component_id, outputs.component_property)
+
+
+def source_version(directory, extensions=('.py', '.js', '.css')):
+    """Digest of the code in a directory, so responses rendered by a previous deploy are never served
+
+    :param directory: directory of the app, its assets sub-directory is included
+    :param extensions: files to hash
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    for folder in (directory, os.path.join(directory, 'assets')):
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(extensions):
+                with open(os.path.join(folder, name), 'rb') as f:
+                    digest.update(name.encode() + f.read())
+
+    return digest.hexdigest()[:16]
+
+
+def entry_size(entry):
+    """Bytes of the bodies of a cached response"""
+    return sum(len(body) for body in entry['bodies'].values())
+
+
+class MemoryTier:
+    """Responses held by this process, least recently used ones are dropped first"""
+
+    name = 'memory'
+
+    def __init__(self, max_bytes, ttl=0):
+        """
+        :param max_bytes: bound on the bytes of the bodies held
+        :param ttl: seconds a response is kept, 0 keeps it until evicted or the data version changes
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+
+            entry, size, created = item
+            if self.ttl and time.time() - created > self.ttl:
+                del self.entries[key]
+                self.bytes -= size
+                return None
+
+            self.entries.move_to_end(key)
+
+            return entry
+
+    def put(self, key, version, entry):
+        size = entry_size(entry)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self.entries[key] = (entry, size, time.time())
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def touch(self, key, version):
+        """Mark a response as used, get already moved it to the most recently used end"""
+
+    def invalidate(self, version):
+        """Drop the responses of every other data version, i.e. all of them as keys include the version"""
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.bytes = 0
+
+
+class SharedTier:
+    """Responses in a SQLite file shared by the processes of one machine
+
+    Each process and thread opens its own connection (connections don't survive a fork). The database is in WAL
+    mode so readers never wait for a writer. Errors from SQLite, e.g. a locked or full disk, count as misses.
+
+    Reads don't write: a response's recency is updated by touch, which the cache calls when it copies the response
+    into a faster tier, so a response every worker keeps in memory costs one write per worker rather than one per
+    request. Without a faster tier, least recently used means least recently stored.
+    """
+
+    name = 'shared'
+
+    def __init__(self, path, max_bytes, ttl=0, namespace=''):
+        """
+        :param path: SQLite file, created with its directory if missing
+        :param max_bytes: bound on the bytes of the bodies held, least recently used ones are deleted first
+        :param ttl: seconds a response is kept, 0 keeps it until evicted or the data version changes
+        :param namespace: version of the code rendering the responses, see source_version
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.namespace = namespace
+        self.local = threading.local()
+
+    def scope(self, version):
+        return '{0}:{1}'.format(self.namespace, version)
+
+    def connect(self):
+        """This process and thread's connection"""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT, version TEXT, etag TEXT, '
+                               'mimetype TEXT, identity BLOB, gzip BLOB, br BLOB, size INTEGER, created REAL, '
+                               'used REAL, PRIMARY KEY (key, version))')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+            self.local.connection, self.local.pid = connection, os.getpid()
+
+        return self.local.connection
+
+    def get(self, key, version):
+        try:
+            connection = self.connect()
+            row = connection.execute('SELECT etag, mimetype, identity, gzip, br, created FROM responses '
+                                     'WHERE key = ? AND version = ?', (key, self.scope(version))).fetchone()
+            if row is None or (self.ttl and time.time() - row[5] > self.ttl):
+                return None
+        except sqlite3.Error:
+            return None
+
+        bodies = {name: body for name, body in zip(('identity', 'gzip', 'br'), row[2:5]) if body is not None}
+
+        return {'etag': row[0], 'mimetype': row[1], 'bodies': bodies}
+
+    def put(self, key, version, entry):
+        size = entry_size(entry)
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        bodies = entry['bodies']
+        try:
+            connection = self.connect()
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key, self.scope(version), entry['etag'], entry['mimetype'], bodies['identity'],
+                                bodies.get('gzip'), bodies.get('br'), size, now, now))
+            self.evict(connection, now)
+        except sqlite3.Error:
+            pass
+
+    def touch(self, key, version):
+        """Mark a response as used, so eviction keeps it over the responses used before"""
+        try:
+            self.connect().execute('UPDATE responses SET used = ? WHERE key = ? AND version = ?',
+                                   (time.time(), key, self.scope(version)))
+        except sqlite3.Error:
+            pass
+
+    def evict(self, connection, now):
+        """Delete expired responses, then the least recently used ones until the bodies fit in max_bytes"""
+        if self.ttl:
+            connection.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = []
+        for key, version, size in connection.execute('SELECT key, version, size FROM responses ORDER BY used'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key, version))
+            total -= size
+        connection.executemany('DELETE FROM responses WHERE key = ? AND version = ?', evicted)
+
+    def invalidate(self, version):
+        """Delete the responses of other data versions and deploys, the workers still serving them recompute"""
+        try:
+            self.connect().execute('DELETE FROM responses WHERE version != ?', (self.scope(version),))
+        except sqlite3.Error:
+            pass
+
+    @property
+    def bytes(self):
+        try:
+            return self.connect().execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def clear(self):
+        try:
+            self.connect().execute('DELETE FROM responses')
+        except sqlite3.Error:
+            pass
+
+
+class ResponseCache:
+    """Flask hooks serving cached responses for the Dash layout and pure callbacks"""
+
+    def __init__(self, server, outputs=(), layout=True, version=None, tiers=None, keys=None):
+        """
+        :param server: the Dash app's Flask server
+        :param outputs: callback outputs (Output or list of Outputs per callback) whose responses depend on their
+            inputs and the data only
+        :param keys: dict of callback_id to a function of the callback's input and state values returning only what
+            its response depends on, so requests differing in anything else share a response
+        :param layout: also cache /_dash-layout
+        :param version: function returning the current data version, None if the data never changes
+        :param tiers: list of MemoryTier and SharedTier, looked up in order, by default an unbounded MemoryTier
+        """
+        self.outputs = {callback_id(output) for output in outputs}
+        self.keys = keys or {}
+        self.layout = layout
+        self.version = version
+        self.current = version() if version is not None else None
+        self.tiers = tiers if tiers is not None else [MemoryTier(float('inf'))]
+        self.hits = {tier.name: 0 for tier in self.tiers}
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        server.before_request(self.serve)
+        server.after_request(self.store)
+
+    def key(self):
+        """Cache key of the current request, None if it is not cacheable"""
+        if request.method == 'GET' and request.path.endswith('/_dash-layout'):
+            return json.dumps(['layout', self.current]) if self.layout else None
+
+        if request.method == 'POST' and request.path.endswith('/_dash-update-component'):
+            body = request.get_json(silent=True) or {}
+            if body.get('output') in self.outputs:
+                values = [item.get('value') for group in ('inputs', 'state') for item in body.get(group) or []]
+                key = self.keys.get(body['output'])
+                return json.dumps([body['output'], self.current, key(*values) if key else values], sort_keys=True)
+
+        return None
+
+    def serve(self):
+        """before_request hook, answers from the cache on a hit"""
+        if self.version is not None and self.version() != self.current:
+            with self.lock:
+                self.current = self.version()
+                for tier in self.tiers:
+                    tier.invalidate(self.current)
+
+        key = self.key()
+        g.response_cache_key = key
+        if key is None:
+            return None
+
+        entry = self.lookup(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # answered from the cache, nothing to store
+        g.response_cache_key = None
+
+        # a conditional GET for the same body needs no body at all
+        if request.method == 'GET' and entry['etag'] in request.if_none_match:
+            response = Response(status=304)
+        else:
+            encoding = request.accept_encodings.best_match([name for name in ('br', 'gzip') if name in entry['bodies']])
+            response = Response(entry['bodies'].get(encoding, entry['bodies']['identity']), mimetype=entry['mimetype'])
+            if encoding in entry['bodies']:
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(entry['etag'])
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+
+        return response
+
+    def lookup(self, key):
+        """The cached response of a key from the first tier holding it, copied into the tiers before that one
+
+        The tier it came from only records the use when the response is copied, later hits are served by the
+        faster tiers and don't reach it.
+        """
+        for position, tier in enumerate(self.tiers):
+            entry = tier.get(key, self.current)
+            if entry is not None:
+                if position:
+                    tier.touch(key, self.current)
+                for faster in self.tiers[:position]:
+                    faster.put(key, self.current, entry)
+                self.hits[tier.name] += 1
+                return entry
+
+        return None
+
+    def store(self, response):
+        """after_request hook, keeps the successful response of a cacheable request that missed"""
+        key = getattr(g, 'response_cache_key', None)
+        if key is None or response.status_code != 200 or \
+                response.direct_passthrough or 'Content-Encoding' in response.headers:
+            return response
+
+        raw = response.get_data()
+        bodies = {'identity': raw, 'gzip': gzip.compress(raw, GZIP_LEVEL)}
+        if brotli is not None:
+            bodies['br'] = brotli.compress(raw, quality=BROTLI_QUALITY)
+
+        entry = {'etag': hashlib.sha1(raw).hexdigest(), 'mimetype': response.mimetype, 'bodies': bodies}
+        for tier in self.tiers:
+            tier.put(key, self.current, entry)
+
+        response.set_etag(entry['etag'])
+
+        return response
+
+    def warm(self, server, paths=('/_dash-layout',)):
+        """Fill the cache for GET routes ahead of the first visitor
+
+        :param server: the Flask server the cache is attached to
+        :param paths: routes to request
+        """
+        with server.test_client() as client:
+            for path in paths:
+                client.get(path)
+
+    def clear(self):
+        """Drop every cached response of every tier, including the ones other processes share"""
+        for tier in self.tiers:
+            tier.clear()
@@ -0,0 +1,140 @@
+"""Mergeable quantile sketches
+
+A sketch is a vector of counts over a fixed set of buckets, so merging sketches (months, suburbs,
+batches of new sales) is a plain sum and any number of them can be merged with one numpy call.
+Values are mapped to buckets by a mapping: whole-number metrics like bedrooms use one bucket per value
+and are exact, prices use logarithmic buckets with a bounded relative error.
+"""
+import numpy as np
+
+
+class LinearMapping:
+    """One bucket per whole number from 0 to max_value, quantiles are exact"""
+
+    def __init__(self, max_value):
+        self.max_value = max_value
+        self.size = int(max_value) + 1
+
+    def key(self, values):
+        """Bucket of every value, -1 for NaNs"""
+        values = np.asarray(values, dtype='float64')
+        keys = np.clip(np.round(np.nan_to_num(values, nan=-1)), -1, self.max_value).astype('int64')
+        keys[np.isnan(values)] = -1
+
+        return keys
+
+    def value(self, keys):
+        """Value represented by buckets"""
+        return np.asarray(keys, dtype='float64')
+
+    def settings(self):
+        """Parameters of the mapping, sketches built with different settings can't be merged"""
+        return {'mapping': 'linear', 'max_value': self.max_value}
+
+
+class LogMapping:
+    """Logarithmic buckets between min_value and max_value, quantiles are within relative_accuracy
+
+    Values outside the range fall into the first or last bucket.
+    """
+
+    def __init__(self, relative_accuracy, min_value, max_value):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.offset = int(np.ceil(np.log(min_value) / np.log(self.gamma)))
+        self.size = int(np.ceil(np.log(max_value) / np.log(self.gamma))) - self.offset + 1
+
+    def key(self, values):
+        """Bucket of every value, -1 for NaNs"""
+        values = np.asarray(values, dtype='float64')
+        clipped = np.clip(np.nan_to_num(values, nan=self.min_value), self.min_value, self.max_value)
+        keys = np.ceil(np.log(clipped) / np.log(self.gamma)).astype('int64') - self.offset
+        keys[np.isnan(values)] = -1
+
+        return np.clip(keys, -1, self.size - 1)
+
+    def value(self, keys):
+        """Value represented by buckets, the one with the smallest relative error to anything in them"""
+        return 2 * self.gamma ** (np.asarray(keys) + self.offset) / (self.gamma + 1)
+
+    def settings(self):
+        """Parameters of the mapping, sketches built with different settings can't be merged"""
+        return {'mapping': 'log', 'relative_accuracy': self.relative_accuracy,
+                'min_value': self.min_value, 'max_value': self.max_value}
+
+
+def sketch_counts(keys, codes, n_groups, size):
+    """Sketches of every group
+
+    :param keys: bucket of every value from a mapping, negative keys are dropped
+    :param codes: integer group code of every value, negative codes are dropped
+    :param n_groups: number of groups
+    :param size: number of buckets of the mapping
+    :return: (n_groups, size) array of counts
+    """
+    keys = np.asarray(keys)
+    codes = np.asarray(codes)
+    keep = (keys >= 0) & (codes >= 0)
+    counts = np.bincount(codes[keep].astype('int64') * size + keys[keep], minlength=n_groups * size)
+
+    return counts.reshape(n_groups, size)
+
+
+def quantile(counts, mapping, q=0.5):
+    """Quantile of one or many sketches, interpolated between ranks like pandas
+
+    :param counts: sketch counts, a vector or a (n, size) array of sketches
+    :param mapping: the mapping the sketches were built with
+    :param q: quantile to compute
+    :return: quantile of every sketch, NaN for empty ones
+    """
+    single = np.ndim(counts) == 1
+    counts = np.atleast_2d(counts)
+    cumulative = np.cumsum(counts, axis=1)
+    total = cumulative[:, -1]
+
+    rank = q * np.maximum(total - 1, 0)
+    lower = np.floor(rank)
+    low = (cumulative > lower[:, None]).argmax(axis=1)
+    high = (cumulative > np.ceil(rank)[:, None]).argmax(axis=1)
+
+    values = mapping.value(low) + (mapping.value(high) - mapping.value(low)) * (rank - lower)
+    values = np.where(total > 0, values, np.nan)
+
+    return values[0] if single else values
+
+
+def sparse_quantile(groups, keys, counts, n_groups, mapping, q=0.5):
+    """Quantile of many sketches held as sparse entries, like quantile without the dense (n, size) array
+
+    :param groups: group of every entry, entries sorted by group then key
+    :param keys: bucket of every entry
+    :param counts: count of every entry, all positive
+    :param n_groups: number of groups
+    :param mapping: the mapping the sketches were built with
+    :param q: quantile to compute
+    :return: (quantiles, totals) of every group, NaN quantiles for empty groups
+    """
+    cumulative = np.cumsum(counts, dtype='float64')
+    totals = np.bincount(groups, weights=counts, minlength=n_groups)
+    before = np.cumsum(totals) - totals
+
+    # first entry of a group whose running count passes the rank, as argmax does for dense sketches
+    rank = q * np.maximum(totals - 1, 0)
+    lower = np.floor(rank)
+    last = max(len(keys) - 1, 0)
+    low = np.minimum(np.searchsorted(cumulative, before + lower, side='right'), last)
+    high = np.minimum(np.searchsorted(cumulative, before + np.ceil(rank), side='right'), last)
+
+    keys = np.asarray(keys, dtype='int64') if len(keys) else np.zeros(1, dtype='int64')
+    values = mapping.value(keys[low]) + (mapping.value(keys[high]) - mapping.value(keys[low])) * (rank - lower)
+
+    return np.where(totals > 0, values, np.nan), totals.astype('int64')
+
+
+def median(counts, mapping):
+    """Median of one or many sketches"""
+    return quantile(counts, mapping, 0.5)
@@ -0,0 +1,77 @@
+"""Point to suburb lookups over the suburb polygons
+
+The polygons are put in an STRtree once, so a batch of points is matched with one vectorized query
+instead of testing every point against every suburb. Points outside every suburb (on the water, past
+the edge of the map) can be matched to the nearest suburb instead.
+
+Coordinates are scaled to metres around Sydney's latitude before indexing, so distances are in metres
+(to within a fraction of a percent across the city) without a map projection dependency.
+"""
+import numpy as np
+import shapely
+
+# metres per degree of latitude, and of longitude at Sydney's latitude
+METRES_PER_DEGREE = 111320.0
+LATITUDE = -33.87
+
+
+class SuburbLocator:
+    """Spatial index over suburb polygons"""
+
+    def __init__(self, suburbs, geometries, latitude=LATITUDE):
+        """
+        :param suburbs: suburb name of every polygon
+        :param geometries: array of shapely polygons in longitude/latitude
+        :param latitude: latitude the longitudes are scaled at
+        """
+        self.suburbs = np.asarray(suburbs, dtype=object)
+        self.scale = np.array([METRES_PER_DEGREE * np.cos(np.radians(latitude)), METRES_PER_DEGREE])
+        self.geometries = shapely.transform(np.asarray(geometries), lambda coordinates: coordinates * self.scale)
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def from_frame(cls, frame, column='suburb'):
+        """Index the geometries of a GeoDataFrame
+
+        :param frame: GeoDataFrame with a suburb name column
+        :param column: name column
+        """
+        return cls(frame[column].values, frame.geometry.values)
+
+    def __len__(self):
+        return len(self.suburbs)
+
+    def locate(self, lat, lon, nearest=True, max_distance=None):
+        """Suburb of every point
+
+        Where suburbs overlap the first one in index order wins.
+
+        :param lat: latitudes
+        :param lon: longitudes
+        :param nearest: match points outside every suburb to the nearest one
+        :param max_distance: only match nearest suburbs closer than this, in metres
+        :return: (positions into self.suburbs, -1 for no match; distances in metres, 0 inside a suburb and NaN
+            for no match)
+        """
+        lat = np.asarray(lat, dtype='float64')
+        lon = np.asarray(lon, dtype='float64')
+        points = shapely.points(np.column_stack([lon, lat]) * self.scale)
+
+        positions = np.full(len(points), len(self.suburbs), dtype='int64')
+        inputs, targets = self.tree.query(points, predicate='within')
+        np.minimum.at(positions, inputs, targets)
+        positions[positions == len(self.suburbs)] = -1
+
+        distances = np.where(positions >= 0, 0.0, np.nan)
+        outside = np.flatnonzero((positions < 0) & np.isfinite(lat) & np.isfinite(lon))
+        if nearest and len(outside):
+            (inputs, targets), found = self.tree.query_nearest(points[outside], max_distance=max_distance,
+                                                               return_distance=True, all_matches=False)
+            positions[outside[inputs]] = targets
+            distances[outside[inputs]] = found
+
+        return positions, distances
+
+    def names(self, positions):
+        """Suburb names of positions from locate, None for no match"""
+        return np.where(positions >= 0, self.suburbs[np.maximum(positions, 0)], None)
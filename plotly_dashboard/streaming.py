@@ -0,0 +1,172 @@
+"""Out-of-core aggregation of the sales data
+
+For sales data too large to hold in every worker, the source is read in chunks of rows and folded into
+the aggregates the dashboard serves from: per-suburb histogram bins, the monthly cube of bins and
+quantile sketches, and per-suburb medians taken from the sketches. Only one chunk of rows is in memory
+at a time, and the suburb index keeps the suburbs but no rows, so memory depends on the number of
+suburbs and months rather than on the number of sales. Every column is folded in the same pass over
+the chunks. Parallel builds split the rows into parts, each worker folds its own part and the folds
+are merged.
+
+The app builds this way when CHUNK_ROWS is set, e.g. CHUNK_ROWS=500000.
+"""
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from cube import MonthlyCube
+from datastore import PRICES_CSV, PRICES_STORE, read_fresh_store
+from histograms import HistogramCache
+from ingest import merge_aggregates
+from suburb_index import SuburbIndex
+
+CHUNK_ROWS = 500000
+
+
+class FileRange(io.RawIOBase):
+    """The header line of a CSV followed by the lines in a byte range of it, as a file to parse"""
+
+    def __init__(self, path, start, stop):
+        """
+        :param path: CSV file
+        :param start: offset of the first line of the range
+        :param stop: offset just past its last line
+        """
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.header = self.file.readline()
+        self.file.seek(start)
+        self.left = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.header:
+            data, self.header = self.header[:len(buffer)], self.header[len(buffer):]
+        else:
+            data = self.file.read(min(len(buffer), self.left))
+            self.left -= len(data)
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def line_ranges(path, parts):
+    """(start, stop) byte offsets splitting the lines of a CSV after its header into parts of about equal size"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        bounds = [len(f.readline())]
+        for part in range(1, parts):
+            # the line the offset falls in belongs to the previous part
+            f.seek(max(bounds[0], size * part // parts))
+            f.readline()
+            bounds.append(max(bounds[-1], min(f.tell(), size)))
+    bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_chunks(columns, csv=PRICES_CSV, store=PRICES_STORE, chunk_rows=CHUNK_ROWS, part=0, parts=1):
+    """Sales in chunks of rows, indexed by Date
+
+    Slices of the memory-mapped columnar store are used when it is fresh, otherwise the CSV is parsed
+    chunk by chunk. The rows can be split into parts read by different processes, each reads only its own.
+
+    :param columns: columns to read besides Date
+    :param csv: source CSV
+    :param store: columnar store of the CSV (see datastore.py)
+    :param chunk_rows: rows per chunk
+    :param part: part of the rows to read
+    :param parts: number of parts the rows are split into
+    :return: iterator of dataframes
+    """
+    df = read_fresh_store(csv, store, mmap=True)
+    if df is not None:
+        df = df[columns]
+        bounds = np.linspace(0, len(df), parts + 1).astype('int64')
+        for start in range(bounds[part], bounds[part + 1], chunk_rows):
+            # copy the slice so the pages of the previous chunk can be dropped
+            yield df.iloc[start:min(start + chunk_rows, bounds[part + 1])].copy()
+        return
+
+    source = csv
+    if parts > 1:
+        start, stop = line_ranges(csv, parts)[part]
+        if start == stop:
+            return
+        source = io.BufferedReader(FileRange(csv, start, stop))
+
+    with pd.read_csv(source, usecols=['Date'] + list(columns), parse_dates=['Date'], index_col='Date',
+                     chunksize=chunk_rows) as chunks:
+        for chunk in chunks:
+            yield chunk
+
+
+def fold(chunks, edges, mappings, group='suburb'):
+    """Fold chunks of sales into suburb-ordered counts
+
+    :param chunks: iterator of sales dataframes
+    :param edges: dict of column -> histogram bin edges
+    :param mappings: dict of column -> sketch mapping
+    :param group: column holding the suburb names
+    :return: (suburb_index without rows, histogram_cache, cube), None when there were no chunks
+    """
+    folded = None
+
+    for chunk in chunks:
+        if folded is None:
+            chunk_index = SuburbIndex(chunk, group)
+            folded = (chunk_index.without_rows(), HistogramCache.count(chunk_index, edges),
+                      MonthlyCube.build(chunk_index, edges, mappings))
+        else:
+            folded = merge_aggregates(*folded, chunk, keep_rows=False)[:3]
+
+    return folded
+
+
+def merge_folds(folds):
+    """One (suburb_index, histogram_cache, cube) of the folds of several parts of the sales, see fold
+
+    :param folds: list of fold results, None for parts without sales
+    :return: tuple, None when no part had sales
+    """
+    merged = None
+
+    for folded in folds:
+        if folded is None:
+            continue
+        if merged is None:
+            merged = folded
+            continue
+
+        suburb_index, histogram_cache, cube = merged
+        other_index, other_cache, other_cube = folded
+        suburb_index, positions = suburb_index.append(pd.DataFrame({suburb_index.group: other_index.suburbs}),
+                                                      keep_rows=False)
+        n_suburbs = len(suburb_index)
+        other_positions = suburb_index.suburbs.get_indexer(other_index.suburbs)
+        merged = (suburb_index,
+                  histogram_cache.reindex(positions, n_suburbs).merge(other_cache.reindex(other_positions, n_suburbs)),
+                  cube.reindex(positions, n_suburbs).merge(other_cube.reindex(other_positions, n_suburbs)))
+
+    return merged
+
+
+def fold_medians(suburb_index, cube, mappings):
+    """Per-suburb medians of every column over all months, from the cube's sketches
+
+    :return: median_statistics dataframe indexed by suburb
+    """
+    medians = np.column_stack([cube.suburb_medians(column, 0, cube.n_months - 1) for column in mappings])
+
+    return pd.DataFrame(medians, index=pd.Index(suburb_index.suburbs, name=suburb_index.group),
+                        columns=list(mappings))
+
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+
+def widen(codes, categories):
+    """Categorical codes in a type that can hold a code for every category"""
+    return codes.astype(np.promote_types(codes.dtype, np.min_scalar_type(-len(categories))), copy=False)
+
+
+class SuburbIndex:
+    """Sales rows sorted by suburb with a suburb -> (start, stop) row offset table
+
+    Every suburb's sales are one contiguous slice of `rows`, so a selection is resolved with a
+    single dictionary lookup instead of a boolean scan of the whole dataframe.
+    """
+
+    def __init__(self, df, group='suburb'):
+        """
+        :param df: sales dataframe
+        :param group: column holding the suburb names
+        """
+        # a categorical suburb column (the columnar store, the shared artifacts) is used as it is, not copied
+        column = df[group]
+        groups = column.array if isinstance(column.dtype, pd.CategoricalDtype) else pd.Categorical(column)
+        self.suburbs = pd.Index(groups.categories)
+
+        # rows already sorted by suburb (e.g. the shared artifacts) are used as they are
+        if np.all(groups.codes[1:] >= groups.codes[:-1]):
+            self.rows = df
+            self.codes = groups.codes
+        else:
+            order = np.argsort(groups.codes, kind='stable')
+            self.rows = df.iloc[order]
+            # the sorted categorical column already holds the sorted codes, they are not kept twice
+            self.codes = self.rows[group].array.codes if isinstance(column.dtype, pd.CategoricalDtype) \
+                else groups.codes[order]
+
+        # rows without a suburb (code -1) sort first and belong to no span
+        counts = np.bincount(self.codes[self.codes >= 0], minlength=len(self.suburbs))
+        self.offsets = np.count_nonzero(self.codes < 0) + np.concatenate([[0], np.cumsum(counts)])
+        self.positions = dict(zip(self.suburbs, range(len(self.suburbs))))
+        self.group = group
+
+    def __len__(self):
+        return len(self.suburbs)
+
+    def locate(self, suburb):
+        """Position of a suburb in the index, -1 when it has no sales
+
+        :param suburb: suburb name
+        :return: integer position
+        """
+        return self.positions.get(suburb, -1)
+
+    def span(self, position):
+        """(start, stop) offsets of a suburb's rows
+
+        :param position: position from locate
+        :return: tuple of row offsets, empty for unknown suburbs
+        """
+        if position < 0:
+            return 0, 0
+
+        return self.offsets[position], self.offsets[position + 1]
+
+    def slice(self, suburb):
+        """All sales in a suburb
+
+        :param suburb: suburb name
+        :return: dataframe slice of the sorted rows
+        """
+        start, stop = self.span(self.locate(suburb))
+
+        return self.rows.iloc[start:stop]
+
+    def append(self, batch, keep_rows=True):
+        """A new index with more sales added
+
+        The batch's rows are sorted on their own and inserted after the rows of their suburbs, so the current rows
+        are neither re-encoded nor sorted again.
+
+        :param batch: dataframe with the same columns
+        :param keep_rows: add the batch's rows, or only its suburbs (for indexes over aggregates only)
+        :return: (SuburbIndex, positions) where positions maps this index's suburbs to the new index
+        """
+        groups = pd.Categorical(batch[self.group])
+        added = groups.categories.difference(self.suburbs)
+        suburbs = self.suburbs.union(added) if len(added) else self.suburbs
+        positions = suburbs.get_indexer(self.suburbs)
+
+        # the codes of the current rows only move up to make room for new suburbs
+        codes = np.where(self.codes >= 0, positions[np.maximum(self.codes, 0)], -1) if len(added) else self.codes
+        if not keep_rows or not len(batch):
+            rows = self.rows.assign(**{self.group: pd.Categorical.from_codes(codes, categories=suburbs)})
+            return SuburbIndex(rows, self.group), positions
+
+        order = np.argsort(groups.set_categories(suburbs).codes, kind='stable')
+        batch = batch.iloc[order]
+        batch_codes = suburbs.get_indexer(groups.categories)[groups.codes[order]]
+        batch_codes[groups.codes[order] < 0] = -1
+        # each sale of the batch goes after the current sales of its suburb
+        at = np.searchsorted(codes, batch_codes, side='right')
+
+        columns = {}
+        for column in self.rows.columns:
+            current, added_rows = self.rows[column], batch[column]
+            if column == self.group:
+                columns[column] = pd.Categorical.from_codes(np.insert(widen(codes, suburbs), at, batch_codes),
+                                                            categories=suburbs)
+            elif isinstance(current.dtype, pd.CategoricalDtype):
+                # categories new in the batch are added at the end, so the current codes stay valid
+                categories = current.cat.categories.append(
+                    pd.Categorical(added_rows).categories.difference(current.cat.categories))
+                columns[column] = pd.Categorical.from_codes(
+                    np.insert(widen(current.array.codes, categories), at,
+                              pd.Categorical(added_rows, categories=categories).codes),
+                    categories=categories)
+            else:
+                # e.g. a batch with missing prices widens an integer price column to floats, as a concat would
+                dtype = np.result_type(current.dtype, added_rows.dtype)
+                columns[column] = np.insert(current.values.astype(dtype, copy=False), at, added_rows.values)
+        index = pd.Index(np.insert(self.rows.index.values, at, batch.index.values), name=self.rows.index.name)
+
+        return SuburbIndex(pd.DataFrame(columns, index=index), self.group), positions
+
+    def without_rows(self):
+        """An index of the same suburbs holding no sales, for data served from aggregates only"""
+        rows = self.rows.iloc[:0].copy()
+        rows[self.group] = pd.Categorical([], categories=self.suburbs)
+
+        return SuburbIndex(rows, self.group)
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from benchmark import CENTER, SPACING
+
+
+@pytest.fixture
+def client(dashboard):
+    return dashboard.server.test_client()
+
+
+def test_stats_of_suburbs(dashboard, client):
+    response = client.post('/api/stats', json={'suburbs': ['Suburb 0001', 'Nowhere'], 'metrics': ['bed']})
+
+    result = response.get_json()
+    assert response.status_code == 200
+    assert result['found'] == [True, False]
+    assert set(result['metrics']) == {'bed'}
+    medians = dashboard.artifacts.median_statistics
+    assert result['metrics']['bed']['median'] == [medians.loc['Suburb 0001', 'bed'], None]
+    assert len(result['metrics']['bed']['bins'][0]) == len(result['metrics']['bed']['edges']) - 1
+
+
+@pytest.mark.parametrize('params', [{'suburbs': 'Suburb 0001'},
+                                    {'suburbs': ['Suburb 0001'], 'metrics': [['bed']]},
+                                    {'suburbs': ['Suburb 0001'], 'metrics': [1]},
+                                    {'suburbs': ['Suburb 0001'], 'metrics': ['rooms']},
+                                    {'suburbs': ['Suburb 0001'], 'start': '2015-13'},
+                                    {'suburbs': ['Suburb 0001'], 'histograms': 'maybe'},
+                                    {'suburbs': ['Suburb 0001'], 'histograms': 1},
+                                    ['Suburb 0001']])
+def test_stats_rejects_bad_requests(client, params):
+    response = client.post('/api/stats', json=params)
+
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('histograms, expected', [(False, False), ('false', False), ('0', False), (True, True),
+                                                  ('true', True), (None, True)])
+def test_stats_histograms_flag(client, histograms, expected):
+    result = client.post('/api/stats', json={'suburbs': ['Suburb 0001'], 'histograms': histograms}).get_json()
+    assert ('bins' in result['metrics']['bed']) == expected
+
+    query = '' if histograms is None else '&histograms={0}'.format(str(histograms).lower())
+    result = client.get('/api/stats?suburb=Suburb 0001' + query).get_json()
+    assert ('bins' in result['metrics']['bed']) == expected
+
+
+def test_stats_conditional_reads(client):
+    response = client.get('/api/stats?suburb=Suburb 0001&metric=sellPrice')
+    etag = response.headers['ETag']
+
+    assert client.get('/api/stats?suburb=Suburb 0001&metric=sellPrice',
+                      headers={'If-None-Match': etag}).status_code == 304
+
+    # the same query as a POST is not a conditional read
+    response = client.post('/api/stats', json={'suburbs': ['Suburb 0001'], 'metrics': ['sellPrice']},
+                           headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert np.isfinite(response.get_json()['metrics']['sellPrice']['median'][0])
+
+
+def suburb_centre(i, n_suburbs=40):
+    """Longitude and latitude of the middle of the benchmark's i-th suburb"""
+    side = int(np.ceil(np.sqrt(n_suburbs)))
+    row, col = divmod(i, side)
+
+    return CENTER[0] + (col - side / 2) * SPACING, CENTER[1] + (row - side / 2) * SPACING
+
+
+def test_locate_points(dashboard, client):
+    lon, lat = zip(suburb_centre(3), suburb_centre(12))
+    # far to the east of every suburb
+    lon, lat = list(lon) + [152.0], list(lat) + [-33.8651]
+
+    result = client.post('/api/suburbs/locate', json={'lat': lat, 'lon': lon}).get_json()
+    assert result['suburb'][:2] == ['Suburb 0003', 'Suburb 0012']
+    assert result['distance'][:2] == [0, 0] and result['distance'][2] > 50000
+    assert result['bed'][0] == dashboard.artifacts.median_statistics.loc['Suburb 0003', 'bed']
+
+    result = client.post('/api/suburbs/locate', json={'lat': lat, 'lon': lon, 'nearest': False}).get_json()
+    assert result['suburb'][2] is None and result['distance'][2] is None
+
+    result = client.get('/api/suburbs/locate?lat={1}&lon={0}'.format(*suburb_centre(3))).get_json()
+    assert result['suburb'] == ['Suburb 0003']
+
+
+@pytest.mark.parametrize('params', [{'lat': [[-33.8]], 'lon': [[151.2]]}, {'lat': [-33.8], 'lon': [151.2, 151.3]},
+                                    {'lat': ['south'], 'lon': [151.2]}, {'lon': [151.2]}, [[-33.8, 151.2]]])
+def test_locate_rejects_bad_requests(client, params):
+    response = client.post('/api/suburbs/locate', json=params)
+
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
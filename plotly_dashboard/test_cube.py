@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cube import MonthlyCube, month_number
+from histograms import spec_edges
+from pipeline import hist_specs, sketch_specs
+from suburb_index import SuburbIndex
+
+# months 3 to 14 of the sales (inclusive), positions from the cube's first month
+START, STOP = 3, 14
+
+
+def build(df):
+    index = SuburbIndex(df)
+    return index, MonthlyCube.build(index, spec_edges(hist_specs), sketch_specs)
+
+
+def within(df, cube, start, stop):
+    months = month_number(df.index) - cube.first_month
+    return df[(months >= start) & (months <= stop)]
+
+
+def assert_medians(actual, expected, column):
+    if column == 'sellPrice':
+        np.testing.assert_allclose(actual, expected, rtol=0.01)
+    else:
+        np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('column', list(sketch_specs))
+def test_suburb_medians_match_pandas(make_sales, column):
+    df = make_sales()
+    index, cube = build(df)
+
+    medians = cube.suburb_medians(column, START, STOP)
+
+    expected = within(df, cube, START, STOP).groupby('suburb')[column].median().reindex(index.suburbs).values
+    assert_medians(medians, expected, column)
+
+
+@pytest.mark.parametrize('column', list(sketch_specs))
+def test_selection_medians_match_pandas(make_sales, column):
+    df = make_sales()
+    index, cube = build(df)
+    positions = np.array([0, 3, 11, 20])
+
+    [medians] = cube.medians([column], positions, START, STOP)
+
+    selected = within(df, cube, START, STOP)
+    expected = selected[selected['suburb'].isin(index.suburbs[positions])][column].median()
+    assert_medians(medians, expected, column)
+
+
+def test_histogram_matches_numpy(make_sales):
+    df = make_sales()
+    index, cube = build(df)
+    edges = cube.edges['sellPrice']
+    selected = within(df, cube, START, STOP)
+
+    _, city = cube.histogram('sellPrice', None, START, STOP)
+    np.testing.assert_array_equal(city, np.histogram(selected['sellPrice'], edges)[0])
+
+    _, suburb = cube.histogram('sellPrice', 7, START, STOP)
+    np.testing.assert_array_equal(suburb, np.histogram(selected[selected['suburb'] == index.suburbs[7]]['sellPrice'],
+                                                       edges)[0])
+
+
+def test_merge_matches_build(make_sales):
+    df = make_sales()
+    index, cube = build(df)
+    (first_index, first), (second_index, second) = build(df.iloc[::2]), build(df.iloc[1::2])
+
+    # both halves hold every suburb, so their positions are the same as the whole's
+    assert first_index.suburbs.equals(index.suburbs) and second_index.suburbs.equals(index.suburbs)
+    merged = first.merge(second)
+
+    assert (merged.first_month, merged.n_months) == (cube.first_month, cube.n_months)
+    for column in sketch_specs:
+        np.testing.assert_array_equal(merged.suburb_medians(column, START, STOP),
+                                      cube.suburb_medians(column, START, STOP))
+        np.testing.assert_array_equal(merged.histogram(column, None, START, STOP)[1],
+                                      cube.histogram(column, None, START, STOP)[1])
+
+
+@pytest.mark.parametrize('months, freq', [(1, 'MS'), (3, 'QS')])
+def test_period_medians_match_pandas(make_sales, months, freq):
+    df = make_sales()
+    index, cube = build(df)
+
+    medians, counts = cube.period_medians('sellPrice', months)
+
+    grouped = df.groupby(['suburb', pd.Grouper(freq=freq)])['sellPrice']
+    expected = grouped.median().unstack().reindex(index=index.suburbs)
+    expected_counts = grouped.size().unstack().reindex(index=index.suburbs).fillna(0)
+    assert [cube.period_label(p, months) for p in range(medians.shape[1])] == \
+        [date.strftime('%Y-%m-%d') for date in expected.columns]
+    np.testing.assert_allclose(medians, expected.values, rtol=0.01)
+    np.testing.assert_array_equal(counts, expected_counts.values)
+
+    city, city_counts = cube.period_medians('sellPrice', months, np.arange(len(index)))
+    np.testing.assert_allclose(city, df.groupby(pd.Grouper(freq=freq))['sellPrice'].median().values, rtol=0.01)
+    np.testing.assert_array_equal(city_counts, counts.sum(axis=0))
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from datastore import MANIFEST, build_store, load_prices, narrowest, read_manifest, read_store
+
+
+@pytest.fixture
+def csv(make_sales, tmp_path):
+    """Sales written to data/prices_data.csv of a temporary directory"""
+    df = make_sales()
+    os.makedirs(tmp_path / 'data')
+    df.to_csv(tmp_path / 'data' / 'prices_data.csv')
+
+    return df, str(tmp_path / 'data' / 'prices_data.csv'), str(tmp_path / 'data' / 'prices_data')
+
+
+def test_store_round_trip(csv):
+    df, path, store = csv
+    build_store(path, store)
+
+    read = read_store(store)
+
+    # every text column is dictionary encoded, so all of them can be memory-mapped
+    manifest = read_manifest(store)
+    assert set(manifest['columns']['suburb']) == {'dtype', 'categories'}
+    assert set(manifest['columns']['propType']) == {'dtype', 'categories'}
+    assert isinstance(read['propType'].dtype, pd.CategoricalDtype)
+
+    assert read.index.equals(df.index)
+    for column in df.columns:
+        pd.testing.assert_series_equal(read[column].astype(object), df[column].astype(object))
+
+
+def test_narrowest_keeps_values():
+    np.testing.assert_array_equal(narrowest(np.array([0, 200, 70000])), [0, 200, 70000])
+    assert narrowest(np.array([0.0, 3.0, 255.0])).dtype == np.uint8
+    assert narrowest(np.array([-1.0, 3.0])).dtype == np.int8
+    assert narrowest(np.array([1.5, np.nan])).dtype == np.float32
+    assert narrowest(np.array([0.1, 1.0])).dtype == np.float64
+
+
+def test_load_prices_falls_back_to_the_csv(csv, capsys):
+    df, path, store = csv
+    build_store(path, store)
+
+    # a store written before text columns were encoded holds object arrays, which can't be memory-mapped
+    np.save(os.path.join(store, 'propType.npy'), df['propType'].values.astype(object), allow_pickle=True)
+    loaded = load_prices(path, store)
+    assert 'could not be read' in capsys.readouterr().out
+    assert list(loaded['propType']) == list(df['propType'])
+
+    os.remove(os.path.join(store, MANIFEST))
+    assert len(load_prices(path, store)) == len(df)
+
+
+def test_load_prices_reads_the_csv_when_the_store_is_stale(csv, capsys):
+    df, path, store = csv
+    build_store(path, store)
+
+    df.assign(sellPrice=df['sellPrice'] * 2).to_csv(path)
+
+    loaded = load_prices(path, store)
+    assert 'is older than' in capsys.readouterr().out
+    np.testing.assert_array_equal(loaded['sellPrice'], df['sellPrice'] * 2)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from histograms import HistogramCache, bin_counts, spec_edges
+from pipeline import hist_specs
+from suburb_index import SuburbIndex
+
+
+def expected_counts(values, codes, n_groups, edges):
+    return np.array([np.histogram(values[codes == group], edges)[0] for group in range(n_groups)])
+
+
+# categorical codes are int8 up to 127 suburbs and int16 above, their products with the number of bins overflow
+# either past 127 // 50 or 32767 // 50 = 655 suburbs of 50 bins
+@pytest.mark.parametrize('n_suburbs, dtype', [(100, 'int8'), (200, 'int16'), (700, 'int16')])
+def test_bin_counts_narrow_codes(n_suburbs, dtype):
+    rng = np.random.default_rng(n_suburbs)
+    edges = spec_edges(hist_specs)['sellPrice']
+    values = rng.uniform(0, 3000000, 20000)
+    codes = rng.integers(0, n_suburbs, len(values)).astype(dtype)
+
+    counts = bin_counts(values, codes, n_suburbs, edges)
+
+    np.testing.assert_array_equal(counts, expected_counts(values, codes, n_suburbs, edges))
+
+
+@pytest.mark.parametrize('n_suburbs', [100, 200, 700])
+def test_histogram_cache_matches_numpy(make_sales, n_suburbs):
+    df = make_sales(n_suburbs=n_suburbs, n_rows=10 * n_suburbs)
+    index = SuburbIndex(df)
+    cache = HistogramCache.build(index, hist_specs)
+
+    codes = index.suburbs.get_indexer(df['suburb'])
+    for column, edges in cache.edges.items():
+        values = df[column].values
+        keep = ~np.isnan(values)
+        np.testing.assert_array_equal(cache.counts[column],
+                                      expected_counts(values[keep], codes[keep], n_suburbs, edges))
+        np.testing.assert_array_equal(cache.get(column)[1], np.histogram(values[keep], edges)[0])
@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from artifacts import Artifacts
+from cube import MonthlyCube
+from datastore import compact
+from histograms import HistogramCache
+from ingest import DONE_SUFFIX, IncomingWatcher, merge_batch
+from pipeline import hist_specs, sketch_specs
+from price_ranks import PriceRanks
+from suburb_index import SuburbIndex
+
+
+def build(df):
+    """Artifacts of a full rebuild, without the map"""
+    index = SuburbIndex(compact(df))
+    histogram_cache = HistogramCache.build(index, hist_specs)
+    cube = MonthlyCube.build(index, histogram_cache.edges, sketch_specs)
+    medians = index.rows.groupby(index.group, observed=True)[list(sketch_specs)].median()
+    figure = {'data': [{'type': 'choroplethmapbox', 'locations': list(index.suburbs)}], 'layout': {}}
+
+    return Artifacts(index, medians, index.suburbs, histogram_cache, cube, figure, None)
+
+
+def test_merge_batch_matches_rebuild(make_sales):
+    df = make_sales(n_suburbs=50)
+    # the batch has the latest sales and suburbs the current artifacts have never seen
+    df = df.sort_index()
+    new = df['suburb'].isin(['Suburb 0045', 'Suburb 0046', 'Suburb 0047', 'Suburb 0048', 'Suburb 0049'])
+    current, batch = df[~new].iloc[:4000], pd.concat([df[~new].iloc[4000:], df[new]])
+
+    merged = merge_batch(build(current), compact(batch))
+    rebuilt = build(df)
+
+    assert merged.suburb_index.suburbs.equals(rebuilt.suburb_index.suburbs)
+    assert len(merged.df) == len(df)
+    for column in hist_specs:
+        np.testing.assert_array_equal(merged.histogram_cache.counts[column], rebuilt.histogram_cache.counts[column])
+
+    cube = merged.cube
+    assert (cube.first_month, cube.n_months) == (rebuilt.cube.first_month, rebuilt.cube.n_months)
+    for column in sketch_specs:
+        np.testing.assert_array_equal(cube.suburb_medians(column, 0, cube.n_months - 1),
+                                      rebuilt.cube.suburb_medians(column, 0, cube.n_months - 1))
+
+        # medians of the suburbs in the batch come from their sketches, exact but for prices
+        if column == 'sellPrice':
+            np.testing.assert_allclose(merged.median_statistics[column], rebuilt.median_statistics[column], rtol=0.01)
+        else:
+            np.testing.assert_array_equal(merged.median_statistics[column], rebuilt.median_statistics[column])
+
+
+def test_merge_batch_keeps_other_suburbs(make_sales):
+    df = make_sales().sort_index()
+    current = build(df.iloc[:4000])
+    batch = df.iloc[4000:]
+    batch = batch[batch['suburb'] == batch['suburb'].iloc[0]]
+
+    merged = merge_batch(current, compact(batch))
+
+    others = merged.median_statistics.index != batch['suburb'].iloc[0]
+    pd.testing.assert_frame_equal(merged.median_statistics[others], current.median_statistics[others],
+                                  check_names=False)
+    assert merged.version != current.version
+
+
+
+def test_append_inserts_the_batch_rows(make_sales):
+    df = compact(make_sales(n_suburbs=50)).sort_index()
+    current, batch = df[df['suburb'] != 'Suburb 0049'].iloc[:4000], df.iloc[4000:]
+    # a property type the current sales don't have
+    batch = batch.assign(propType=batch['propType'].cat.add_categories(['villa']))
+    batch.iloc[:10, batch.columns.get_loc('propType')] = 'villa'
+    index = SuburbIndex(current)
+
+    appended, positions = index.append(batch)
+
+    rebuilt = SuburbIndex(pd.concat([current.astype({'suburb': object, 'propType': object}),
+                                     batch.astype({'suburb': object, 'propType': object})]))
+    assert appended.suburbs.equals(rebuilt.suburbs)
+    assert list(appended.suburbs[positions]) == list(index.suburbs)
+    np.testing.assert_array_equal(appended.offsets, rebuilt.offsets)
+    # the batch's sales go after the current ones of their suburb, like a stable sort of both
+    assert appended.rows.index.equals(rebuilt.rows.index)
+    for column in df.columns:
+        pd.testing.assert_series_equal(appended.rows[column].astype(object), rebuilt.rows[column].astype(object))
+
+
+def test_merged_ranks_match_rebuild(make_sales):
+    df = make_sales(n_suburbs=50).sort_index()
+    new = df['suburb'].isin(['Suburb 0048', 'Suburb 0049'])
+    current, batch = df[~new].iloc[:4000], pd.concat([df[~new].iloc[4000:], df[new]])
+    data = build(current)
+    data.extras['ranks'] = PriceRanks.from_index(data.suburb_index, 'sellPrice')
+
+    merged = merge_batch(data, compact(batch)).extras['ranks']
+
+    rebuilt = PriceRanks.from_index(build(df).suburb_index, 'sellPrice')
+    for name in ('values', 'cumulative', 'offsets', 'city_values', 'city_cumulative'):
+        np.testing.assert_array_equal(getattr(merged, name), getattr(rebuilt, name))
+
+
+def test_watcher_reads_complete_files_once(make_sales, tmp_path):
+    batches = []
+    watcher = IncomingWatcher(batches.append, str(tmp_path))
+    df = make_sales(n_rows=1000)
+    path = str(tmp_path / 'sales-0001.csv')
+
+    # half written, no marker yet
+    df.iloc[:500].to_csv(path)
+    watcher.scan()
+    assert batches == []
+
+    df.to_csv(path)
+    open(path + DONE_SUFFIX, 'w').close()
+    watcher.scan()
+    watcher.scan()
+    assert [len(batch) for batch in batches] == [1000]
+
+    # changed after it was ingested, its rows are already in the data
+    df.iloc[:1].to_csv(path, mode='a', header=False)
+    watcher.scan()
+    assert [len(batch) for batch in batches] == [1000]
+
+    df.iloc[:10].to_csv(str(tmp_path / 'sales-0002.csv'))
+    open(str(tmp_path / 'sales-0002.csv') + DONE_SUFFIX, 'w').close()
+    watcher.scan()
+    assert [len(batch) for batch in batches] == [1000, 10]
+
+
+def test_watcher_retries_failed_files_once_changed(make_sales, tmp_path):
+    batches = []
+    watcher = IncomingWatcher(batches.append, str(tmp_path))
+    path = str(tmp_path / 'sales.csv')
+    with open(path, 'w') as f:
+        f.write('not,the,sales\n')
+    open(path + DONE_SUFFIX, 'w').close()
+
+    watcher.scan()
+    watcher.scan()
+    assert batches == []
+    assert watcher.failed
+
+    make_sales(n_rows=100).to_csv(path)
+    os.utime(path, ns=(0, 10 ** 9))
+    watcher.scan()
+    assert [len(batch) for batch in batches] == [100]
+
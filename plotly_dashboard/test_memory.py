@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from datastore import compact, write_store, read_store
+from memory import array_size, frame_sizes, is_mapped
+
+
+def test_compact_dtypes(make_sales):
+    df = make_sales()
+
+    compacted = compact(df)
+
+    assert isinstance(compacted['suburb'].dtype, pd.CategoricalDtype)
+    assert isinstance(compacted['propType'].dtype, pd.CategoricalDtype)
+    assert compacted['bed'].dtype == np.uint8
+    assert compacted['postalCode'].dtype == np.uint16
+    # prices are whole thousands, cars have NaNs
+    assert compacted['sellPrice'].dtype == np.uint32
+    assert compacted['car'].dtype == np.float32
+    for column in df.columns:
+        pd.testing.assert_series_equal(compacted[column].astype(object), df[column].astype(object))
+
+
+def test_shared_memory_is_counted_once():
+    values = np.arange(1000, dtype='int64')
+    seen = set()
+
+    assert array_size(values, seen) == (8000, False)
+    assert array_size(values[:], seen) == (0, False)
+
+    categorical = pd.Categorical(['a', 'b', 'a'])
+    size, _ = array_size(categorical, set())
+    assert size >= categorical.codes.nbytes + categorical.categories.values.nbytes
+
+
+def test_mapped_columns_are_reported(make_sales, tmp_path):
+    write_store(compact(make_sales()), str(tmp_path / 'store'))
+    df = read_store(str(tmp_path / 'store'), mmap=True)
+
+    sizes = {name: mapped for name, _, mapped in frame_sizes('rows', df, set())}
+
+    assert sizes['rows.sellPrice'] and sizes['rows.suburb']
+    assert is_mapped(df['bed'].values) and not is_mapped(df['bed'].values.copy())
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from metrics import Metrics
+from pipeline import build_sales, input_version, sketch_specs
+from streaming import read_chunks
+
+
+def build_metrics():
+    metrics = Metrics()
+    metrics.describe('startup_phase_seconds', 'gauge', 'Time spent in each phase of the build')
+
+    return metrics
+
+
+@pytest.fixture
+def prices(make_sales, tmp_path, monkeypatch):
+    """Sales written to data/prices_data.csv of a temporary working directory"""
+    df = make_sales()
+    os.makedirs(tmp_path / 'data')
+    df.to_csv(tmp_path / 'data' / 'prices_data.csv')
+    monkeypatch.chdir(tmp_path)
+
+    return df
+
+
+def test_median_statistics_are_the_stat_columns(prices):
+    # postalCode comes before the stats in the CSV, the stat cards select the medians by name
+    _, median_statistics, _, _ = build_sales(build_metrics())
+
+    assert list(median_statistics.columns) == list(sketch_specs)
+    expected = prices.groupby('suburb')[list(sketch_specs)].median()
+    assert list(median_statistics.index) == list(expected.index)
+    np.testing.assert_array_equal(median_statistics.values, expected.values)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_chunked_build_matches_whole(prices, workers):
+    suburb_index, median_statistics, histogram_cache, cube = build_sales(build_metrics())
+    chunked_index, chunked_medians, chunked_cache, chunked_cube = build_sales(build_metrics(), chunk_rows=1000,
+                                                                              workers=workers)
+
+    assert chunked_index.suburbs.equals(suburb_index.suburbs)
+    assert list(chunked_medians.columns) == list(median_statistics.columns)
+    for column in sketch_specs:
+        np.testing.assert_array_equal(chunked_cache.counts[column], histogram_cache.counts[column])
+        np.testing.assert_array_equal(chunked_cube.suburb_medians(column, 0, cube.n_months - 1),
+                                      cube.suburb_medians(column, 0, cube.n_months - 1))
+
+    # medians come from the sketches, exact but for prices
+    np.testing.assert_allclose(chunked_medians.values, median_statistics.values, rtol=0.01)
+
+
+@pytest.mark.parametrize('store', [False, True])
+def test_chunk_parts_read_every_row_once(prices, store):
+    if store:
+        from datastore import build_store
+        build_store()
+
+    parts = [pd.concat(read_chunks(['suburb', 'sellPrice'], chunk_rows=700, part=part, parts=3)) for part in range(3)]
+
+    read = pd.concat(parts)
+    assert all(len(part) for part in parts)
+    assert list(read.index) == list(prices.index)
+    assert list(read['suburb']) == list(prices['suburb'])
+    np.testing.assert_array_equal(read['sellPrice'], prices['sellPrice'])
+
+
+def test_input_version_follows_the_content(prices):
+    version = input_version()
+
+    # touched but unchanged
+    os.utime('data/prices_data.csv')
+    assert input_version() == version
+
+    prices.assign(sellPrice=prices['sellPrice'] * 2).to_csv('data/prices_data.csv')
+    assert input_version() != version
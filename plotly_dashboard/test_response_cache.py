@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import time
+
+import pytest
+from flask import Flask, jsonify
+
+from response_cache import MemoryTier, ResponseCache, SharedTier, callback_id
+
+
+def entry(body=b'x' * 100, etag='e'):
+    return {'etag': etag, 'mimetype': 'application/json', 'bodies': {'identity': body, 'gzip': body[:10]}}
+
+
+@pytest.fixture
+def shared_path(tmp_path):
+    return str(tmp_path / 'cache' / 'responses.sqlite')
+
+
+def worker(shared_path, version, calls):
+    """A Flask app like one gunicorn worker, with a memory tier and the shared tier"""
+    server = Flask(__name__)
+
+    @server.route('/_dash-layout')
+    def layout():
+        calls.append(version['data'])
+        return jsonify(data=version['data'])
+
+    cache = ResponseCache(server, version=lambda: version['data'],
+                          tiers=[MemoryTier(2 ** 20), SharedTier(shared_path, 2 ** 20, namespace='code')])
+
+    return server.test_client(), cache
+
+
+def test_memory_tier_evicts_least_recently_used():
+    tier = MemoryTier(250)
+    tier.put('a', '1', entry())
+    tier.put('b', '1', entry())
+    tier.get('a', '1')
+    tier.put('c', '1', entry())
+
+    assert tier.get('b', '1') is None
+    assert tier.get('a', '1') is not None and tier.get('c', '1') is not None
+    assert tier.bytes == 220
+
+
+def test_memory_tier_expires(monkeypatch):
+    tier = MemoryTier(2 ** 20, ttl=10)
+    tier.put('a', '1', entry())
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert tier.get('a', '1') is None and tier.bytes == 0
+
+
+def test_shared_tier_is_scoped_by_version_and_code(shared_path):
+    tier = SharedTier(shared_path, 2 ** 20, namespace='code')
+    tier.put('a', '1', entry())
+
+    assert tier.get('a', '1')['bodies'] == entry()['bodies']
+    assert tier.get('a', '2') is None
+    assert SharedTier(shared_path, 2 ** 20, namespace='other code').get('a', '1') is None
+
+    tier.invalidate('2')
+    assert tier.get('a', '1') is None and tier.bytes == 0
+
+
+def test_shared_tier_reads_dont_write(shared_path):
+    tier = SharedTier(shared_path, 2 ** 20)
+    tier.put('a', '1', entry())
+    connection = sqlite3.connect(shared_path)
+    used = connection.execute('SELECT used FROM responses').fetchone()[0]
+
+    tier.get('a', '1')
+    assert connection.execute('SELECT used FROM responses').fetchone()[0] == used
+
+    tier.touch('a', '1')
+    assert connection.execute('SELECT used FROM responses').fetchone()[0] > used
+
+
+def test_shared_tier_evicts_least_recently_used(shared_path):
+    tier = SharedTier(shared_path, 250)
+    tier.put('a', '1', entry())
+    tier.put('b', '1', entry())
+    tier.touch('a', '1')
+    tier.put('c', '1', entry())
+
+    assert tier.get('b', '1') is None
+    assert tier.get('a', '1') is not None and tier.get('c', '1') is not None
+
+
+def test_workers_share_responses(shared_path):
+    version, calls = {'data': 'v1'}, []
+    first, first_cache = worker(shared_path, version, calls)
+    second, second_cache = worker(shared_path, version, calls)
+
+    assert first.get('/_dash-layout').get_json() == {'data': 'v1'}
+    assert second.get('/_dash-layout').get_json() == {'data': 'v1'}
+    assert second.get('/_dash-layout').get_json() == {'data': 'v1'}
+
+    # computed once, then served from the shared tier and the second worker's memory
+    assert calls == ['v1']
+    assert second_cache.hits == {'memory': 1, 'shared': 1}
+
+
+def test_new_data_version_is_not_served_old_responses(shared_path):
+    version, calls = {'data': 'v1'}, []
+    client, _ = worker(shared_path, version, calls)
+    client.get('/_dash-layout')
+
+    # e.g. a restart on changed input data, in a process with empty memory
+    version['data'] = 'v2'
+    restarted, _ = worker(shared_path, version, calls)
+
+    assert restarted.get('/_dash-layout').get_json() == {'data': 'v2'}
+    assert calls == ['v1', 'v2']
+    assert os.path.exists(shared_path)
+
+
+def click(suburb, x):
+    """clickData of a click on a suburb of the map, at some position within it"""
+    return {'points': [{'curveNumber': 0, 'location': suburb, 'bbox': {'x0': x, 'x1': x, 'y0': 200, 'y1': 200}}]}
+
+
+def update(client, outputs, inputs):
+    """POST a callback like the Dash renderer"""
+    specs = [{'id': output.component_id, 'property': output.component_property} for output in outputs]
+    return client.post('/_dash-update-component', json={
+        'output': callback_id(outputs), 'outputs': specs, 'inputs': inputs, 'state': [],
+        'changedPropIds': ['{0}.{1}'.format(item['id'], item['property']) for item in inputs]})
+
+
+def test_selection_is_keyed_by_suburbs(dashboard):
+    client = dashboard.server.test_client()
+    cache = dashboard.response_cache
+    cache.clear()
+
+    def select(clickData, selectedData=None, dates=None):
+        return update(client, dashboard.selection_outputs, [
+            {'id': 'map', 'property': 'clickData', 'value': clickData},
+            {'id': 'map', 'property': 'selectedData', 'value': selectedData},
+            {'id': 'dates', 'property': 'value', 'value': dates}])
+
+    first = select(click('Suburb 0003', 100))
+    misses = cache.misses
+    # elsewhere in the same suburb, and a lasso around it alone
+    assert select(click('Suburb 0003', 120)).get_data() == first.get_data()
+    lasso = dict(click('Suburb 0003', 140), lassoPoints={'mapbox': [[151.1, -33.9], [151.2, -33.9], [151.2, -33.8]]})
+    assert select(click('Suburb 0003', 100), lasso).get_data() == first.get_data()
+    assert cache.misses == misses
+
+    select(click('Suburb 0004', 100))
+    select(click('Suburb 0003', 100), dates=[0, 5])
+    assert cache.misses == misses + 2
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from pipeline import sketch_specs
+from sketches import median, quantile, sketch_counts, sparse_quantile
+from suburb_index import SuburbIndex
+
+
+def suburb_sketches(index, column):
+    mapping = sketch_specs[column]
+    return sketch_counts(mapping.key(index.rows[column].values), index.codes, len(index), mapping.size)
+
+
+def assert_medians(actual, expected, column):
+    """Prices within the sketch's 1% relative accuracy, counts exactly"""
+    if column == 'sellPrice':
+        np.testing.assert_allclose(actual, expected, rtol=0.01)
+    else:
+        np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('column', list(sketch_specs))
+def test_medians_match_pandas(make_sales, column):
+    df = make_sales()
+    index = SuburbIndex(df)
+
+    medians = median(suburb_sketches(index, column), sketch_specs[column])
+
+    assert_medians(medians, df.groupby('suburb')[column].median().reindex(index.suburbs).values, column)
+
+
+@pytest.mark.parametrize('column', list(sketch_specs))
+def test_merged_sketches_match_pandas(make_sales, column):
+    df = make_sales()
+    index = SuburbIndex(df)
+    picked = index.suburbs[[1, 5, 7]]
+
+    merged = suburb_sketches(index, column)[[1, 5, 7]].sum(axis=0)
+
+    assert_medians(median(merged, sketch_specs[column]), df[df['suburb'].isin(picked)][column].median(), column)
+
+
+@pytest.mark.parametrize('n_suburbs, dtype', [(100, 'int8'), (700, 'int16')])
+def test_sketch_counts_narrow_codes(n_suburbs, dtype):
+    rng = np.random.default_rng(n_suburbs)
+    mapping = sketch_specs['bed']
+    keys = mapping.key(rng.integers(0, 10, 20000))
+    codes = rng.integers(0, n_suburbs, len(keys)).astype(dtype)
+
+    counts = sketch_counts(keys, codes, n_suburbs, mapping.size)
+
+    expected = np.array([np.bincount(keys[codes == group], minlength=mapping.size) for group in range(n_suburbs)])
+    np.testing.assert_array_equal(counts, expected)
+
+
+def test_sparse_quantile_matches_dense(make_sales):
+    df = make_sales()
+    index = SuburbIndex(df)
+    mapping = sketch_specs['sellPrice']
+    counts = suburb_sketches(index, 'sellPrice')
+
+    groups, keys = np.nonzero(counts)
+    for q in (0.1, 0.5, 0.9):
+        quantiles, totals = sparse_quantile(groups, keys, counts[groups, keys], len(index), mapping, q)
+        np.testing.assert_allclose(quantiles, quantile(counts, mapping, q))
+        np.testing.assert_array_equal(totals, counts.sum(axis=1))
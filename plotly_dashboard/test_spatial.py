@@ -0,0 +1,30 @@
+import numpy as np
+import shapely
+
+from spatial import LATITUDE, SuburbLocator
+
+
+def square(x, y, side=0.01):
+    return shapely.box(x, y, x + side, y + side)
+
+
+def test_locate_points():
+    # the second square overlaps the first, where the first one wins
+    locator = SuburbLocator(['A', 'B', 'C'], [square(151.0, LATITUDE), square(151.005, LATITUDE),
+                                               square(151.1, LATITUDE)])
+    lat = np.array([LATITUDE + 0.005, LATITUDE + 0.005, LATITUDE + 0.005, LATITUDE + 0.005, np.nan])
+    lon = np.array([151.002, 151.007, 151.012, 151.05, 151.0])
+
+    positions, distances = locator.locate(lat, lon)
+
+    assert locator.names(positions).tolist() == ['A', 'A', 'B', 'B', None]
+    np.testing.assert_array_equal(distances[:3], 0)
+    # 0.035 degrees of longitude east of B
+    np.testing.assert_allclose(distances[3], 0.035 * 111320 * np.cos(np.radians(LATITUDE)), rtol=1e-3)
+    assert np.isnan(distances[4])
+
+    positions, distances = locator.locate(lat[3:4], lon[3:4], nearest=False)
+    assert positions.tolist() == [-1] and np.isnan(distances[0])
+
+    positions, _ = locator.locate(lat[3:4], lon[3:4], max_distance=1000)
+    assert positions.tolist() == [-1]